@@ -0,0 +1,204 @@
+# fakes.py
+# Stand-ins for the two services the bot talks to, so benchmarks measure our own code
+# under a controlled load rather than the network:
+#   - FakeResponsesAPI answers the OpenAI Responses API (plain and streamed) through an
+#     httpx.MockTransport plugged into a real AsyncOpenAI client, so the SDK's request
+#     building and response parsing are still exercised. Latency and answer size are
+#     drawn from log-normal distributions, like real model calls. Prompt caching is
+#     simulated too: input tokens up to the end of the longest previously seen prefix
+#     of input items come back as cached_tokens. To exercise timeouts, hedging and the
+#     circuit breaker, a fraction of requests can fail (HTTP 500) or stall.
+#   - FakeBot implements the handful of Bot methods handlers.py calls, optionally with
+#     a fixed per-call latency.
+import asyncio
+import hashlib
+import json
+import itertools
+import random
+from types import SimpleNamespace
+
+import httpx
+from openai import AsyncOpenAI
+
+_WORDS = (
+    "retina detachment gas bubble positioning break cryotherapy laser vitrectomy patient "
+    "surgeon injection pneumatic retinopexy follow-up visual acuity macula superior "
+    "inferior quadrant tear lattice degeneration outcome success rate complication"
+).split()
+
+
+# OpenAI only caches prompts of at least this many tokens.
+MIN_CACHED_TOKENS = 1024
+
+
+def _lognormal(rng: random.Random, median: float, sigma: float) -> float:
+    return median * rng.lognormvariate(0, sigma) if sigma > 0 else median
+
+
+def answer_text(rng: random.Random, chars: int) -> str:
+    """Markdown-ish filler of roughly `chars` characters: paragraphs, some bold and a list."""
+    paragraphs = []
+    size = 0
+    while size < chars:
+        words = [rng.choice(_WORDS) for _ in range(rng.randint(20, 60))]
+        words[rng.randrange(len(words))] = f"**{rng.choice(_WORDS)}**"
+        paragraph = " ".join(words).capitalize() + "."
+        if rng.random() < 0.3:
+            paragraph += "\n" + "\n".join(f"- {rng.choice(_WORDS)} {rng.choice(_WORDS)}" for _ in range(3))
+        paragraphs.append(paragraph)
+        size += len(paragraph) + 2
+    return "\n\n".join(paragraphs)[:chars]
+
+
+class FakeResponsesAPI:
+    """Serves POST /v1/responses. Latency (seconds, to the full answer) and answer length
+    (characters) are log-normal around the given medians; sigma 0 makes them fixed.
+    Streamed answers arrive in `stream_chunk_chars` pieces spread evenly over the
+    latency, after `first_token_fraction` of it has passed. `error_rate` of requests
+    fail with a 500 and `stall_rate` take `stall_factor` times their latency."""
+
+    def __init__(self, latency: float = 1.0, latency_sigma: float = 0.4, answer_chars: int = 1200,
+                 answer_sigma: float = 0.5, stream_chunk_chars: int = 20, first_token_fraction: float = 0.3,
+                 error_rate: float = 0.0, stall_rate: float = 0.0, stall_factor: float = 20.0, seed: int = 0):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.answer_chars = answer_chars
+        self.answer_sigma = answer_sigma
+        self.stream_chunk_chars = stream_chunk_chars
+        self.first_token_fraction = first_token_fraction
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall_factor = stall_factor
+        self._rng = random.Random(seed)
+        self._ids = itertools.count(1)
+        self.requests = 0
+        self.request_bytes = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self._prefixes: set[bytes] = set()
+
+    def client(self) -> AsyncOpenAI:
+        """A real AsyncOpenAI client whose requests are answered by this fake."""
+        return AsyncOpenAI(
+            api_key="benchmark",
+            base_url="http://fake-openai.local/v1",
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(self.handle)),
+            max_retries=0,
+        )
+
+    def _cached_chars(self, body: dict) -> int:
+        """Characters of the request's longest prefix (instructions, then input items)
+        that an earlier request started with, remembering this request's prefixes."""
+        items = body.get("input", "")
+        items = items if isinstance(items, list) else [items]
+        h = hashlib.sha256(json.dumps([body.get("instructions"), body.get("tools")]).encode())
+        chars = cached = 0
+        for item in items:
+            h.update(json.dumps(item).encode())
+            chars += len(json.dumps(item))
+            digest = h.copy().digest()
+            if digest in self._prefixes:
+                cached = chars
+            self._prefixes.add(digest)
+        return cached
+
+    def _response(self, text: str, input_chars: int, cached_chars: int) -> dict:
+        input_tokens = input_chars // 4
+        cached_tokens = cached_chars // 4 if cached_chars // 4 >= MIN_CACHED_TOKENS else 0
+        self.input_tokens += input_tokens
+        self.cached_tokens += cached_tokens
+        output_tokens = len(text) // 4
+        response_id = f"resp_{next(self._ids)}"
+        return {
+            "id": response_id,
+            "object": "response",
+            "created_at": 0,
+            "model": "fake",
+            "status": "completed",
+            "output": [{
+                "type": "message",
+                "id": f"msg_{response_id}",
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }],
+            "usage": {
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+                "input_tokens_details": {"cached_tokens": cached_tokens},
+                "output_tokens_details": {"reasoning_tokens": 0},
+            },
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": [],
+        }
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        self.request_bytes += len(request.content)
+        body = json.loads(request.content)
+        input_chars = len(json.dumps(body.get("input", "")))
+        cached_chars = self._cached_chars(body)
+        latency = _lognormal(self._rng, self.latency, self.latency_sigma)
+        if self._rng.random() < self.error_rate:
+            await asyncio.sleep(latency * self.first_token_fraction)
+            return httpx.Response(500, json={"error": {"message": "fake server error", "type": "server_error"}})
+        if self._rng.random() < self.stall_rate:
+            latency *= self.stall_factor
+        text = answer_text(self._rng, max(1, int(_lognormal(self._rng, self.answer_chars, self.answer_sigma))))
+        if not body.get("stream"):
+            await asyncio.sleep(latency)
+            return httpx.Response(200, json=self._response(text, input_chars, cached_chars))
+        return httpx.Response(
+            200, headers={"content-type": "text/event-stream"},
+            content=self._stream(text, input_chars, cached_chars, latency),
+        )
+
+    async def _stream(self, text: str, input_chars: int, cached_chars: int, latency: float):
+        chunks = [text[i:i + self.stream_chunk_chars] for i in range(0, len(text), self.stream_chunk_chars)]
+        await asyncio.sleep(latency * self.first_token_fraction)
+        gap = latency * (1 - self.first_token_fraction) / max(1, len(chunks))
+        for n, chunk in enumerate(chunks):
+            yield _sse("response.output_text.delta", {
+                "delta": chunk, "item_id": "msg", "output_index": 0, "content_index": 0,
+                "sequence_number": n, "logprobs": [],
+            })
+            await asyncio.sleep(gap)
+        yield _sse("response.completed", {"response": self._response(text, input_chars, cached_chars), "sequence_number": len(chunks)})
+
+
+def _sse(event_type: str, data: dict) -> bytes:
+    return f"event: {event_type}\ndata: {json.dumps({'type': event_type, **data})}\n\n".encode("utf-8")
+
+
+class FakeBot:
+    """The subset of telegram.Bot that handlers.py uses, recording what was sent."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self._message_ids = itertools.count(1)
+        self.calls = {"send_message": 0, "edit_message_text": 0, "delete_message": 0, "send_chat_action": 0}
+        self.sent_chars = 0
+
+    async def _call(self, name: str) -> None:
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, parse_mode=None, **kwargs):
+        await self._call("send_message")
+        self.sent_chars += len(text)
+        return SimpleNamespace(message_id=next(self._message_ids), chat_id=chat_id, text=text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, parse_mode=None, **kwargs):
+        await self._call("edit_message_text")
+        return True
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self._call("delete_message")
+        return True
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        await self._call("send_chat_action")
+        return True
@@ -0,0 +1,93 @@
+# markdown.py
+# Micro-benchmarks for turning a reply into Telegram messages: the current
+# telegram_markdown.render_chunks() against the previous split-then-render-each-chunk
+# implementation (markdown_reference.py), on typical and worst-case replies. Also checks
+# that single-message replies render identically with both.
+#
+#   python -m benchmarks.markdown
+#   python -m benchmarks.markdown --repeat 5 --number 200
+import argparse
+import random
+import timeit
+
+from telegram_openai_assistant.telegram_markdown import render_chunks
+
+from . import markdown_reference as reference
+from .fakes import answer_text
+
+# Same as handlers.MARKDOWN_SPLIT_LIMIT (importing handlers would need a full config).
+SPLIT_LIMIT = 3000
+
+
+def _structured(rng: random.Random, chars: int) -> str:
+    """A reply using most of what the renderer handles: headings, lists, quotes, code."""
+    parts = []
+    size = 0
+    while size < chars:
+        kind = rng.random()
+        if kind < 0.4:
+            part = answer_text(rng, rng.randint(200, 800))
+        elif kind < 0.6:
+            part = "\n".join(f"{i + 1}. **{answer_text(rng, 30)}**: {answer_text(rng, 90)}" for i in range(rng.randint(3, 8)))
+        elif kind < 0.7:
+            part = "```\n" + "\n".join(f"dose[{i}] = {i * 0.1:.1f}  # <ml> & more" for i in range(rng.randint(5, 30))) + "\n```"
+        elif kind < 0.8:
+            part = "> " + answer_text(rng, 300).replace("\n", "\n> ")
+        elif kind < 0.9:
+            part = "### " + answer_text(rng, 40)
+        else:
+            part = "See [the protocol](https://example.org/pnr?a=1&b=2), `gas <type>` and ~~older~~ advice."
+        parts.append(part)
+        size += len(part) + 2
+    return "\n\n".join(parts)
+
+
+def _plain(rng: random.Random, chars: int) -> str:
+    """A reply with no Markdown at all."""
+    words = answer_text(rng, chars).replace("*", "").replace("- ", "")
+    return words
+
+
+def _cases(rng: random.Random) -> dict[str, str]:
+    return {
+        "plain, 400 chars": _plain(rng, 400),
+        "plain, 12k chars": _plain(rng, 12_000),
+        "markdown, 1.5k chars": _structured(rng, 1500),
+        "markdown, 12k chars": _structured(rng, 12_000),
+        "markdown, 40k chars": _structured(rng, 40_000),
+        # Thousands of blank-line-separated empty quotes: the old renderer's output
+        # collapsing loop rescans the whole string once per pass.
+        "pathological newlines": ">\n\n" * 2000,
+        # Line endings markdown-it accepts but the block splitter once didn't count.
+        "CRLF, 12k chars": _structured(rng, 12_000).replace("\n", "\r\n"),
+        "CR, 12k chars": _structured(rng, 12_000).replace("\n", "\r"),
+    }
+
+
+def _reference_chunks(text: str) -> list[tuple[str, str]]:
+    return [(chunk, reference.to_telegram_html(chunk)) for chunk in reference._split_message(text, SPLIT_LIMIT)]
+
+
+def _best(fn, text: str, repeat: int, number: int) -> float:
+    return min(timeit.repeat(lambda: fn(text), repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Markdown rendering and splitting.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=50, help="Calls per timing run (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'case':<24}{'chunks':>8}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for name, text in _cases(random.Random(args.seed)).items():
+        chunks = render_chunks(text, SPLIT_LIMIT)
+        if len(text) <= SPLIT_LIMIT and chunks != _reference_chunks(text):
+            print(f"{name}: output differs from the reference renderer")
+        before = _best(_reference_chunks, text, args.repeat, args.number)
+        after = _best(lambda t: render_chunks(t, SPLIT_LIMIT), text, args.repeat, args.number)
+        print(f"{name:<24}{len(chunks):>8}{before * 1000:>12.3f}{after * 1000:>12.3f}{before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
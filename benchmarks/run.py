@@ -0,0 +1,223 @@
+# run.py
+# Offline throughput benchmark: feeds synthetic Telegram updates through the real
+# handlers (process_message / process_group_message), with OpenAI replaced by
+# fakes.FakeResponsesAPI and the Telegram Bot by fakes.FakeBot, and reports for each
+# scenario messages/sec, the per-stage latencies recorded in metrics.py, request sizes
+# and memory. Nothing leaves the machine; state goes to a throwaway temp directory.
+#
+#   python -m benchmarks.run                       # every scenario
+#   python -m benchmarks.run --scenarios big_answers many_chats --latency-ms 50
+#   python -m benchmarks.run --no-stream --memory  # non-streamed replies, tracemalloc peak
+#
+# Within a scenario every chat sends its messages one after another (waiting for each
+# answer, like a person would) and all chats run concurrently.
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from telegram import Update
+
+from . import fakes
+
+SCENARIOS = {
+    # name: (chats, messages per chat, group chats?, median answer chars, seeded history turns)
+    "baseline": (20, 5, False, 1200, 0),
+    # Just under handlers.MAX_CONVERSATION_TURNS, so the threads continue (and grow into
+    # background compaction) rather than being reset.
+    "long_histories": (20, 3, False, 1200, 38),
+    "big_answers": (20, 3, False, 12_000, 0),
+    "many_chats": (500, 2, False, 1200, 0),
+    "groups": (20, 5, True, 1200, 0),
+}
+# Size of each seeded history turn, so long_histories resends ~150 KB per request.
+HISTORY_TURN_CHARS = 4000
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark message handling against fake OpenAI and Telegram.")
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--latency-ms", type=float, default=200, help="Median model latency (default: %(default)s)")
+    parser.add_argument("--latency-sigma", type=float, default=0.4,
+                        help="Log-normal spread of model latency, 0 = fixed (default: %(default)s)")
+    parser.add_argument("--answer-sigma", type=float, default=0.5,
+                        help="Log-normal spread of answer length, 0 = fixed (default: %(default)s)")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Fraction of model requests that fail with a 500 (default: %(default)s)")
+    parser.add_argument("--stall-rate", type=float, default=0,
+                        help="Fraction of model requests that take 20x their latency (default: %(default)s)")
+    parser.add_argument("--hedge", action="store_true", help="Turn on OPENAI_HEDGE_REQUESTS")
+    parser.add_argument("--telegram-latency-ms", type=float, default=0, help="Latency of each Bot API call")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="Pace sends at the default Telegram rate limits (off: unlimited)")
+    parser.add_argument("--no-stream", action="store_true", help="Benchmark with STREAM_REPLIES off")
+    parser.add_argument("--answer-cache", action="store_true", help="Leave the answer cache on")
+    parser.add_argument("--max-concurrency", type=int, default=64, help="OPENAI_MAX_CONCURRENCY (default: %(default)s)")
+    parser.add_argument("--memory", action="store_true",
+                        help="Track Python allocations with tracemalloc (slower, but reports the peak per scenario)")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def _configure_environment(args, data_dir: str) -> None:
+    """Settings for the package, which reads them at import time -- so this must run
+    before anything from telegram_openai_assistant is imported."""
+    os.environ.update({
+        "TELEGRAM_TOKEN": "0:benchmark",
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_VECTOR_STORE_ID": "vs_benchmark",
+        "DATA_DIR": data_dir,
+        "SQLITE_DB_PATH": os.path.join(data_dir, "bot_state.db"),
+        "STORAGE_BACKEND": "sqlite",
+        "STREAM_REPLIES": "0" if args.no_stream else "1",
+        "ANSWER_CACHE_ENABLED": "1" if args.answer_cache else "0",
+        "OPENAI_MAX_CONCURRENCY": str(args.max_concurrency),
+        "OPENAI_REQUESTS_PER_MINUTE": "0",
+        "OPENAI_TOKENS_PER_MINUTE": "0",
+        "OPENAI_HEDGE_REQUESTS": "1" if args.hedge else "0",
+        **({} if args.telegram_limits else {
+            "TELEGRAM_MESSAGES_PER_SECOND": "0",
+            "TELEGRAM_CHAT_MESSAGES_PER_MINUTE": "0",
+            "TELEGRAM_GROUP_MESSAGES_PER_MINUTE": "0",
+        }),
+        "QUOTA_USER_MESSAGES": "0",
+        "QUOTA_USER_TOKENS": "0",
+        "QUOTA_CHAT_MESSAGES": "0",
+        "QUOTA_CHAT_TOKENS": "0",
+        "QUOTA_GLOBAL_MESSAGES": "0",
+        "QUOTA_GLOBAL_TOKENS": "0",
+    })
+    # config.py loads .env with override=True, which would let a developer's .env point
+    # the benchmark at their real database or re-enable quotas. Benchmarks only ever use
+    # the settings above.
+    import dotenv
+    dotenv.load_dotenv = lambda *a, **kw: False
+
+
+def _format_ms(seconds: float) -> str:
+    return f"{seconds * 1000:.1f}"
+
+
+async def _run_scenario(name: str, args, fake, fake_update, handlers, metrics, storage, chat_offset: int) -> dict:
+    from telegram_openai_assistant import profiles
+    from telegram_openai_assistant.openai_client import MODEL_REQUESTS
+    from telegram_openai_assistant.resilience import guard
+
+    chats, per_chat, group, answer_chars, history_turns = SCENARIOS[name]
+    fake.answer_chars = answer_chars
+    bot = fakes.FakeBot(args.telegram_latency_ms / 1000)
+    context = SimpleNamespace(bot=bot, args=[])
+    chat_ids = [chat_offset + i for i in range(chats)]
+
+    if history_turns:
+        filler = fakes.answer_text(fake._rng, HISTORY_TURN_CHARS)
+        for chat_id in chat_ids:
+            history = [handlers._new_turn("user" if n % 2 == 0 else "assistant", filler) for n in range(history_turns)]
+            storage.save_history(handlers._conversation_key(chat_id, chat_id), history, expected_updated_at=None)
+
+    async def converse(chat_id: int) -> None:
+        user_id = chat_id + 1 if group else chat_id
+        for n in range(per_chat):
+            text = f"Question {n} about pneumatic retinopexy and gas bubble positioning?"
+            if group:
+                text = "/chat " + text
+            update = Update.de_json(fake_update.build_update(text, chat_id, user_id, group=group), None)
+            if group:
+                await handlers.process_group_message(update, context)
+            else:
+                await handlers.process_message(update, context)
+
+    metrics.registry.reset()
+    requests_before, bytes_before = fake.requests, fake.request_bytes
+    input_before, cached_before = fake.input_tokens, fake.cached_tokens
+    if args.memory:
+        tracemalloc.reset_peak()
+        traced_before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    await asyncio.gather(*(converse(chat_id) for chat_id in chat_ids))
+    await handlers.drain(60)
+    elapsed = time.perf_counter() - started
+
+    requests = fake.requests - requests_before
+    result = {
+        "messages": chats * per_chat,
+        "seconds": elapsed,
+        "requests": requests,
+        "avg_request_kb": (fake.request_bytes - bytes_before) / max(1, requests) / 1024,
+        "cached_input": (fake.cached_tokens - cached_before) / max(1, fake.input_tokens - input_before),
+        "bot_calls": dict(bot.calls),
+        "answers": {
+            outcome: int(MODEL_REQUESTS.value(profile=profiles.DEFAULT_PROFILE, outcome=outcome))
+            for outcome in ("model", "cache", "error", "degraded")
+        },
+        "resilience": guard.stats(),
+        "stages": {
+            labels["stage"]: (count, quantiles)
+            for labels, count, _, quantiles in metrics.STAGE_SECONDS.snapshot()
+        },
+        "maxrss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if args.memory:
+        result["traced_peak_mb"] = (tracemalloc.get_traced_memory()[1] - traced_before) / (1024 * 1024)
+    return result
+
+
+def _report(name: str, result: dict) -> None:
+    rate = result["messages"] / result["seconds"] if result["seconds"] else 0.0
+    print(f"\n== {name}: {result['messages']} messages in {result['seconds']:.2f}s = {rate:.1f} msg/s")
+    print(
+        f"   model requests: {result['requests']}, avg request {result['avg_request_kb']:.1f} KB, "
+        f"{result['cached_input']:.0%} of input tokens prompt-cached"
+    )
+    print("   bot calls: " + ", ".join(f"{k}={v}" for k, v in result["bot_calls"].items()))
+    print("   answers: " + ", ".join(f"{k}={v}" for k, v in result["answers"].items()))
+    print("   resilience: " + ", ".join(f"{k}={v:g}" for k, v in result["resilience"].items()))
+    memory = f"   max RSS {result['maxrss_mb']:.0f} MB"
+    if "traced_peak_mb" in result:
+        memory += f", Python allocation peak +{result['traced_peak_mb']:.1f} MB"
+    print(memory)
+    print(f"   {'stage':<24}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, (count, quantiles) in sorted(result["stages"].items()):
+        p50, p95, p99 = (quantiles.get(q, 0.0) for q in (0.5, 0.95, 0.99))
+        print(f"   {stage:<24}{count:>7}{_format_ms(p50):>10}{_format_ms(p95):>10}{_format_ms(p99):>10}")
+
+
+async def _main(args) -> None:
+    from telegram_openai_assistant import fake_update, handlers, metrics, openai_client
+    from telegram_openai_assistant.storage import backend as storage
+    from telegram_openai_assistant.analytics import analytics
+
+    fake = fakes.FakeResponsesAPI(
+        latency=args.latency_ms / 1000, latency_sigma=args.latency_sigma, answer_sigma=args.answer_sigma,
+        error_rate=args.error_rate, stall_rate=args.stall_rate, seed=args.seed,
+    )
+    openai_client.client = fake.client()
+    storage.init_db()
+    try:
+        for i, name in enumerate(args.scenarios):
+            # Distinct chat ids per scenario, so each starts from fresh conversations.
+            result = await _run_scenario(name, args, fake, fake_update, handlers, metrics, storage, (i + 1) * 1_000_000)
+            _report(name, result)
+    finally:
+        await analytics.close()
+        storage.close()
+
+
+def main():
+    args = _parse_args()
+    with tempfile.TemporaryDirectory(prefix="bot-benchmark-") as data_dir:
+        _configure_environment(args, data_dir)
+        if args.memory:
+            tracemalloc.start()
+        print(f"Model latency ~{args.latency_ms:.0f} ms, streaming {'off' if args.no_stream else 'on'}, "
+              f"max concurrency {args.max_concurrency}", file=sys.stderr)
+        asyncio.run(_main(args))
+
+
+if __name__ == "__main__":
+    main()
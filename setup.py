@@ -15,6 +15,8 @@ setup(
     entry_points={
         'console_scripts': [
             'chatbot = telegram_openai_assistant.bot:main',
+            'chatbot-export-qa = telegram_openai_assistant.export_qa:main',
+            'chatbot-build-index = telegram_openai_assistant.build_index:main',
         ],
     },
 )
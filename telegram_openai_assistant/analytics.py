@@ -0,0 +1,144 @@
+# analytics.py
+# Gets every answered question into the Q&A log (see utils.py) without making the reply
+# wait for it. Handlers call analytics.record() with a structured event -- question,
+# answer, who asked where, latency, tokens, cache hits -- which only puts it on an
+# in-memory queue. A background task takes events off in batches and appends each batch
+# under a single hold of the log's file lock, off the event loop. If the log can't keep
+# up (a slow or stalled disk), the queue fills up to QA_QUEUE_MAX_EVENTS and further
+# events are dropped and counted, so a backed-up log never slows replies down or grows
+# memory without bound.
+import asyncio
+import datetime
+import logging
+import time
+
+from .metrics import registry
+from .utils import save_qa_batch
+
+logger = logging.getLogger(__name__)
+
+# Events waiting to be written; beyond this, new ones are dropped.
+QA_QUEUE_MAX_EVENTS = 10_000
+# Events appended per write.
+QA_BATCH_MAX_EVENTS = 500
+# How long the writer lets a batch build up, unless a full one is already waiting. Also
+# the longest an event sits in memory before being written.
+QA_FLUSH_INTERVAL_SECONDS = 1.0
+# Log every this many-th drop, rather than each of a flood of them.
+DROP_LOG_EVERY = 100
+
+EVENTS = registry.counter(
+    "bot_qa_events_total", "Q&A log events, by outcome (queued, written, dropped, failed)", ("outcome",)
+)
+
+
+def qa_event(user, chat, question: str, result, seconds: float, profile: str) -> dict:
+    """The Q&A log entry for one answered question. user and chat are the Telegram
+    User/Chat it came from, result the openai_client.ResponseResult that answered it,
+    seconds how long the reply took, queueing included, and profile the name of the
+    assistant profile that answered. The first five fields are the log's original
+    format."""
+    return {
+        "telegram_id": user.id,
+        "username": user.username,
+        "question": question,
+        "answer": result.text,
+        "timestamp": str(datetime.datetime.now()),
+        "chat_id": chat.id,
+        "chat_type": chat.type,
+        "profile": profile,
+        "latency_seconds": round(seconds, 3),
+        "first_token_seconds": round(result.first_token_seconds, 3) if result.first_token_seconds is not None else None,
+        "total_tokens": result.total_tokens,
+        "input_tokens": result.input_tokens,
+        "cached_tokens": result.cached_tokens,
+        "answer_cache": result.cached,
+        "route": result.route,
+        "error": result.response_id is None and result.route is None,
+    }
+
+
+class AnalyticsPipeline:
+    def __init__(self, write_batch, max_events: int, batch_size: int, flush_interval: float):
+        self._write_batch = write_batch
+        self._max_events = max_events
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        # Created on first use, on the event loop the handlers run on.
+        self._queue: asyncio.Queue | None = None
+        self._closing: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._stats = {
+            "queued": 0,
+            "written": 0,
+            "dropped": 0,
+            "failed": 0,
+            "batches": 0,
+            "last_batch_ms": 0.0,
+            "max_batch_ms": 0.0,
+        }
+
+    def record(self, event: dict) -> None:
+        """Queues event for the log; never waits. Must be called on the event loop."""
+        if self._task is None:
+            self._queue = asyncio.Queue(self._max_events)
+            self._closing = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self._stats["dropped"] += 1
+            EVENTS.inc(outcome="dropped")
+            if self._stats["dropped"] % DROP_LOG_EVERY == 1:
+                logger.warning(f"Q&A log is {self._max_events} events behind; dropped {self._stats['dropped']} so far")
+            return
+        self._stats["queued"] += 1
+        EVENTS.inc(outcome="queued")
+
+    def _take_batch(self) -> list[dict]:
+        batch = []
+        while len(batch) < self._batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _write(self, batch: list[dict]) -> None:
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+        except Exception as e:
+            # Not retried: a disk that's failing would only back the queue up further.
+            self._stats["failed"] += len(batch)
+            EVENTS.inc(len(batch), outcome="failed")
+            logger.error(f"Failed to write {len(batch)} Q&A log entries: {e}")
+            return
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._stats["written"] += len(batch)
+        self._stats["batches"] += 1
+        self._stats["last_batch_ms"] = elapsed_ms
+        self._stats["max_batch_ms"] = max(self._stats["max_batch_ms"], elapsed_ms)
+        EVENTS.inc(len(batch), outcome="written")
+
+    async def _run(self) -> None:
+        while not (self._closing.is_set() and self._queue.empty()):
+            if self._queue.qsize() < self._batch_size and not self._closing.is_set():
+                try:
+                    await asyncio.wait_for(self._closing.wait(), self._flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self._take_batch()
+            if batch:
+                await self._write(batch)
+
+    async def close(self) -> None:
+        """Writes out everything still queued and stops the writer."""
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        self._closing.set()
+        await task
+
+    def stats(self) -> dict:
+        return {"queue_depth": self._queue.qsize() if self._queue is not None else 0, **self._stats}
+
+
+analytics = AnalyticsPipeline(save_qa_batch, QA_QUEUE_MAX_EVENTS, QA_BATCH_MAX_EVENTS, QA_FLUSH_INTERVAL_SECONDS)
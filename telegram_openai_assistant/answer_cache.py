@@ -0,0 +1,253 @@
+# answer_cache.py
+# Caches the model's answer to the *first* message of a conversation, so the same
+# question asked again (by anyone) is answered instantly instead of paying for another
+# full file_search call. Only first turns are cacheable: later turns depend on the
+# conversation before them, and their answers wouldn't transfer to another thread.
+#
+# Lookups match on the normalized question text (case, punctuation and whitespace
+# insensitive), plus an optional TF-IDF cosine-similarity match above
+# ANSWER_CACHE_SIMILARITY_THRESHOLD for reworded questions. Every entry is tagged with a
+# fingerprint of everything that shapes an answer (model, temperature, instructions,
+# vector store, retrieval mode), so changing any of them invalidates the cache instead of serving answers
+# the current configuration wouldn't give. With several assistant profiles (see
+# profiles.py), each has its own fingerprint, and so its own answers; lookups only ever
+# match the asking profile's. Entries live in the same SQLite file as conversation
+# state, so they survive restarts.
+import hashlib
+import logging
+import math
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from .config import (
+    answer_cache_enabled,
+    answer_cache_similarity_threshold,
+    answer_cache_ttl_seconds,
+    sqlite_db_path,
+)
+
+logger = logging.getLogger(__name__)
+
+# Bounds each fingerprint's in-memory similarity index (and its entries in the table,
+# which are pruned to match).
+MAX_ENTRIES = 5000
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+# Words that carry no meaning for matching clinical questions to each other.
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it me my of on or should "
+    "the to was what when where which who why will with you your".split()
+)
+
+
+def normalize(text: str) -> str:
+    return " ".join(_WORD_RE.findall(text.lower()))
+
+
+def _terms(normalized: str) -> Counter:
+    return Counter(w for w in normalized.split() if w not in _STOPWORDS)
+
+
+def fingerprint(model: str, temperature: float, instructions: str, store_id: str | None, retrieval: str) -> str:
+    h = hashlib.sha256()
+    for part in (model, repr(temperature), instructions, store_id or "", retrieval):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class _SimilarityIndex:
+    """One fingerprint's cached questions: normalized question -> (term counts,
+    created_at), plus document frequencies across all of them for the IDF weights."""
+
+    def __init__(self):
+        self.entries: dict[str, tuple[Counter, float]] = {}
+        self._df: Counter = Counter()
+
+    def add(self, question: str, created_at: float) -> None:
+        if question in self.entries:
+            self.remove(question)
+        terms = _terms(question)
+        self.entries[question] = (terms, created_at)
+        self._df.update(terms.keys())
+
+    def remove(self, question: str) -> None:
+        terms, _ = self.entries.pop(question)
+        self._df.subtract(terms.keys())
+
+    def _weights(self, terms: Counter) -> dict[str, float]:
+        n = len(self.entries) + 1
+        return {t: c * (math.log(n / (1 + self._df[t])) + 1) for t, c in terms.items()}
+
+    def most_similar(self, question: str, now: float, ttl_seconds: float, threshold: float) -> tuple[str, float] | None:
+        query = self._weights(_terms(question))
+        query_norm = math.sqrt(sum(w * w for w in query.values()))
+        if not query_norm:
+            return None
+        best, best_score = None, 0.0
+        for candidate, (terms, created_at) in self.entries.items():
+            if now - created_at >= ttl_seconds or not query.keys() & terms.keys():
+                continue
+            weights = self._weights(terms)
+            norm = math.sqrt(sum(w * w for w in weights.values()))
+            score = sum(w * weights.get(t, 0.0) for t, w in query.items()) / (query_norm * norm)
+            if score > best_score:
+                best, best_score = candidate, score
+        if best is None or best_score < threshold:
+            return None
+        return best, best_score
+
+
+class AnswerCache:
+    """Persistent first-turn answer cache. Methods block on SQLite, so call them via
+    asyncio.to_thread from async code."""
+
+    def __init__(self, db_path: str, ttl_seconds: float, similarity_threshold: float):
+        self._db_path = db_path
+        self._ttl_seconds = ttl_seconds
+        self._similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        # fingerprint -> similarity index of its questions
+        self._indexes: dict[str, _SimilarityIndex] = {}
+        self._stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "stores": 0}
+
+    def init(self, fingerprints: list[str]) -> None:
+        """Create the table, drop entries past their TTL or from configurations other than
+        `fingerprints` (those of the current profiles), and load the similarity index.
+        Call once at startup."""
+        with self._lock:
+            self._conn = sqlite3.connect(self._db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            with self._conn:
+                self._conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS answer_cache (
+                        fingerprint TEXT NOT NULL,
+                        question TEXT NOT NULL,
+                        answer TEXT NOT NULL,
+                        response_id TEXT,
+                        total_tokens INTEGER,
+                        created_at REAL NOT NULL,
+                        PRIMARY KEY (fingerprint, question)
+                    )
+                    """
+                )
+                placeholders = ", ".join("?" * len(fingerprints))
+                deleted = self._conn.execute(
+                    f"DELETE FROM answer_cache WHERE fingerprint NOT IN ({placeholders}) OR created_at < ?",
+                    (*fingerprints, time.time() - self._ttl_seconds),
+                ).rowcount
+            if deleted:
+                logger.info(f"Answer cache: dropped {deleted} stale or invalidated entries")
+            if self._similarity_threshold > 0:
+                for fp, question, created_at in self._conn.execute(
+                    "SELECT fingerprint, question, created_at FROM answer_cache"
+                ):
+                    self._index(fp).add(question, created_at)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _index(self, fp: str) -> _SimilarityIndex:
+        index = self._indexes.get(fp)
+        if index is None:
+            index = self._indexes[fp] = _SimilarityIndex()
+        return index
+
+    def lookup(self, fp: str, question: str) -> dict | None:
+        """Returns {"answer", "response_id", "total_tokens"} for a cached answer to this
+        question under fingerprint fp (or, if similarity matching is on, to a close
+        enough rewording), else None."""
+        normalized = normalize(question)
+        if not normalized:
+            return None
+        now = time.time()
+        with self._lock:
+            if self._conn is None:
+                return None
+            row = self._select(fp, normalized, now)
+            if row is not None:
+                self._stats["exact_hits"] += 1
+            elif self._similarity_threshold > 0 and fp in self._indexes:
+                match = self._indexes[fp].most_similar(normalized, now, self._ttl_seconds, self._similarity_threshold)
+                if match is not None:
+                    row = self._select(fp, match[0], now)
+                    if row is not None:
+                        self._stats["similar_hits"] += 1
+                        logger.info(f"Answer cache: similar match (score {match[1]:.2f}) for {question!r}")
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+        return {"answer": row[0], "response_id": row[1], "total_tokens": row[2]}
+
+    def _select(self, fp: str, normalized: str, now: float):
+        return self._conn.execute(
+            """
+            SELECT answer, response_id, total_tokens FROM answer_cache
+            WHERE fingerprint = ? AND question = ? AND created_at >= ?
+            """,
+            (fp, normalized, now - self._ttl_seconds),
+        ).fetchone()
+
+    def store(self, fp: str, question: str, answer: str, response_id: str | None, total_tokens: int | None) -> None:
+        normalized = normalize(question)
+        if not normalized:
+            return
+        now = time.time()
+        with self._lock:
+            if self._conn is None:
+                return
+            with self._conn:
+                self._conn.execute(
+                    """
+                    INSERT OR REPLACE INTO answer_cache
+                        (fingerprint, question, answer, response_id, total_tokens, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (fp, normalized, answer, response_id, total_tokens, now),
+                )
+                self._stats["stores"] += 1
+                if self._stats["stores"] % 100 == 0:
+                    self._prune(now)
+            if self._similarity_threshold > 0:
+                self._index(fp).add(normalized, now)
+
+    def _prune(self, now: float) -> None:
+        """Drops expired entries and, past MAX_ENTRIES per fingerprint, the oldest ones."""
+        self._conn.execute(
+            "DELETE FROM answer_cache WHERE created_at < ?", (now - self._ttl_seconds,)
+        )
+        self._conn.execute(
+            """
+            DELETE FROM answer_cache WHERE rowid IN (
+                SELECT rowid FROM (
+                    SELECT rowid, ROW_NUMBER() OVER (PARTITION BY fingerprint ORDER BY created_at DESC) AS age
+                    FROM answer_cache
+                ) WHERE age > ?
+            )
+            """,
+            (MAX_ENTRIES,),
+        )
+        if self._similarity_threshold > 0:
+            kept = set(self._conn.execute("SELECT fingerprint, question FROM answer_cache"))
+            for fp, index in self._indexes.items():
+                for question in [q for q in index.entries if (fp, q) not in kept]:
+                    index.remove(question)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"indexed": sum(len(index.entries) for index in self._indexes.values()), **self._stats}
+
+
+cache: AnswerCache | None = (
+    AnswerCache(sqlite_db_path, answer_cache_ttl_seconds, answer_cache_similarity_threshold)
+    if answer_cache_enabled
+    else None
+)
@@ -1,8 +1,33 @@
 # bot.py
+import asyncio
+import signal
+
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from .config import telegram_token, validate_config
-from .handlers import start, help_command, process_message, process_group_message, chat_command
-from . import storage
+from .config import (
+    bot_mode,
+    concurrent_updates,
+    drain_timeout_seconds,
+    metrics_log_interval_seconds,
+    metrics_port,
+    telegram_token,
+    validate_config,
+    webhook_listen,
+    webhook_path,
+    webhook_port,
+    webhook_secret_token,
+    webhook_url,
+)
+from .handlers import start, help_command, process_message, process_group_message, chat_command, drain, usage_command
+from .webserver import HttpServer, WebhookServer
+from . import answer_cache, handlers, metrics, openai_client, profiles, retrieval
+from .analytics import analytics
+from .quotas import quotas
+from .resilience import guard
+from .router import router
+from .scheduler import admission
+from .sender import sender
+from .storage import backend as storage
+from .utils import migrate_legacy_qa
 import logging
 from telegram import Update
 logging.basicConfig(
@@ -12,7 +37,63 @@ logger = logging.getLogger(__name__)
 
 validate_config()
 
-application = Application.builder().token(telegram_token).build()
+# Background work besides handling updates: the METRICS_PORT metrics server and the
+# periodic metrics log. Started/stopped by _start_observability/_stop_observability,
+# which also writes out the Q&A log's queue (analytics.py) on the way out.
+_metrics_server: HttpServer | None = None
+_metrics_log_task: asyncio.Task | None = None
+
+
+def register_metrics():
+    """Exposes the stats() counters the other modules keep as gauges (see metrics.py)."""
+    metrics.registry.register_stats("bot_storage_write_queue", "Conversation write-behind queue", storage.write_queue_stats)
+    metrics.registry.register_stats("bot_storage_cache", "In-memory conversation cache", storage.cache_stats)
+    if answer_cache.cache is not None:
+        metrics.registry.register_stats("bot_answer_cache", "First-turn answer cache", answer_cache.cache.stats)
+    if retrieval.index is not None:
+        metrics.registry.register_stats("bot_retrieval", "Local retrieval index", retrieval.index.stats)
+    metrics.registry.register_stats("bot_admission", "Model-call admission queue", admission.stats)
+    metrics.registry.register_stats("bot_quota", "Usage quota checks", quotas.stats)
+    metrics.registry.register_stats("bot_router", "Messages answered without the model", router.stats)
+    metrics.registry.register_stats("bot_qa_log", "Q&A log write queue", analytics.stats)
+    metrics.registry.register_stats("bot_telegram_sender", "Outbound Bot API calls", sender.stats)
+    metrics.registry.register_stats("bot_model_resilience", "Model-call deadlines, hedging and circuit breaker", guard.stats)
+    metrics.registry.register_stats("bot_model_input", "Model calls by input mode", lambda: openai_client.request_stats)
+    metrics.registry.register_stats("bot_replies", "Replies and conversations in progress", handlers.stats)
+
+
+async def _start_observability(app=None):
+    global _metrics_server, _metrics_log_task
+    if metrics_port:
+        _metrics_server = HttpServer(webhook_listen, metrics_port)
+        await _metrics_server.start()
+    if metrics_log_interval_seconds > 0:
+        _metrics_log_task = asyncio.create_task(metrics.log_periodically(metrics_log_interval_seconds))
+
+
+async def _stop_observability(app=None):
+    global _metrics_server, _metrics_log_task
+    if _metrics_log_task is not None:
+        _metrics_log_task.cancel()
+        _metrics_log_task = None
+    if _metrics_server is not None:
+        await _metrics_server.stop()
+        _metrics_server = None
+    await analytics.close()
+    summary = metrics.registry.summary()
+    if summary:
+        logger.info(f"Stage latencies (recent):\n{summary}")
+
+
+_builder = Application.builder().token(telegram_token).concurrent_updates(concurrent_updates)
+if bot_mode == "webhook":
+    # Updates arrive through webserver.py instead of the long-polling Updater.
+    _builder = _builder.updater(None)
+else:
+    # run_polling owns the event loop; these run on it right after startup/before exit.
+    _builder = _builder.post_init(_start_observability).post_stop(_stop_observability)
+application = _builder.build()
+
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Log the error and send a message to notify the user."""
@@ -32,15 +113,65 @@ def setup_handlers(app):
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("chat", chat_command))  # Add the new /chat command
+    app.add_handler(CommandHandler("usage", usage_command))  # Admin-only quota usage
 
     
 def main():
     """Main function to run the bot."""
     logger.info("Starting bot...")
     storage.init_db()
+    profiles.init()
+    if answer_cache.cache is not None:
+        answer_cache.cache.init([profile.fingerprint for profile in profiles.all_profiles()])
+    retrieval.init()
+    migrate_legacy_qa()
     setup_handlers(application)
     application.add_error_handler(error_handler)
-    application.run_polling()
+    register_metrics()
+    try:
+        if bot_mode == "webhook":
+            asyncio.run(_run_webhook())
+        else:
+            application.run_polling()
+    finally:
+        # Conversation history is written behind; make sure the last turns land on disk.
+        storage.close()
+        if answer_cache.cache is not None:
+            logger.info(f"Answer cache: {answer_cache.cache.stats()}")
+            answer_cache.cache.close()
+
+async def _run_webhook():
+    """Serves updates pushed by Telegram until SIGINT/SIGTERM, then shuts down
+    gracefully: stop reporting ready (so new updates go elsewhere and Telegram retries
+    anything we refuse), let in-flight replies finish for up to DRAIN_TIMEOUT_SECONDS,
+    then stop."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    server = WebhookServer(application, webhook_listen, webhook_port, webhook_path, webhook_secret_token)
+    async with application:
+        await application.bot.set_webhook(
+            url=webhook_url.rstrip("/") + webhook_path,
+            secret_token=webhook_secret_token,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await application.start()
+        await server.start()
+        await _start_observability()
+        server.ready = True
+        logger.info(f"Webhook mode: receiving updates at {webhook_url.rstrip('/')}{webhook_path}")
+
+        await stop.wait()
+        logger.info("Shutting down: draining in-flight replies...")
+        server.ready = False
+        await drain(drain_timeout_seconds)
+        await server.stop()
+        await _stop_observability()
+        # The webhook registration is left in place: other instances may still be
+        # serving it, and Telegram holds updates for us until one of them answers.
+        await application.stop()
 
 if __name__ == "__main__":
     main()
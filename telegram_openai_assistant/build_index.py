@@ -0,0 +1,26 @@
+# build_index.py
+# Command-line builder for the local retrieval index (see retrieval.py), from a local
+# copy of the files uploaded to the vector store.
+import argparse
+
+from .config import retrieval_index_path
+from .retrieval import PASSAGE_CHARS, build_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the local retrieval index from a directory of knowledge files.")
+    parser.add_argument("source", help="Directory holding the knowledge files (.txt, .md, .pdf)")
+    parser.add_argument("output", nargs="?", default=retrieval_index_path,
+                        help="Path to write the index to (default: RETRIEVAL_INDEX_PATH, %(default)s)")
+    parser.add_argument("--passage-chars", type=int, default=PASSAGE_CHARS,
+                        help="Approximate passage size in characters (default: %(default)s)")
+    args = parser.parse_args()
+
+    counts = build_index(args.source, args.output, args.passage_chars)
+    for name, count in counts.items():
+        print(f"{count:>6} passages  {name}")
+    print(f"Indexed {sum(counts.values())} passages from {len(counts)} files into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,153 @@
 # config.py
 from dotenv import load_dotenv
 import os
+import re
 
 # Load the environment variables from the .env file. override=True ensures .env takes
 # precedence over any same-named variable already present in the shell/system environment
 # (e.g. an unrelated global OPENAI_API_KEY set for another tool on this machine).
 load_dotenv(override=True)
 
+
+def _env_flag(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
 # Retrieve the variables from the environment.
 telegram_token = os.getenv("TELEGRAM_TOKEN")
 openai_api_key = os.getenv("OPENAI_API_KEY")
 vector_store_id = os.getenv("OPENAI_VECTOR_STORE_ID")
 sqlite_db_path = os.getenv("SQLITE_DB_PATH", "./bot_state.db")
 data_dir = os.getenv("DATA_DIR", ".")
+# Where conversation history and shared counters (the daily message limit) live:
+# "sqlite" (the SQLITE_DB_PATH file; one machine) or "redis" (any Redis-compatible
+# server at REDIS_URL, shared by any number of bot processes/machines). See storage.py.
+storage_backend = os.getenv("STORAGE_BACKEND", "sqlite").strip().lower()
+redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+redis_key_prefix = os.getenv("REDIS_KEY_PREFIX", "pnrbot:")
+# Set when several bot processes share one SQLite file: history is then written through
+# immediately and cached conversations are re-validated against the file, so every
+# process sees every other's latest turns (at some cost in speed).
+sqlite_multi_process = _env_flag("SQLITE_MULTI_PROCESS", False)
+# "polling" (long-poll Telegram from a single process) or "webhook" (Telegram pushes
+# updates to our own HTTP server, see webserver.py -- lower latency, and any number of
+# instances can sit behind a load balancer).
+bot_mode = os.getenv("BOT_MODE", "polling").strip().lower()
+# Public base URL Telegram should deliver updates to, e.g. https://bot.example.com
+webhook_url = os.getenv("WEBHOOK_URL")
+webhook_path = os.getenv("WEBHOOK_PATH", "/telegram")
+# Sent by Telegram with every update (X-Telegram-Bot-Api-Secret-Token) so the endpoint
+# can reject anything that didn't come from Telegram. Required in webhook mode.
+webhook_secret_token = os.getenv("WEBHOOK_SECRET_TOKEN")
+webhook_listen = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+webhook_port = int(os.getenv("PORT", "8080"))
+# Port for a /metrics + /healthz HTTP endpoint, 0 for none. See metrics.py. Metrics are
+# never served on the public webhook port, so in webhook mode this must differ from PORT.
+metrics_port = int(os.getenv("METRICS_PORT", "0"))
+# How often to log per-stage latency percentiles; 0 turns it off.
+metrics_log_interval_seconds = float(os.getenv("METRICS_LOG_INTERVAL_SECONDS", "300"))
+# On shutdown, how long to wait for replies that are already being generated to finish.
+drain_timeout_seconds = float(os.getenv("DRAIN_TIMEOUT_SECONDS", "60"))
+# How many updates python-telegram-bot may process at once. Ordering within a single
+# conversation is preserved regardless (see handlers._reply).
+concurrent_updates = int(os.getenv("CONCURRENT_UPDATES", "64"))
+# Inactivity after which a conversation is treated as a new topic. Shared by handlers.py
+# (to reset the thread) and storage.py (so stale threads don't linger in its memory cache).
+conversation_timeout_seconds = int(os.getenv("CONVERSATION_TIMEOUT_SECONDS", str(6 * 60 * 60)))
+# How conversation size is estimated for the context budget: "chars" (a fixed
+# characters-per-token ratio, no extra dependencies) or "tiktoken" (an offline tokenizer,
+# if the tiktoken package is installed). See tokens.py.
+token_estimator = os.getenv("TOKEN_ESTIMATOR", "chars")
+# The Q&A log is append-only JSON Lines; the live file is rotated out to a timestamped
+# archive once it passes this size or a new day starts, whichever comes first.
+qa_log_max_bytes = int(os.getenv("QA_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+# Show answers progressively as the model streams them (edited into place), instead of
+# only once the whole answer is ready.
+stream_replies = _env_flag("STREAM_REPLIES", False)
+# Messages that arrive for a conversation while its previous one is still being answered
+# are combined into a single follow-up request instead of being answered one by one.
+coalesce_pending_messages = _env_flag("COALESCE_PENDING_MESSAGES", False)
+# Admission control for model calls (see scheduler.py). A rate of 0 means unlimited;
+# the tokens-per-minute budget is charged with each response's actual total_tokens.
+openai_max_concurrency = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+openai_requests_per_minute = float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "0"))
+openai_tokens_per_minute = float(os.getenv("OPENAI_TOKENS_PER_MINUTE", "0"))
+queue_notice_after_seconds = float(os.getenv("QUEUE_NOTICE_AFTER_SECONDS", "5"))
+# Model-call resilience (see resilience.py). Each answer gets a deadline derived from
+# recent latencies (time to the first token, for streamed answers), kept between these
+# bounds; until there's enough history, it's the maximum.
+openai_timeout_min_seconds = float(os.getenv("OPENAI_TIMEOUT_MIN_SECONDS", "15"))
+openai_timeout_max_seconds = float(os.getenv("OPENAI_TIMEOUT_MAX_SECONDS", "60"))
+# Send a second, identical request when the first is slower than the recent p95 and use
+# whichever answers first. Costs the duplicate's tokens on roughly 1 call in 20.
+openai_hedge_requests = _env_flag("OPENAI_HEDGE_REQUESTS", False)
+# Circuit breaker: once at least this fraction of the recent model calls have failed,
+# stop calling for CIRCUIT_BREAKER_COOLDOWN_SECONDS and answer from the answer cache (or
+# with an apology) straight away, then let a single trial call through. 0 disables it.
+circuit_breaker_error_rate = float(os.getenv("CIRCUIT_BREAKER_ERROR_RATE", "0.5"))
+circuit_breaker_cooldown_seconds = float(os.getenv("CIRCUIT_BREAKER_COOLDOWN_SECONDS", "30"))
+# Outbound rate limits for messages sent and edited through the Bot API (see
+# sender.py), defaulting to Telegram's published limits: about 30 messages a second
+# overall, one a second per chat, and 20 a minute per group. 0 = unlimited.
+telegram_messages_per_second = float(os.getenv("TELEGRAM_MESSAGES_PER_SECOND", "30"))
+telegram_chat_messages_per_minute = float(os.getenv("TELEGRAM_CHAT_MESSAGES_PER_MINUTE", "60"))
+telegram_group_messages_per_minute = float(os.getenv("TELEGRAM_GROUP_MESSAGES_PER_MINUTE", "20"))
+# Continue conversations server-side with previous_response_id (sending only the new
+# turn) while they're under the context budget, instead of resending the whole history
+# every time. The local history is still kept and used whenever the chain can't be.
+response_chaining = _env_flag("RESPONSE_CHAINING", False)
+# First-turn answers can be cached (in the same SQLite file) and reused for repeat
+# questions, from anyone; see answer_cache.py. Off by default: a cached answer is given
+# to other users unchanged until its TTL runs out. The similarity threshold (0-1, cosine
+# over TF-IDF of the question) enables fuzzy matching on top of exact normalized-text
+# matching; 0 keeps it to exact matches only.
+answer_cache_enabled = _env_flag("ANSWER_CACHE_ENABLED", False)
+answer_cache_ttl_seconds = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+answer_cache_similarity_threshold = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0"))
+# Where the model's source passages come from (see retrieval.py): "hosted" (the
+# file_search tool over OPENAI_VECTOR_STORE_ID on every call), "local" (the best
+# passages from a local index of the same files, inlined into the request) or "hybrid"
+# (local for short questions the index covers well, file_search for everything else).
+retrieval_mode = os.getenv("RETRIEVAL_MODE", "hosted").strip().lower()
+retrieval_index_path = os.getenv("RETRIEVAL_INDEX_PATH", os.path.join(data_dir, "retrieval_index.json"))
+retrieval_top_k = int(os.getenv("RETRIEVAL_TOP_K", "6"))
+# Upper bound on inlined passage text per request (~4 characters per token).
+retrieval_max_chars = int(os.getenv("RETRIEVAL_MAX_CHARS", "8000"))
+# Hybrid mode: a question counts as simple if it has at most this many words and the
+# local passages contain at least this fraction of its terms.
+retrieval_simple_max_words = int(os.getenv("RETRIEVAL_SIMPLE_MAX_WORDS", "30"))
+retrieval_min_coverage = float(os.getenv("RETRIEVAL_MIN_COVERAGE", "0.8"))
+
+# Routing before the model (see router.py): greetings and thanks get a canned reply, and
+# first questions that are clearly outside the assistant's scope a canned refusal,
+# without a model call. ROUTER_MODEL optionally names a small, cheap model that
+# classifies the first questions the local rules can't decide; empty = rules only.
+router_enabled = _env_flag("ROUTER_ENABLED", True)
+router_model = os.getenv("ROUTER_MODEL", "").strip()
+router_timeout_seconds = float(os.getenv("ROUTER_TIMEOUT_SECONDS", "5"))
+# Optional JSON file of extra assistant profiles -- each its own model, instructions and
+# vector store -- and which chats use which (see profiles.py). Unset: every chat gets
+# the one assistant defined in assistant_config.py.
+profiles_path = os.getenv("PROFILES_PATH")
+
+# Sliding-window usage quotas (see quotas.py): how many messages may be answered, and
+# how many model tokens spent, per user, per group chat and overall within the last
+# QUOTA_WINDOW_SECONDS. 0 = unlimited.
+quota_window_seconds = int(os.getenv("QUOTA_WINDOW_SECONDS", str(24 * 60 * 60)))
+quota_user_messages = int(os.getenv("QUOTA_USER_MESSAGES", "0"))
+quota_user_tokens = int(os.getenv("QUOTA_USER_TOKENS", "0"))
+quota_chat_messages = int(os.getenv("QUOTA_CHAT_MESSAGES", "0"))
+quota_chat_tokens = int(os.getenv("QUOTA_CHAT_TOKENS", "0"))
+quota_global_messages = int(os.getenv("QUOTA_GLOBAL_MESSAGES", "100"))
+quota_global_tokens = int(os.getenv("QUOTA_GLOBAL_TOKENS", "0"))
+# Telegram user ids (comma- or space-separated) allowed to use admin commands like /usage.
+admin_user_ids = frozenset(int(i) for i in os.getenv("ADMIN_USER_IDS", "").replace(",", " ").split())
+
+# What Telegram accepts as a webhook secret token.
+_SECRET_TOKEN_RE = re.compile(r"[A-Za-z0-9_-]{1,256}")
 
 REQUIRED_VARS = {
     "TELEGRAM_TOKEN": telegram_token,
@@ -24,5 +159,19 @@ REQUIRED_VARS = {
 def validate_config():
     """Fail fast at startup if any required env var is missing."""
     missing = [name for name, value in REQUIRED_VARS.items() if not value]
+    if bot_mode == "webhook" and not webhook_url:
+        missing.append("WEBHOOK_URL")
+    if bot_mode == "webhook" and not webhook_secret_token:
+        missing.append("WEBHOOK_SECRET_TOKEN")
     if missing:
         raise RuntimeError(f"Missing required environment variable(s): {', '.join(missing)}")
+    if bot_mode not in ("polling", "webhook"):
+        raise RuntimeError(f"BOT_MODE must be 'polling' or 'webhook', not {bot_mode!r}")
+    if bot_mode == "webhook" and not _SECRET_TOKEN_RE.fullmatch(webhook_secret_token):
+        raise RuntimeError("WEBHOOK_SECRET_TOKEN must be 1-256 characters of A-Z, a-z, 0-9, _ and -")
+    if bot_mode == "webhook" and metrics_port == webhook_port:
+        raise RuntimeError("METRICS_PORT must differ from PORT; metrics aren't served on the webhook port")
+    if storage_backend not in ("sqlite", "redis"):
+        raise RuntimeError(f"STORAGE_BACKEND must be 'sqlite' or 'redis', not {storage_backend!r}")
+    if retrieval_mode not in ("hosted", "local", "hybrid"):
+        raise RuntimeError(f"RETRIEVAL_MODE must be 'hosted', 'local' or 'hybrid', not {retrieval_mode!r}")
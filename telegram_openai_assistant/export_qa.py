@@ -0,0 +1,22 @@
+# export_qa.py
+# Command-line exporter for the append-only Q&A log (see utils.py), producing the
+# single-array questions_answers.json format the log used to be stored in.
+import argparse
+
+from .utils import export_qa_json, migrate_legacy_qa
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the Q&A log as a legacy-format JSON array.")
+    parser.add_argument("output", nargs="?", default="questions_answers_export.json",
+                        help="Path to write the JSON array to (default: %(default)s)")
+    args = parser.parse_args()
+
+    # Make sure a not-yet-migrated legacy file is included rather than silently missed.
+    migrate_legacy_qa()
+    count = export_qa_json(args.output)
+    print(f"Exported {count} Q&A entries to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
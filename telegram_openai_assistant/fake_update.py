@@ -0,0 +1,52 @@
+# fake_update.py
+# Posts a synthetic Telegram update to a locally running webhook server (BOT_MODE=webhook,
+# see webserver.py), so webhook mode can be exercised without exposing the bot to the
+# internet or registering a real webhook. Replies are still sent through the real Bot
+# API, so use a chat_id the bot can actually message (e.g. your own user id).
+import argparse
+import random
+import sys
+import time
+
+import httpx
+
+
+def build_update(text: str, chat_id: int, user_id: int, group: bool = False, update_id: int | None = None) -> dict:
+    chat = (
+        {"id": chat_id, "type": "supergroup", "title": "Test group"}
+        if group
+        else {"id": chat_id, "type": "private", "first_name": "Test"}
+    )
+    message = {
+        "message_id": random.randint(1, 2**31 - 1),
+        "date": int(time.time()),
+        "chat": chat,
+        "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return {"update_id": update_id if update_id is not None else random.randint(1, 2**31 - 1), "message": message}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a fake Telegram update to a local webhook server.")
+    parser.add_argument("text", help="Message text (commands like /start work too)")
+    parser.add_argument("--chat-id", type=int, required=True, help="Chat to reply in")
+    parser.add_argument("--user-id", type=int, help="Sender (default: same as --chat-id)")
+    parser.add_argument("--group", action="store_true", help="Send as a group message instead of a private one")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/telegram",
+                        help="Webhook endpoint (default: %(default)s)")
+    parser.add_argument("--secret-token", help="Value for the X-Telegram-Bot-Api-Secret-Token header")
+    args = parser.parse_args()
+
+    update = build_update(args.text, args.chat_id, args.user_id or args.chat_id, args.group)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret_token} if args.secret_token else {}
+    response = httpx.post(args.url, json=update, headers=headers, timeout=10)
+    print(f"{response.status_code} {response.reason_phrase}")
+    sys.exit(0 if response.is_success else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,48 @@
 import asyncio
 import datetime
 import logging
+import re
+import time
+from contextlib import asynccontextmanager
 
-from telegram.constants import ChatAction, ParseMode
-from telegram.error import BadRequest
+from telegram.constants import ChatAction
+from telegram.error import TelegramError
 from telegram.ext import CallbackContext
 from telegram import Update
 
-from . import openai_client, storage
-from .telegram_markdown import to_telegram_html
-from .utils import get_message_count, update_message_count, save_qa
+from . import openai_client, profiles
+from .analytics import analytics, qa_event
+from .metrics import STAGE_SECONDS, stage_timer, timed
+from .scheduler import admission
+from .sender import sender
+from .quotas import GLOBAL_SUBJECT, SCOPES, Denial, format_duration, quotas
+from .router import router
+from .config import (
+    admin_user_ids,
+    coalesce_pending_messages,
+    conversation_timeout_seconds,
+    response_chaining,
+    stream_replies,
+)
+from .tokens import estimate_tokens, turn_tokens
+from .storage import backend as storage
+from .telegram_markdown import render_chunks
 
 TELEGRAM_MAX_MESSAGE_LENGTH = 4096
-# Conservative: we split the raw markdown at this length, then convert each piece to
-# HTML, which grows it somewhat (**x** -> <b>x</b>). Leaves headroom under the real
-# 4096-char Telegram limit for that markup overhead.
+# Longest message we send: render_chunks keeps both a message's Markdown (sent as plain
+# text if Telegram rejects the HTML) and its HTML within this, with headroom under the
+# real 4096-char Telegram limit.
 MARKDOWN_SPLIT_LIMIT = 3000
 # Telegram's "typing…" indicator auto-expires after ~5s (or on the next sent message),
 # so it has to be re-sent periodically to stay visible for the duration of a slower call.
 TYPING_REFRESH_SECONDS = 4
+# When streaming (see _StreamingReply), the message being written is edited at most this
+# often: Telegram rate-limits edits, and a new edit every few tokens would trip that
+# almost immediately while barely looking any smoother.
+STREAM_EDIT_INTERVAL_SECONDS = 1.5
+# Streamed text is only shown up to the end of its last complete sentence/line, so the
+# message doesn't flicker through half-words and half-open markdown.
+_SENTENCE_END_RE = re.compile(r"[.!?:;](?=\s)|\n")
 
 # We resend the *entire* conversation history as input on every turn (that's how
 # continuity works here -- see storage.py), so a thread gets more expensive and slower
@@ -28,57 +52,160 @@ TYPING_REFRESH_SECONDS = 4
 # turns FIFO to stay under budget, so a long-running conversation keeps recent context
 # instead of losing everything at once.
 MAX_CONVERSATION_TURNS = 40
-CONVERSATION_TIMEOUT_SECONDS = 6 * 60 * 60  # 6h of inactivity is treated as a new topic
+CONVERSATION_TIMEOUT_SECONDS = conversation_timeout_seconds  # 6h of inactivity by default
 MAX_CONTEXT_TOKENS = 400_000
-# No tokenizer dependency: file_search's retrieved-document tokens are invisible to us
-# until after the call anyway and dominate the real total, so a precise local count of
-# just the conversational text wouldn't meaningfully improve this estimate.
-CHARS_PER_TOKEN_ESTIMATE = 4
-
+# Trimming evicts in one block down to this fraction of the budget, rather than one pair
+# per turn. OpenAI caches prompts by prefix (instructions, then the summary, then the
+# oldest turns), so every eviction makes the next request's input a cache miss from the
+# first turn on; trimming coarsely leaves the front of the input unchanged -- and
+# cached -- for the many turns it takes to fill the budget again.
+TRIM_TARGET_FRACTION = 0.75
+# Rolling summarization (see _compact): once a conversation passes this fraction of
+# MAX_CONTEXT_TOKENS or of MAX_CONVERSATION_TURNS, its oldest turns are condensed into a
+# summary in the background, so long case discussions keep their details without
+# paying for (or eventually being trimmed/reset out of) the full transcript. Compaction
+# folds turns until about COMPACT_KEEP_FRACTION of the history is left. 0 disables it,
+# leaving only FIFO trimming.
+SUMMARIZE_AT_FRACTION = 0.5
+COMPACT_KEEP_FRACTION = 0.5
+# Summarization calls share the admission queue (see scheduler.py) as if they were one
+# more chat, so they get a fair turn without ever crowding out users.
+COMPACTION_QUEUE = "compaction"
+# With several bot processes, another one may save a conversation while this one is
+# answering in it (see storage.save_history); the turn is then re-applied on top of what
+# was saved, up to this many times.
+SAVE_ATTEMPTS = 3
+
+# Joins messages coalesced into one follow-up request (see _reply).
+COALESCED_MESSAGE_SEPARATOR = "\n\n"
+
+QUEUE_NOTICE = "\u23F3 I'm handling a lot of questions right now -- you're #{position} in line, I'll answer as soon as I can."
+SUMMARY_PREFIX = "Summary of the earlier part of this conversation (older messages were condensed to save space):\n\n"
+# Sent when a message is over quota (see quotas.py), keyed on the scope whose limit it hit.
+QUOTA_NOTICES = {
+    "user": "You've reached your limit of questions for now. Please try again in about {wait}.",
+    "chat": "This chat has reached its limit of questions for now. Please try again in about {wait}.",
+    "profile": "This assistant has reached its limit of questions for now. Please try again in about {wait}.",
+    "global": "Sorry, I've reached my message limit for now. Please try again in about {wait}.",
+}
 RESET_NOTICE = "\U0001F504 This conversation has grown long, so I'm starting a fresh one from here."
 
 
-def _split_message(text: str, limit: int = TELEGRAM_MAX_MESSAGE_LENGTH) -> list[str]:
-    """Splits text into chunks that fit within Telegram's per-message character limit,
-    preferring to break on a paragraph/line/word boundary over mid-word."""
-    if len(text) <= limit:
-        return [text]
-
-    chunks = []
-    remaining = text
-    while len(remaining) > limit:
-        split_at = remaining.rfind("\n\n", 0, limit)
-        if split_at == -1:
-            split_at = remaining.rfind("\n", 0, limit)
-        if split_at == -1:
-            split_at = remaining.rfind(" ", 0, limit)
-        if split_at <= 0:
-            split_at = limit
-        chunks.append(remaining[:split_at].rstrip())
-        remaining = remaining[split_at:].lstrip()
-    if remaining:
-        chunks.append(remaining)
-    return chunks
-
-
+@timed("send_long_message")
 async def _send_long_message(context: CallbackContext, chat_id, text: str) -> None:
     """Sends text as one or more messages (splitting if it exceeds Telegram's 4096-char
     limit), rendering the model's Markdown as Telegram HTML so bold/italic/links/lists
     actually show up formatted. Falls back to plain text if HTML parsing ever fails,
-    e.g. from an edge case the converter didn't anticipate, so a reply is never lost."""
-    for chunk in _split_message(text, limit=MARKDOWN_SPLIT_LIMIT):
-        html_chunk = to_telegram_html(chunk)
-        try:
-            await context.bot.send_message(chat_id=chat_id, text=html_chunk, parse_mode=ParseMode.HTML)
-        except BadRequest as e:
-            logging.error(f"Telegram rejected HTML message, falling back to plain text: {e}")
-            await context.bot.send_message(chat_id=chat_id, text=chunk)
+    e.g. from an edge case the converter didn't anticipate, so a reply is never lost.
+    Every chunk is rendered before the first is sent, and they go out back to back
+    within the chat's send rate (see sender.py)."""
+    await sender.send_chunks(context.bot, chat_id, render_chunks(text, MARKDOWN_SPLIT_LIMIT))
+
+
+class _StreamingReply:
+    """Shows an answer progressively while it streams in. The first message goes out as
+    soon as a complete sentence is available; it's then edited in place at most every
+    STREAM_EDIT_INTERVAL_SECONDS, rolling over to a new message whenever the text passes
+    MARKDOWN_SPLIT_LIMIT -- the same chunking _send_long_message uses, so finish() can
+    settle every message on its final HTML render with at most one edit each. Each
+    update only re-renders from the last message on: the ones before it are full, and
+    render_chunks packs blocks from the start, so they'd come out the same anyway."""
+
+    def __init__(self, context: CallbackContext, chat_id):
+        self._bot = context.bot
+        self._chat_id = chat_id
+        self._raw = ""
+        self._changed = asyncio.Event()
+        self._finished = asyncio.Event()
+        self._messages: list[list] = []  # [message_id, markdown chunk currently shown, its HTML]
+        self._started = time.perf_counter()
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def on_text(self, raw: str) -> None:
+        """Callback for openai_client.stream_answer; just records the latest text."""
+        self._raw = raw
+        self._changed.set()
+
+    def _displayable(self) -> str:
+        text = openai_client.clean_partial(self._raw)
+        last = None
+        for last in _SENTENCE_END_RE.finditer(text):
+            pass
+        return text[: last.end()].rstrip() if last is not None else ""
+
+    def _render_progress(self, text: str) -> list[tuple[str, str]]:
+        """render_chunks(text), reusing the messages before the last one as they are.
+        Falls back to rendering everything if the text no longer starts with them."""
+        settled = self._messages[:-1]
+        position = 0
+        for _, chunk, _ in settled:
+            found = text.find(chunk, position)
+            if found == -1 or text[position:found].strip():
+                return render_chunks(text, MARKDOWN_SPLIT_LIMIT)
+            position = found + len(chunk)
+        tail = render_chunks(text[position:].lstrip(), MARKDOWN_SPLIT_LIMIT) if text[position:].strip() else []
+        return [(chunk, html_chunk) for _, chunk, html_chunk in settled] + tail
+
+    async def _run(self) -> None:
+        while not self._finished.is_set():
+            await self._changed.wait()
+            self._changed.clear()
+            if self._finished.is_set():
+                return
+            text = self._displayable()
+            if text:
+                try:
+                    await self._show(self._render_progress(text))
+                except TelegramError as e:
+                    # A failed intermediate update isn't fatal: finish() still delivers the
+                    # complete answer.
+                    logging.error(f"Failed to update streamed reply: {e}")
+            try:
+                await asyncio.wait_for(self._finished.wait(), timeout=STREAM_EDIT_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _show(self, chunks: list[tuple[str, str]]) -> None:
+        for i, (chunk, html_chunk) in enumerate(chunks):
+            if i >= len(self._messages):
+                await self._send(chunk, html_chunk)
+            elif self._messages[i][1] != chunk:
+                await self._edit(i, chunk, html_chunk)
+        # Only possible on finish(), e.g. when the final text is an apology that's
+        # shorter than what had already streamed in.
+        for message_id, _, _ in self._messages[len(chunks):]:
+            await sender.call(self._chat_id, self._bot.delete_message, message_id=message_id)
+        del self._messages[len(chunks):]
+
+    async def _send(self, chunk: str, html_chunk: str) -> None:
+        message = await sender.send_html(self._bot, self._chat_id, chunk, html_chunk)
+        if not self._messages:
+            logging.info(f"First streamed chunk shown after {time.perf_counter() - self._started:.2f}s")
+        self._messages.append([message.message_id, chunk, html_chunk])
+
+    async def _edit(self, index: int, chunk: str, html_chunk: str) -> None:
+        await sender.edit_html(self._bot, self._chat_id, self._messages[index][0], chunk, html_chunk)
+        self._messages[index][1:] = [chunk, html_chunk]
+
+    async def finish(self, final_text: str | None) -> None:
+        """Stops streaming updates and, given the final answer, makes the messages show
+        exactly that. With None (the request raised), whatever was shown is left as is."""
+        self._finished.set()
+        self._changed.set()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+        if final_text is not None:
+            await self._show(self._render_progress(final_text))
 
 
 async def help_command(update: Update, context: CallbackContext) -> None:
     """Sends a help message to the user."""
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
+    await sender.call(
+        update.effective_chat.id,
+        context.bot.send_message,
         text="Just send me a question and I'll try to answer it.",
     )
 
@@ -90,24 +217,85 @@ def _conversation_key(chat_id, user_id) -> str:
     return f"{chat_id}:{user_id}"
 
 
-def _estimate_tokens(text: str) -> int:
-    return max(1, len(text) // CHARS_PER_TOKEN_ESTIMATE)
+def _new_turn(role: str, content: str) -> dict:
+    return {"role": role, "content": content, "est_tokens": estimate_tokens(content)}
+
+
+def _trim_to_token_budget(
+    history: list[dict], budget: int = MAX_CONTEXT_TOKENS, total: int | None = None
+) -> tuple[list[dict], int]:
+    """Evicts the oldest turns (FIFO) once the estimated size of the history exceeds the
+    budget, instead of wiping the whole conversation. Evicts down to
+    TRIM_TARGET_FRACTION of the budget in one go, so it doesn't have to again on the
+    next few turns. Prefers dropping a whole user/assistant pair at a time to keep turns
+    aligned.
+
+    Works off each turn's cached estimate and a running total, so it's a single pass
+    however many turns are evicted. Pass `total` when the caller already knows it (e.g.
+    the total returned by the previous trim plus one appended turn) to skip even the
+    initial sum. Returns (history, total) with total updated for what's left."""
+    if total is None:
+        total = sum(turn_tokens(m) for m in history)
+
+    if total <= budget:
+        return history, total
+    target = budget * TRIM_TARGET_FRACTION
+    start = 0
+    while total > target and len(history) - start > 2:
+        total -= turn_tokens(history[start]) + turn_tokens(history[start + 1])
+        start += 2
+    # Fallback for a single turn so large it alone is near/over budget: still keep the
+    # newest entry so the conversation isn't left completely empty.
+    while total > budget and len(history) - start > 1:
+        total -= turn_tokens(history[start])
+        start += 1
+    if start:
+        del history[:start]
+    return history, total
+
 
+def _summary_turn(summary: dict) -> dict:
+    return {"role": "developer", "content": SUMMARY_PREFIX + summary["content"]}
 
-def _trim_to_token_budget(history: list[dict], budget: int = MAX_CONTEXT_TOKENS) -> list[dict]:
-    """Evicts the oldest turns (FIFO) until the estimated size of the remaining history
-    fits the budget, instead of wiping the whole conversation once it's exceeded.
-    Prefers dropping a whole user/assistant pair at a time to keep turns aligned."""
-    def total_tokens() -> int:
-        return sum(_estimate_tokens(m["content"]) for m in history)
 
-    while total_tokens() > budget and len(history) > 2:
-        del history[0:2]
-    # Fallback for a single turn so large it alone is near/over budget: still keep the
-    # newest entry so the conversation isn't left completely empty.
-    while total_tokens() > budget and len(history) > 1:
-        history.pop(0)
-    return history
+def _needs_compaction(history: list[dict], total_tokens: int) -> bool:
+    if SUMMARIZE_AT_FRACTION <= 0 or len(history) <= 2:
+        return False
+    return (
+        total_tokens >= SUMMARIZE_AT_FRACTION * MAX_CONTEXT_TOKENS
+        or len(history) // 2 >= SUMMARIZE_AT_FRACTION * MAX_CONVERSATION_TURNS
+    )
+
+
+def _turns_to_fold(history: list[dict]) -> list[dict]:
+    """The oldest turns to condense: whole user/assistant pairs from the front until
+    about COMPACT_KEEP_FRACTION of the tokens and turns are left, always keeping at
+    least the latest exchange verbatim."""
+    total = sum(turn_tokens(m) for m in history)
+    keep_tokens = total * COMPACT_KEEP_FRACTION
+    keep_turns = max(2, int(len(history) * COMPACT_KEEP_FRACTION))
+    cut = 0
+    while len(history) - cut > 2 and (total > keep_tokens or len(history) - cut > keep_turns):
+        total -= turn_tokens(history[cut]) + turn_tokens(history[cut + 1])
+        cut += 2
+    return history[:cut]
+
+
+def _chain_to_continue(state: dict | None, history: list[dict]) -> str | None:
+    """With RESPONSE_CHAINING on, the previous_response_id to continue this turn from, or
+    None to send the full history. A chain is only safe to continue while the server-side
+    thread is exactly our local history minus the new turn: so not after a reset, not
+    once FIFO trimming has dropped any turn the thread started with, and not once the
+    thread itself (which also holds past file_search results we never see) has grown
+    past the context budget."""
+    if not response_chaining or state is None or state.get("chain") is None:
+        return None
+    chain = state["chain"]
+    if chain["tokens"] is None or chain["tokens"] >= MAX_CONTEXT_TOKENS:
+        return None
+    if not history or history[0].get("seq") != chain["start_seq"]:
+        return None
+    return chain["response_id"]
 
 
 def _resolve_history(state: dict | None) -> tuple[list[dict], str | None]:
@@ -129,35 +317,139 @@ def _resolve_history(state: dict | None) -> tuple[list[dict], str | None]:
     return state["history"], None
 
 
-async def get_reply(context: CallbackContext, chat_id, user_id, message_text):
+async def _save_history(key: str, history: list[dict], **kwargs) -> bool:
+    """storage.save_history, run off the event loop unless the backend only queues the
+    write in memory (the default write-behind SQLite setup, see storage.py)."""
+    if storage.writes_behind:
+        return storage.save_history(key, history, **kwargs)
+    return await asyncio.to_thread(storage.save_history, key, history, **kwargs)
+
+
+async def _save_turn(
+    key: str, state: dict | None, history: list[dict], context_tokens: int, chain: dict | None, summary: dict | None
+) -> tuple[list[dict], int, dict | None]:
+    """Saves the conversation after a turn, `state` being what it was built from. If
+    another process has saved the conversation since, this turn's new turns are added
+    after what it saved and the save is retried. Returns the history, its size and the
+    summary as saved."""
+    expected = state["updated_at"] if state is not None else None
+    for _ in range(SAVE_ATTEMPTS):
+        if await _save_history(key, history, chain=chain, summary=summary, expected_updated_at=expected):
+            return history, context_tokens, summary
+        logging.info(f"Conversation {key} was saved elsewhere meanwhile; re-applying this turn")
+        current = await asyncio.to_thread(storage.get_conversation_state, key)
+        new_turns = [m for m in history if "seq" not in m]
+        expected = current["updated_at"] if current is not None else None
+        summary = current.get("summary") if current is not None else None
+        budget = MAX_CONTEXT_TOKENS - (summary["est_tokens"] if summary else 0)
+        history, context_tokens = _trim_to_token_budget((current["history"] if current else []) + new_turns, budget)
+        # The response chain doesn't include the other process's turns.
+        chain = None
+    logging.error(f"Conversation {key} kept changing; this turn was not saved")
+    return history, context_tokens, summary
+
+
+class _OverQuota(Exception):
+    def __init__(self, denial):
+        self.denial = denial
+
+
+async def get_reply(
+    context: CallbackContext, chat_id, user_id, message_text, on_text=None
+) -> openai_client.ResponseResult:
     """Get a reply from the model, continuing the caller's existing conversation history
     when it's still valid, and persisting the updated history so continuity survives
     restarts. History is trimmed FIFO to a token budget rather than sending an
-    ever-growing conversation to the model."""
+    ever-growing conversation to the model. If on_text is given, the response is
+    streamed and on_text receives the text so far as it arrives (see
+    openai_client.stream_answer). The chat's assistant profile (see profiles.py) answers.
+    Returns the model's result; its text is the answer. Messages router.py answers
+    without the model (greetings, thanks, out-of-scope questions) get its canned reply
+    and leave the conversation as it was. Any other message is charged to its quotas
+    first (see quotas.py), raising _OverQuota if it's over one."""
     key = _conversation_key(chat_id, user_id)
-    state = await asyncio.to_thread(storage.get_conversation_state, key)
+    profile = profiles.for_chat(chat_id)
+    with stage_timer("get_conversation_state"):
+        state = await asyncio.to_thread(storage.get_conversation_state, key)
     history, reset_reason = _resolve_history(state)
+    summary = state.get("summary") if state is not None and reset_reason is None else None
+
+    # Before any reset is announced: a routed message leaves the state untouched, so the
+    # next real question still gets the notice.
+    routed = await router.route(message_text, profile, first_turn=not history and summary is None, chat_id=chat_id)
+    if routed is not None:
+        return routed
+
+    # Only messages that need the model count towards quotas.
+    charge = await quotas.acquire(chat_id, user_id, profile.name)
+    if isinstance(charge, Denial):
+        raise _OverQuota(charge)
+    try:
+        if reset_reason is not None:
+            logging.info(f"Resetting conversation {key}: {reset_reason}")
+            await sender.call(chat_id, context.bot.send_message, text=RESET_NOTICE)
+
+        # The summary (if any) takes its share of the budget off the top.
+        budget = MAX_CONTEXT_TOKENS - (summary["est_tokens"] if summary else 0)
+
+        history.append(_new_turn("user", message_text))
+        history, context_tokens = _trim_to_token_budget(history, budget)
+        chain_id = _chain_to_continue(state, history) if reset_reason is None else None
+        first_sent_seq = history[0].get("seq")
+        model_input = ([_summary_turn(summary)] if summary else []) + history
+
+        async def _notify_queued(position: int) -> None:
+            try:
+                await sender.call(chat_id, context.bot.send_message, text=QUEUE_NOTICE.format(position=position))
+            except TelegramError as e:
+                logging.error(f"Failed to send queue notice: {e}")
+
+        # Admission is per chat, so a busy group shares one fair turn per round with
+        # everyone else rather than getting one per member (see scheduler.py).
+        async with admission.slot(chat_id, context_tokens, on_queued=_notify_queued) as slot:
+            STAGE_SECONDS.observe(slot.waited_seconds, stage="admission_wait")
+            if on_text is not None:
+                result = await openai_client.stream_answer(
+                    model_input, on_text, previous_response_id=chain_id, profile=profile
+                )
+            else:
+                result = await openai_client.get_answer(model_input, previous_response_id=chain_id, profile=profile)
+            slot.record_tokens(result.total_tokens)
+        # A cached answer cost nothing.
+        await quotas.record_tokens(chat_id, user_id, None if result.cached else result.total_tokens, profile.name)
+
+        if result.response_id is not None:
+            assistant_turn = _new_turn("assistant", result.text)
+            history.append(assistant_turn)
+            kept_before = len(history)
+            history, context_tokens = _trim_to_token_budget(
+                history, budget, total=context_tokens + assistant_turn["est_tokens"]
+            )
+            chain = None
+            # A cached answer's response_id belongs to someone else's conversation, and a
+            # trim just now means the thread holds turns we no longer do; either way the next
+            # turn has to start a fresh chain from the full history.
+            if response_chaining and not result.cached and len(history) == kept_before:
+                chain = {
+                    "response_id": result.response_id,
+                    "tokens": result.total_tokens,
+                    "start_seq": state["chain"]["start_seq"] if result.chained else first_sent_seq,
+                }
+            history, context_tokens, summary = await _save_turn(key, state, history, context_tokens, chain, summary)
+            if _needs_compaction(history, context_tokens + (summary["est_tokens"] if summary else 0)):
+                _schedule_compaction(key, profile)
+        else:
+            logging.error(f"No response returned for conversation {key}; state not updated")
 
-    if reset_reason is not None:
-        logging.info(f"Resetting conversation {key}: {reset_reason}")
-        await context.bot.send_message(chat_id=chat_id, text=RESET_NOTICE)
-
-    history.append({"role": "user", "content": message_text})
-    history = _trim_to_token_budget(history)
-
-    result = await openai_client.get_answer(history)
-
-    if result.response_id is not None:
-        history.append({"role": "assistant", "content": result.text})
-        history = _trim_to_token_budget(history)
-        await asyncio.to_thread(storage.save_history, key, history)
-    else:
-        logging.error(f"No response returned for conversation {key}; state not updated")
-
-    return result.text
+        return result
+    except BaseException:
+        await quotas.release(charge)
+        raise
 
 
-async def _get_reply_with_typing(context: CallbackContext, chat_id, user_id, message_text: str) -> str:
+async def _get_reply_with_typing(
+    context: CallbackContext, chat_id, user_id, message_text: str, on_text=None
+) -> openai_client.ResponseResult:
     """Same as get_reply, but shows Telegram's "typing…" indicator for as long as the
     request is in flight, re-sending it every few seconds since it expires on its own."""
     async def _keep_typing():
@@ -170,17 +462,215 @@ async def _get_reply_with_typing(context: CallbackContext, chat_id, user_id, mes
 
     typing_task = asyncio.create_task(_keep_typing())
     try:
-        return await get_reply(context, chat_id, user_id, message_text)
+        return await get_reply(context, chat_id, user_id, message_text, on_text)
     finally:
         typing_task.cancel()
         await asyncio.gather(typing_task, return_exceptions=True)
 
 
+@timed("reply")
+async def _deliver_reply(context: CallbackContext, chat_id, user_id, message_text: str) -> openai_client.ResponseResult:
+    """Gets the reply to message_text and delivers it to the chat -- streamed in
+    progressively when STREAM_REPLIES is on, otherwise sent once complete. Returns the
+    model's result."""
+    if not stream_replies:
+        result = await _get_reply_with_typing(context, chat_id, user_id, message_text)
+        await _send_long_message(context, chat_id, result.text)
+        return result
+
+    streamer = _StreamingReply(context, chat_id)
+    streamer.start()
+    result = None
+    try:
+        result = await _get_reply_with_typing(context, chat_id, user_id, message_text, on_text=streamer.on_text)
+    finally:
+        await streamer.finish(result.text if result is not None else None)
+    return result
+
+
+class _ConversationQueue:
+    """Per-conversation serialization state: a FIFO lock so only one turn of a
+    conversation is in flight at a time, plus (when coalescing) the messages waiting
+    for it."""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending: list[str] = []
+        self.users = 0  # handlers currently holding or waiting on this queue
+
+
+_conversation_queues: dict[str, _ConversationQueue] = {}
+# Replies currently being worked on (queued or generating), so shutdown can wait for
+# them -- see drain().
+_in_flight = 0
+
+
+@asynccontextmanager
+async def _conversation_queue(key: str):
+    """The conversation's _ConversationQueue, kept registered for as long as anyone is
+    using it."""
+    queue = _conversation_queues.get(key)
+    if queue is None:
+        queue = _conversation_queues[key] = _ConversationQueue()
+    queue.users += 1
+    try:
+        yield queue
+    finally:
+        queue.users -= 1
+        if queue.users == 0:
+            del _conversation_queues[key]
+
+
+async def _reply(
+    context: CallbackContext, chat_id, user_id, message_text: str
+) -> tuple[str, openai_client.ResponseResult] | None:
+    """Answers message_text in order with the rest of its conversation. Without this, two
+    quick messages from the same person would both read the same stored history, both
+    pay for a full-context model call, and whichever saved last would silently drop the
+    other's turn. Different conversations never wait on each other.
+
+    With COALESCE_PENDING_MESSAGES, every message that arrives while a turn is in flight
+    is answered by a single follow-up request once that turn is done, asking them all
+    together. Returns (question, result) -- question being the combined text when
+    messages were coalesced -- or None if this message was already answered as part of
+    an earlier caller's follow-up."""
+    global _in_flight
+    key = _conversation_key(chat_id, user_id)
+    _in_flight += 1
+    try:
+        return await _reply_in_order(context, key, chat_id, user_id, message_text)
+    finally:
+        _in_flight -= 1
+
+
+async def _reply_in_order(context: CallbackContext, key: str, chat_id, user_id, message_text: str):
+    async with _conversation_queue(key) as queue:
+        if coalesce_pending_messages:
+            queue.pending.append(message_text)
+        async with queue.lock:
+            if coalesce_pending_messages:
+                if not queue.pending:
+                    return None
+                if len(queue.pending) > 1:
+                    logging.info(f"Coalescing {len(queue.pending)} messages for conversation {key}")
+                message_text = COALESCED_MESSAGE_SEPARATOR.join(queue.pending)
+                queue.pending.clear()
+            result = await _deliver_reply(context, chat_id, user_id, message_text)
+            return message_text, result
+
+
+def stats() -> dict:
+    """Replies in progress, conversations with a turn in flight or queued, and
+    compactions running."""
+    return {
+        "in_flight": _in_flight,
+        "active_conversations": len(_conversation_queues),
+        "compactions": len(_background_tasks),
+    }
+
+
+async def drain(timeout: float) -> bool:
+    """Waits up to timeout seconds for in-flight replies (and the compactions they
+    scheduled) to finish. Returns False if some were still running when it gave up."""
+    deadline = time.monotonic() + timeout
+    while _in_flight or _background_tasks:
+        if time.monotonic() >= deadline:
+            logging.warning(
+                f"Shutdown: gave up waiting on {_in_flight} replies and {len(_background_tasks)} compactions"
+            )
+            return False
+        await asyncio.sleep(0.1)
+    return True
+
+
+async def _answer(update: Update, context: CallbackContext, message_text: str) -> None:
+    """Answers the update's message_text (see _reply) -- or, if it's over the sender's,
+    the chat's or the bot's quota, tells them when they can ask again -- and records the
+    answer in the Q&A log. Quotas are charged by get_reply, once a message turns out to
+    need the model: canned replies (router.py) are sent whatever the quotas, and
+    messages answered together with others (COALESCE_PENDING_MESSAGES) count once."""
+    chat, user = update.effective_chat, update.effective_user
+    profile = profiles.for_chat(chat.id)
+    started = time.perf_counter()
+    try:
+        reply = await _reply(context, chat.id, user.id, message_text)
+    except _OverQuota as e:
+        notice = QUOTA_NOTICES[e.denial.scope].format(wait=format_duration(e.denial.retry_after))
+        await sender.call(chat.id, context.bot.send_message, text=notice)
+        return
+    if reply is not None:
+        question, result = reply
+        analytics.record(qa_event(user, chat, question, result, time.perf_counter() - started, profile.name))
+
+
+# Conversations with a compaction in progress, and the tasks running them (held so they
+# aren't garbage-collected mid-flight).
+_compacting: set[str] = set()
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _schedule_compaction(key: str, profile: profiles.Profile) -> None:
+    if key in _compacting:
+        return
+    _compacting.add(key)
+    task = asyncio.create_task(_compact(key, profile))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _compact(key: str, profile: profiles.Profile) -> None:
+    """Condenses the conversation's oldest turns into its rolling summary, off the
+    request path. The turns to fold are picked under the conversation's lock, but the
+    summarization call runs without it, so the user can keep chatting meanwhile; the
+    result is then applied under the lock again, and only if the folded turns are still
+    at the front of the history (a reset or trim in the meantime makes it moot, and it's
+    simply dropped)."""
+    try:
+        async with _conversation_queue(key) as queue, queue.lock:
+            state = await asyncio.to_thread(storage.get_conversation_state, key)
+        if state is None:
+            return
+        fold = _turns_to_fold(state["history"])
+        if not fold:
+            return
+        summary = state.get("summary")
+
+        async with admission.slot(COMPACTION_QUEUE, sum(turn_tokens(m) for m in fold)) as slot:
+            result = await openai_client.summarize(fold, summary["content"] if summary else None, profile)
+            slot.record_tokens(result.total_tokens)
+        if result.response_id is None or not result.text:
+            logging.error(f"Summarizing conversation {key} failed; will retry after a later turn")
+            return
+        new_summary = {"content": result.text, "est_tokens": estimate_tokens(result.text)}
+
+        async with _conversation_queue(key) as queue, queue.lock:
+            current = await asyncio.to_thread(storage.get_conversation_state, key)
+            history = current["history"] if current is not None else []
+            by_seq = {m["seq"]: m for m in history}
+            still_there = all(
+                m["seq"] in by_seq and by_seq[m["seq"]]["content"] == m["content"] for m in (fold[0], fold[-1])
+            )
+            remaining = [m for m in history if m["seq"] > fold[-1]["seq"]]
+            if not still_there or current.get("summary") != summary or not remaining:
+                logging.info(f"Conversation {key} changed during compaction; discarding summary")
+                return
+            if not await _save_history(key, remaining, summary=new_summary, expected_updated_at=current["updated_at"]):
+                logging.info(f"Conversation {key} was saved elsewhere during compaction; discarding summary")
+                return
+        logging.info(
+            f"Compacted {len(fold)} turns of conversation {key} "
+            f"(~{sum(turn_tokens(m) for m in fold)} tokens) into a ~{new_summary['est_tokens']}-token summary"
+        )
+    except Exception:
+        logging.exception(f"Compacting conversation {key} failed")
+    finally:
+        _compacting.discard(key)
+
+
 async def handle_mention(update: Update, context: CallbackContext):
     """Handles the logic for when the bot is mentioned or called via /chat."""
     message_text = update.message.text
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
     logging.info(f"Received message: {message_text}")
 
     if "/chat" in message_text:
@@ -188,10 +678,9 @@ async def handle_mention(update: Update, context: CallbackContext):
         user_message = message_text.replace("/chat", "").strip()
 
         if user_message:
-            response = await _get_reply_with_typing(context, chat_id, user_id, user_message)
-            await _send_long_message(context, chat_id, response)
+            await _answer(update, context, user_message)
         else:
-            await context.bot.send_message(chat_id=chat_id, text="Hello! How can I assist you?")
+            await sender.call(chat_id, context.bot.send_message, text="Hello! How can I assist you?")
     else:
         logging.info(f"Ignored message: {message_text}")
 
@@ -201,9 +690,10 @@ async def chat_command(update: Update, context: CallbackContext) -> None:
     if update.message.text.strip():
         await handle_mention(update, context)
     else:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Please provide a message after the /chat command."
+        await sender.call(
+            update.effective_chat.id,
+            context.bot.send_message,
+            text="Please provide a message after the /chat command.",
         )
 
 
@@ -214,40 +704,40 @@ async def process_group_message(update: Update, context: CallbackContext):
 
 async def start(update: Update, context: CallbackContext):
     """Handles /start command in both private and group chats."""
-    await context.bot.send_message(chat_id=update.effective_chat.id, text="Hello! I'm here to help. Mention me in a group using @PnRGPTbot.")
+    await sender.call(update.effective_chat.id, context.bot.send_message, text="Hello! I'm here to help. Mention me in a group using @PnRGPTbot.")
 
 
 async def process_message(update: Update, context: CallbackContext) -> None:
-    message_data = await asyncio.to_thread(get_message_count)
-    count = message_data["count"]
-    date = message_data["date"]
-    today = str(datetime.date.today())
-
-    if date != today:
-        count = 0
-
-    if count >= 100:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Sorry, I've reached my daily message limit. Please try again tomorrow."
-        )
-        return
+    await _answer(update, context, update.message.text)
 
-    answer = await _get_reply_with_typing(
-        context,
-        update.effective_chat.id,
-        update.effective_user.id,
-        update.message.text
-    )
 
-    await _send_long_message(context, update.effective_chat.id, answer)
+def _format_usage(usage: dict) -> str:
+    return ", ".join(
+        f"{metric} {u['used']:,}/{u['limit']:,}" if u["limit"] else f"{metric} {u['used']:,}"
+        for metric, u in usage.items()
+    )
 
-    await asyncio.to_thread(update_message_count, count + 1)
 
-    await asyncio.to_thread(
-        save_qa,
-        update.effective_user.id,
-        update.effective_user.username,
-        update.message.text,
-        answer,
-    )
+async def usage_command(update: Update, context: CallbackContext) -> None:
+    """Admin-only /usage: quota usage overall and for the heaviest users and chats, or
+    for one of them with `/usage user <id>` / `/usage chat <id>` (or for an assistant
+    profile with a quota, `/usage profile <name>`)."""
+    if update.effective_user.id not in admin_user_ids:
+        logging.info(f"Ignored /usage from non-admin user {update.effective_user.id}")
+        return
+    window = format_duration(quotas.window_seconds)
+    args = context.args or []
+    if len(args) == 2 and args[0] in SCOPES:
+        lines = [f"Usage by {args[0]} {args[1]} in the last {window}: "
+                 f"{_format_usage(await quotas.usage(args[0], args[1]))}"]
+    elif args:
+        lines = ["Usage: /usage, /usage user <id>, /usage chat <id> or /usage profile <name>"]
+    else:
+        lines = [f"Usage in the last {window}: {_format_usage(await quotas.usage('global', GLOBAL_SUBJECT))}"]
+        for scope in ("user", "chat", "profile"):
+            top = quotas.top(scope)
+            if top:
+                lines.append(f"\nTop {scope}s:")
+                lines.extend(f"{subject}: messages {t['messages']:,}, tokens {t['tokens']:,}" for subject, t in top)
+        lines.append(f"\n{quotas.stats()}")
+    await sender.call(update.effective_chat.id, context.bot.send_message, text="\n".join(lines))
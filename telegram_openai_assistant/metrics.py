@@ -0,0 +1,266 @@
+# metrics.py
+# In-process metrics: counters and latency histograms for the stages of handling a
+# message (storage reads, model calls, rendering, sending, Q&A logging), plus the
+# stats() counters the other modules already keep (caches, queues, quotas), pulled in
+# at read time. Exposed in Prometheus text format at /metrics (see webserver.py) and,
+# optionally, summarized to the log every METRICS_LOG_INTERVAL_SECONDS.
+#
+# Recording is meant to be cheap enough to leave on everywhere: a counter is a locked
+# add, a histogram observation a bisect into fixed buckets plus an append to a bounded
+# ring of recent samples. The buckets are what Prometheus aggregates across instances;
+# the ring gives exact p50/p95/p99 over the most recent RECENT_SAMPLES observations
+# for the log summary (and as *_recent gauges), computed only when they're read.
+import asyncio
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds. Spans sub-millisecond local work (rendering, cache hits) to slow model calls.
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0,
+)
+RECENT_SAMPLES = 1024
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def value(self, **labels) -> float:
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {value}")
+        return lines
+
+
+class _Series:
+    __slots__ = ("buckets", "sum", "count", "recent")
+
+    def __init__(self, size: int):
+        self.buckets = [0] * size
+        self.sum = 0.0
+        self.count = 0
+        self.recent: deque[float] = deque(maxlen=RECENT_SAMPLES)
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_labels", "_started")
+
+    def __init__(self, histogram: "Histogram", labels: dict):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._started, **self._labels)
+        return False
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._bounds = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series: dict[tuple, _Series] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(len(self._bounds) + 1)
+            series.buckets[index] += 1
+            series.sum += value
+            series.count += 1
+            series.recent.append(value)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+    def time(self, **labels) -> _Timer:
+        """`with histogram.time(stage=...):` observes the block's duration in seconds."""
+        return _Timer(self, labels)
+
+    def snapshot(self) -> list[tuple[dict, int, float, dict[float, float]]]:
+        """(labels, count, sum, {quantile: value over recent samples}) per series."""
+        with self._lock:
+            series = [(key, s.count, s.sum, sorted(s.recent)) for key, s in self._series.items()]
+        result = []
+        for key, count, total, recent in series:
+            quantiles = {q: recent[min(len(recent) - 1, int(q * len(recent)))] for q in QUANTILES} if recent else {}
+            result.append((dict(zip(self.labelnames, key)), count, total, quantiles))
+        return result
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(key, list(s.buckets), s.sum, s.count) for key, s in self._series.items()]
+        for key, buckets, total, count in series:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self._bounds, buckets):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        recent_name = f"{self.name}_recent"
+        lines.append(f"# HELP {recent_name} Quantiles of {self.name} over the last {RECENT_SAMPLES} observations")
+        lines.append(f"# TYPE {recent_name} gauge")
+        for labels, _, _, quantiles in self.snapshot():
+            for q, value in quantiles.items():
+                lines.append(f"{recent_name}{_format_labels({**labels, 'quantile': q})} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+        # name prefix -> (help, fn returning a {name: number} dict, possibly one level nested)
+        self._stats: dict[str, tuple[str, object]] = {}
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def reset(self) -> None:
+        """Zeroes every counter and histogram (e.g. between benchmark runs)."""
+        for metric in self._metrics:
+            metric.reset()
+
+    def register_stats(self, prefix: str, help: str, stats) -> None:
+        """Exposes every number in the dict `stats()` returns as a gauge named
+        prefix_<key> (nested dicts become prefix_<key>_<subkey>)."""
+        self._stats[prefix] = (help, stats)
+
+    def _collect_stats(self) -> list[tuple[str, str, float]]:
+        collected = []
+        for prefix, (help, stats) in self._stats.items():
+            try:
+                values = stats()
+            except Exception:
+                logger.exception(f"Collecting {prefix} metrics failed")
+                continue
+            for key, value in values.items():
+                items = value.items() if isinstance(value, dict) else [(None, value)]
+                for subkey, v in items:
+                    if isinstance(v, (int, float)):
+                        name = f"{prefix}_{key}" if subkey is None else f"{prefix}_{key}_{subkey}"
+                        collected.append((name, help, float(v)))
+        return collected
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, help, value in self._collect_stats():
+            lines.extend((f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"))
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """One line per histogram series with its count and recent p50/p95/p99."""
+        lines = []
+        for metric in self._metrics:
+            if not isinstance(metric, Histogram):
+                continue
+            for labels, count, _, quantiles in metric.snapshot():
+                label_text = ",".join(str(v) for v in labels.values()) or metric.name
+                percentiles = " ".join(f"p{int(q * 100)}={v * 1000:.1f}ms" for q, v in quantiles.items())
+                lines.append(f"{label_text}: n={count} {percentiles}")
+        return "\n".join(lines)
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "bot_stage_seconds", "Time spent in each stage of answering a message", ("stage",)
+)
+
+
+def timed(stage: str):
+    """Decorator recording every call of a function (sync or async) under
+    bot_stage_seconds{stage=...}."""
+
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with STAGE_SECONDS.time(stage=stage):
+                    return await fn(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage=stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def stage_timer(stage: str) -> _Timer:
+    """`with stage_timer("..."):` -- timed() for a block rather than a whole function."""
+    return STAGE_SECONDS.time(stage=stage)
+
+
+async def log_periodically(interval_seconds: float) -> None:
+    """Logs registry.summary() every interval_seconds until cancelled."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        summary = registry.summary()
+        if summary:
+            logger.info(f"Stage latencies (recent):\n{summary}")
@@ -1,17 +1,68 @@
+import asyncio
+import json
 import logging
 import re
+import time
 from dataclasses import dataclass
+from typing import Callable
 
-from openai import AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    APIError,
+    APIStatusError,
+    APITimeoutError,
+    BadRequestError,
+    NotFoundError,
+    RateLimitError,
+)
 
-from .assistant_config import INSTRUCTIONS, MODEL, TEMPERATURE
-from .config import openai_api_key, vector_store_id
+from . import answer_cache, profiles, retrieval
+from .config import openai_api_key, openai_timeout_max_seconds
+from .metrics import STAGE_SECONDS, registry, stage_timer, timed
+from .profiles import Profile
+from .resilience import guard
 
 logger = logging.getLogger(__name__)
 
-client = AsyncOpenAI(api_key=openai_api_key, timeout=60.0, max_retries=2)
+# One client, and so one HTTP connection pool, for every assistant profile: a profile
+# only changes the request parameters. Answers are held to tighter, adaptive deadlines
+# by resilience.guard; the client's own timeout is only the ceiling for a single attempt.
+client = AsyncOpenAI(api_key=openai_api_key, timeout=openai_timeout_max_seconds, max_retries=2)
+
+# Size and latency of model calls, per input mode: "full" (whole history resent) vs
+# "chained" (previous_response_id plus only the new turn), so the two can be compared,
+# along with how many of their input tokens OpenAI's prompt cache served.
+request_stats = {
+    mode: {"requests": 0, "request_bytes": 0, "seconds": 0.0, "input_tokens": 0, "cached_tokens": 0}
+    for mode in ("full", "chained")
+}
+MODEL_REQUESTS = registry.counter(
+    "bot_model_requests_total",
+    "Answers requested, by assistant profile and how they were served (model, cache, error, degraded)",
+    ("profile", "outcome"),
+)
+MODEL_TOKENS = registry.counter(
+    "bot_model_tokens_total", "Model tokens used, by assistant profile and kind", ("profile", "kind")
+)
+# Background compaction, kept apart so it doesn't count as answers or answer errors.
+SUMMARIES = registry.counter(
+    "bot_summaries_total", "Conversation summaries requested, by assistant profile and outcome", ("profile", "outcome")
+)
+SUMMARY_TOKENS = registry.counter(
+    "bot_summary_tokens_total", "Model tokens used for conversation summaries, by assistant profile", ("profile",)
+)
+
+# Everything a model call can fail with: the SDK's errors, and TimeoutError from the
+# deadlines resilience.guard sets.
+MODEL_ERRORS = (APIError, TimeoutError)
+# Stream events after which no more text is coming.
+_STREAM_END_EVENTS = ("response.completed", "response.failed", "response.incomplete", "error")
+UNAVAILABLE_APOLOGY = "Sorry, the AI service is having trouble right now. Please try again in a few minutes."
 
 _CITATION_MARKER_RE = re.compile(r"【.*?】")
+# A citation marker that has started streaming in but isn't closed yet.
+_PARTIAL_CITATION_RE = re.compile(r"【[^】]*$")
 
 
 @dataclass
@@ -19,6 +70,18 @@ class ResponseResult:
     text: str
     response_id: str | None
     total_tokens: int | None = None
+    cached: bool = False  # served from answer_cache rather than a model call
+    first_token_seconds: float | None = None  # only set for streamed responses
+    # True if the request continued a server-side thread via previous_response_id
+    # rather than sending the whole history.
+    chained: bool = False
+    input_tokens: int | None = None
+    # Input tokens served from OpenAI's prompt cache (billed and processed at a discount)
+    # -- the prefix of the request it had already seen.
+    cached_tokens: int | None = None
+    # Set when router.py answered without the model: the route it took (greeting, thanks,
+    # out_of_scope). response_id is None then, but nothing failed.
+    route: str | None = None
 
 
 def _clean(text: str) -> str:
@@ -26,31 +89,347 @@ def _clean(text: str) -> str:
     return _CITATION_MARKER_RE.sub("", text).strip()
 
 
-async def get_answer(messages: list[dict[str, str]]) -> ResponseResult:
-    """Get an answer from the model, given the full conversation so far as a list of
-    {"role": "user"|"assistant", "content": ...} turns (handlers.py owns trimming this
-    to a token budget). response_id is None on failure so callers know not to persist
-    the turn that triggered it."""
-    try:
-        response = await client.responses.create(
-            model=MODEL,
-            instructions=INSTRUCTIONS,
-            input=messages,
-            tools=[{"type": "file_search", "vector_store_ids": [vector_store_id]}],
-            temperature=TEMPERATURE,
+def clean_partial(text: str) -> str:
+    """_clean for text that's still streaming in, which may end mid-marker."""
+    return _PARTIAL_CITATION_RE.sub("", _CITATION_MARKER_RE.sub("", text)).strip()
+
+
+def _is_cacheable(messages: list[dict]) -> bool:
+    return answer_cache.cache is not None and len(messages) == 1 and messages[0]["role"] == "user"
+
+
+async def _cached_result(messages: list[dict], profile: Profile) -> ResponseResult | None:
+    hit = await asyncio.to_thread(answer_cache.cache.lookup, profile.fingerprint, messages[0]["content"])
+    if hit is None:
+        return None
+    logger.info(f"Answer cache hit, saved ~{hit['total_tokens'] or 0} tokens")
+    MODEL_REQUESTS.inc(profile=profile.name, outcome="cache")
+    return ResponseResult(hit["answer"], hit["response_id"], cached=True)
+
+
+async def _degraded_result(messages: list[dict], profile: Profile) -> ResponseResult:
+    """What to answer while the circuit breaker is open: the answer cache's answer to the
+    latest message if it has one -- even mid-conversation, where it's normally not used
+    -- or else an apology."""
+    MODEL_REQUESTS.inc(profile=profile.name, outcome="degraded")
+    if answer_cache.cache is not None and messages[-1]["role"] == "user":
+        hit = await asyncio.to_thread(answer_cache.cache.lookup, profile.fingerprint, messages[-1]["content"])
+        if hit is not None:
+            logger.info("Model calls suspended; answering from the answer cache")
+            return ResponseResult(hit["answer"], hit["response_id"], cached=True)
+    logger.info("Model calls suspended; apologizing")
+    return ResponseResult(UNAVAILABLE_APOLOGY, None)
+
+
+async def _store_cached(messages: list[dict], result: ResponseResult, profile: Profile) -> None:
+    if result.text:
+        await asyncio.to_thread(
+            answer_cache.cache.store,
+            profile.fingerprint,
+            messages[0]["content"],
+            result.text,
+            result.response_id,
+            result.total_tokens,
         )
-    except APITimeoutError:
+
+
+async def _retrieve(messages: list[dict], profile: Profile) -> retrieval.Retrieved | None:
+    """Locally retrieved passages for the latest question, or None to use file_search
+    (see retrieval.py)."""
+    if retrieval.index is None or not profile.local_retrieval or messages[-1]["role"] != "user":
+        return None
+    with stage_timer("retrieve"):
+        return await asyncio.to_thread(retrieval.for_question, messages[-1]["content"])
+
+
+def _request_params(
+    messages: list[dict],
+    profile: Profile,
+    previous_response_id: str | None = None,
+    retrieved: retrieval.Retrieved | None = None,
+) -> dict:
+    if previous_response_id is not None:
+        # The server-side thread already holds everything up to and including the last
+        # assistant turn; only what came after it needs sending.
+        last_assistant = max((i for i, m in enumerate(messages) if m["role"] == "assistant"), default=-1)
+        messages = messages[last_assistant + 1:]
+    # History entries also carry storage bookkeeping (seq, etc.) the API won't accept.
+    turns = [{"role": m["role"], "content": m["content"]} for m in messages]
+    if retrieved is not None:
+        # Right before the question, so everything ahead of it stays a stable prefix.
+        turns.insert(len(turns) - 1, retrieved.as_message())
+    params = dict(model=profile.model, instructions=profile.instructions, input=turns, temperature=profile.temperature)
+    if retrieved is None:
+        params["tools"] = [{"type": "file_search", "vector_store_ids": [profile.vector_store_id]}]
+    if previous_response_id is not None:
+        params["previous_response_id"] = previous_response_id
+    return params
+
+
+def _is_missing_previous_response(e: APIStatusError) -> bool:
+    return "previous response" in str(e).lower() or "previous_response" in str(e).lower()
+
+
+async def _create(messages: list[dict], previous_response_id: str | None, profile: Profile, **kwargs):
+    """Sends the request, chained onto previous_response_id if given. If that response no
+    longer exists server-side (expired or deleted), falls back to sending the full
+    history -- which is always kept locally for exactly this reason. Returns
+    (response or stream, chained, request params)."""
+    retrieved = await _retrieve(messages, profile)
+    if previous_response_id is not None:
+        params = _request_params(messages, profile, previous_response_id, retrieved)
+        try:
+            return await client.responses.create(**params, **kwargs), True, params
+        except (BadRequestError, NotFoundError) as e:
+            if not _is_missing_previous_response(e):
+                raise
+            logger.warning(f"Previous response {previous_response_id} unavailable, resending full history: {e}")
+    params = _request_params(messages, profile, retrieved=retrieved)
+    return await client.responses.create(**params, **kwargs), False, params
+
+
+def _record_request(result: ResponseResult, params: dict, seconds: float) -> None:
+    mode = "chained" if result.chained else "full"
+    request_bytes = len(json.dumps(params["input"]).encode("utf-8"))
+    stats = request_stats[mode]
+    stats["requests"] += 1
+    stats["request_bytes"] += request_bytes
+    stats["seconds"] += seconds
+    stats["input_tokens"] += result.input_tokens or 0
+    stats["cached_tokens"] += result.cached_tokens or 0
+    logger.info(
+        f"Model call ({mode}): {request_bytes} input bytes, {seconds:.2f}s, "
+        f"{result.cached_tokens or 0}/{result.input_tokens or 0} input tokens cached"
+    )
+
+
+def _error_result(e: Exception, profile: Profile) -> ResponseResult:
+    """Maps a failed request to the apology the user sees (response_id None)."""
+    MODEL_REQUESTS.inc(profile=profile.name, outcome="error")
+    if isinstance(e, (APITimeoutError, TimeoutError)):
         logger.error("OpenAI request timed out")
         return ResponseResult("Sorry, the request is taking too long. Please try again later.", None)
-    except RateLimitError:
+    if isinstance(e, RateLimitError):
         logger.error("OpenAI rate limit hit")
         return ResponseResult("Sorry, I'm getting too many requests right now. Please try again in a moment.", None)
-    except APIConnectionError:
+    if isinstance(e, APIConnectionError):
         logger.error("OpenAI connection error")
         return ResponseResult("Sorry, I couldn't reach the AI service. Please try again later.", None)
-    except APIStatusError as e:
-        logger.error(f"OpenAI API error: {e}")
+    logger.error(f"OpenAI API error: {e}")
+    return ResponseResult("Sorry, there was an issue processing your request. Please try again later.", None)
+
+
+def is_service_failure(e: Exception) -> bool:
+    """Whether e says the service is struggling (for the circuit breaker), rather than
+    that something was wrong with this one request."""
+    if isinstance(e, APIStatusError):
+        return e.status_code >= 500 or isinstance(e, RateLimitError)
+    return True
+
+
+def _result_from_response(response, profile: Profile, chained: bool = False) -> ResponseResult:
+    MODEL_REQUESTS.inc(profile=profile.name, outcome="model")
+    usage = response.usage
+    if usage is None:
+        return ResponseResult(_clean(response.output_text), response.id, chained=chained)
+    for kind in ("input_tokens", "output_tokens", "total_tokens"):
+        count = getattr(usage, kind, None)
+        if isinstance(count, int):
+            MODEL_TOKENS.inc(count, profile=profile.name, kind=kind.removesuffix("_tokens"))
+    details = getattr(usage, "input_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None)
+    if isinstance(cached_tokens, int):
+        MODEL_TOKENS.inc(cached_tokens, profile=profile.name, kind="cached_input")
+    return ResponseResult(
+        _clean(response.output_text),
+        response.id,
+        usage.total_tokens,
+        chained=chained,
+        input_tokens=usage.input_tokens,
+        cached_tokens=cached_tokens,
+    )
+
+
+@timed("get_answer")
+async def get_answer(
+    messages: list[dict[str, str]], previous_response_id: str | None = None, profile: Profile | None = None
+) -> ResponseResult:
+    """Get an answer from the model, given the full conversation so far as a list of
+    {"role": "user"|"assistant", "content": ...} turns (handlers.py owns trimming this
+    to a token budget). response_id is None on failure so callers know not to persist
+    the turn that triggered it.
+
+    If previous_response_id is given, messages must be exactly the conversation that
+    response's server-side thread holds plus the new turn(s); only the new turns are
+    sent, falling back to the whole list if the chain can't be continued.
+
+    The first message of a conversation is looked up in (and, once answered, stored in)
+    the answer cache, so a question that's been asked before is answered without a
+    model call.
+
+    The call is held to resilience.guard's deadline (and hedged, if enabled); while its
+    circuit breaker is open, no call is made and the answer comes from
+    _degraded_result instead.
+
+    profile is the assistant answering (see profiles.py), the default one if not given."""
+    profile = profile or profiles.default
+    cacheable = previous_response_id is None and _is_cacheable(messages)
+    if cacheable:
+        cached = await _cached_result(messages, profile)
+        if cached is not None:
+            return cached
+    if not guard.allow():
+        return await _degraded_result(messages, profile)
+
+    started = time.perf_counter()
+    failed = None
+    try:
+        response, chained, params = await guard.run("answer", lambda: _create(messages, previous_response_id, profile))
+        failed = False
+    except MODEL_ERRORS as e:
+        failed = is_service_failure(e)
+        return _error_result(e, profile)
+    finally:
+        guard.record(failed)
+
+    result = _result_from_response(response, profile, chained)
+    _record_request(result, params, time.perf_counter() - started)
+    if cacheable:
+        await _store_cached(messages, result, profile)
+    return result
+
+
+async def _open_stream(messages: list[dict], previous_response_id: str | None, profile: Profile):
+    """Starts a streamed request and reads it up to its first text (or its end, if no text
+    comes), which is what the deadline and hedging apply to for streams. Returns
+    (stream, events read so far, chained, request params)."""
+    stream, chained, params = await _create(messages, previous_response_id, profile, stream=True)
+    events = []
+    try:
+        while True:
+            event = await anext(stream, None)
+            if event is None:
+                break
+            events.append(event)
+            if event.type == "response.output_text.delta" or event.type in _STREAM_END_EVENTS:
+                break
+    except BaseException:
+        await stream.close()
+        raise
+    return stream, events, chained, params
+
+
+async def _close_stream(opened) -> None:
+    await opened[0].close()
+
+
+async def _replay(events: list, stream):
+    """The events _open_stream already read, then the rest of the stream."""
+    for event in events:
+        yield event
+    if not events or events[-1].type not in _STREAM_END_EVENTS:
+        async for event in stream:
+            yield event
+
+
+@timed("stream_answer")
+async def stream_answer(
+    messages: list[dict[str, str]],
+    on_text: Callable[[str], None],
+    previous_response_id: str | None = None,
+    profile: Profile | None = None,
+) -> ResponseResult:
+    """Same contract as get_answer, but streams the response: on_text is called with the
+    raw text received so far every time more arrives, so the caller can show it
+    progressively (passing it through clean_partial first). on_text must be cheap --
+    it runs once per streamed delta, so callers should only record the text there and
+    render on their own schedule. The returned result always carries the complete final
+    text, which is what should be shown in the end (on failure it's the apology, and on
+    an answer cache hit on_text is never called at all)."""
+    profile = profile or profiles.default
+    cacheable = previous_response_id is None and _is_cacheable(messages)
+    if cacheable:
+        cached = await _cached_result(messages, profile)
+        if cached is not None:
+            return cached
+
+    if not guard.allow():
+        return await _degraded_result(messages, profile)
+
+    started = time.perf_counter()
+    first_token_seconds = None
+    received = ""
+    response = None
+    failed = None
+    try:
+        stream, events, chained, params = await guard.run(
+            "first_token", lambda: _open_stream(messages, previous_response_id, profile), discard=_close_stream
+        )
+        end = None
+        async for event in _replay(events, stream):
+            if event.type == "response.output_text.delta":
+                if first_token_seconds is None:
+                    first_token_seconds = time.perf_counter() - started
+                    logger.info(f"Time to first token: {first_token_seconds:.2f}s")
+                    STAGE_SECONDS.observe(first_token_seconds, stage="first_token")
+                received += event.delta
+                on_text(received)
+            elif event.type == "response.completed":
+                response = event.response
+            elif event.type in _STREAM_END_EVENTS:
+                logger.error(f"OpenAI stream ended with {event.type}: {event}")
+                end = event.type
+                break
+        # An incomplete response (e.g. cut off at the output limit) isn't the service failing.
+        failed = None if end == "response.incomplete" else response is None
+    except MODEL_ERRORS as e:
+        failed = is_service_failure(e)
+        return _error_result(e, profile)
+    finally:
+        guard.record(failed)
+
+    if response is None:
+        MODEL_REQUESTS.inc(profile=profile.name, outcome="error")
         return ResponseResult("Sorry, there was an issue processing your request. Please try again later.", None)
 
-    total_tokens = response.usage.total_tokens if response.usage is not None else None
+    result = _result_from_response(response, profile, chained)
+    _record_request(result, params, time.perf_counter() - started)
+    result.first_token_seconds = first_token_seconds
+    if cacheable:
+        await _store_cached(messages, result, profile)
+    return result
+
+
+async def summarize(
+    turns: list[dict], previous_summary: str | None = None, profile: Profile | None = None
+) -> ResponseResult:
+    """Condenses turns (oldest first) into a summary, merged with previous_summary if
+    given, with the profile's summary model and instructions. No file_search: it only
+    restates what's already in the conversation. Not attempted while the circuit
+    breaker is open (response_id None, like a failure)."""
+    profile = profile or profiles.default
+    if not guard.allow():
+        return ResponseResult("", None)
+    transcript = "\n\n".join(f"{m['role'].upper()}: {m['content']}" for m in turns)
+    parts = [f"Previous summary:\n{previous_summary}"] if previous_summary else []
+    parts.append(f"Transcript:\n{transcript}")
+    failed = None
+    try:
+        response = await client.responses.create(
+            model=profile.summary_model,
+            instructions=profile.summary_instructions,
+            input="\n\n".join(parts),
+        )
+        failed = False
+    except MODEL_ERRORS as e:
+        failed = is_service_failure(e)
+        SUMMARIES.inc(profile=profile.name, outcome="error")
+        logger.warning(f"Summary request failed: {e!r}")
+        return ResponseResult("", None)
+    finally:
+        guard.record(failed)
+    SUMMARIES.inc(profile=profile.name, outcome="summarized")
+    total_tokens = getattr(response.usage, "total_tokens", None)
+    if isinstance(total_tokens, int):
+        SUMMARY_TOKENS.inc(total_tokens, profile=profile.name)
     return ResponseResult(_clean(response.output_text), response.id, total_tokens)
@@ -0,0 +1,162 @@
+# profiles.py
+# Several assistants from one bot process. A profile is everything that makes an
+# assistant what it is -- model, temperature, instructions, the vector store it
+# searches, the model it summarizes with and its canned replies (see router.py) -- plus
+# an optional quota of its own. The one in assistant_config.py is the "default"
+# profile; PROFILES_PATH can name a JSON file with more, and with the chats that should
+# use each of them:
+#
+#   {
+#     "profiles": {
+#       "glaucoma": {
+#         "instructions_file": "glaucoma.txt",
+#         "vector_store_id": "vs_...",
+#         "quota_messages": 500
+#       }
+#     },
+#     "chats": {"-1001234567890": "glaucoma"}
+#   }
+#
+# Any setting a profile leaves out is the default profile's; "instructions_file" is read
+# relative to the JSON file. A "default" entry overrides settings of the default
+# profile itself, which every chat not listed under "chats" uses.
+#
+# The file is read once, at startup (init()), and looking up a chat's profile is then a
+# dict lookup. Everything else stays shared: one OpenAI client and connection pool, one
+# admission queue and circuit breaker, one answer cache (keyed per profile, see
+# answer_cache.py). Model requests and tokens are counted per profile.
+import json
+import logging
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+
+from . import assistant_config
+from .answer_cache import fingerprint
+from .config import profiles_path, retrieval_mode, vector_store_id
+from .quotas import quotas
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE = "default"
+# Settings a profile in the file may give.
+SETTINGS = (
+    "model",
+    "temperature",
+    "instructions",
+    "instructions_file",
+    "vector_store_id",
+    "summary_model",
+    "summary_instructions",
+    "greeting_reply",
+    "thanks_reply",
+    "out_of_scope_reply",
+    "quota_messages",
+    "quota_tokens",
+)
+
+
+@dataclass(frozen=True)
+class Profile:
+    name: str
+    model: str
+    temperature: float
+    instructions: str
+    vector_store_id: str
+    summary_model: str
+    summary_instructions: str
+    # What router.py answers greetings, thanks and out-of-scope questions with.
+    greeting_reply: str
+    thanks_reply: str
+    out_of_scope_reply: str
+    # Limits over QUOTA_WINDOW_SECONDS on everything this profile answers, on top of the
+    # per-user, per-chat and global ones. 0 = unlimited.
+    quota_messages: int = 0
+    quota_tokens: int = 0
+    # Whether the local retrieval index (RETRIEVAL_MODE) applies. There is one index,
+    # built from the default profile's knowledge files; other profiles use file_search.
+    local_retrieval: bool = False
+    # Identifies the answers this profile gives, for the answer cache.
+    fingerprint: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(
+            self,
+            "fingerprint",
+            fingerprint(
+                self.model,
+                self.temperature,
+                self.instructions,
+                self.vector_store_id,
+                retrieval_mode if self.local_retrieval else "hosted",
+            ),
+        )
+
+
+default = Profile(
+    DEFAULT_PROFILE,
+    assistant_config.MODEL,
+    assistant_config.TEMPERATURE,
+    assistant_config.INSTRUCTIONS,
+    vector_store_id,
+    assistant_config.SUMMARY_MODEL,
+    assistant_config.SUMMARY_INSTRUCTIONS,
+    assistant_config.GREETING_REPLY,
+    assistant_config.THANKS_REPLY,
+    assistant_config.OUT_OF_SCOPE_REPLY,
+    local_retrieval=True,
+)
+_profiles: dict[str, Profile] = {DEFAULT_PROFILE: default}
+_chats: dict[int, Profile] = {}
+
+
+def _settings(name: str, entry: dict, base_dir: Path) -> dict:
+    unknown = set(entry) - set(SETTINGS)
+    if unknown:
+        raise RuntimeError(f"Profile {name!r} has unknown setting(s): {', '.join(sorted(unknown))}")
+    settings = dict(entry)
+    if "instructions_file" in settings:
+        if "instructions" in settings:
+            raise RuntimeError(f"Profile {name!r} gives both instructions and instructions_file")
+        settings["instructions"] = (base_dir / settings.pop("instructions_file")).read_text(encoding="utf-8").strip()
+    return settings
+
+
+def load(path) -> tuple[dict[str, Profile], dict[int, Profile]]:
+    """Reads a profiles file: returns ({name: Profile}, {chat id: Profile}), the default
+    profile included."""
+    path = Path(path)
+    with open(path, encoding="utf-8") as file:
+        data = json.load(file)
+    entries = data.get("profiles", {})
+    base = replace(default, **_settings(DEFAULT_PROFILE, entries.get(DEFAULT_PROFILE, {}), path.parent))
+    profiles = {DEFAULT_PROFILE: base}
+    for name, entry in entries.items():
+        if name != DEFAULT_PROFILE:
+            profiles[name] = replace(base, name=name, local_retrieval=False, **_settings(name, entry, path.parent))
+    chats = {}
+    for chat_id, name in data.get("chats", {}).items():
+        if name not in profiles:
+            raise RuntimeError(f"{path}: chat {chat_id} is mapped to unknown profile {name!r}")
+        chats[int(chat_id)] = profiles[name]
+    return profiles, chats
+
+
+def init() -> None:
+    """Loads PROFILES_PATH, if set, and applies the profiles' quotas. Call once at
+    startup, before anything else that uses the profiles."""
+    global default, _profiles, _chats
+    if profiles_path:
+        _profiles, _chats = load(profiles_path)
+        default = _profiles[DEFAULT_PROFILE]
+        logger.info(f"Loaded {len(_profiles)} assistant profiles for {len(_chats)} chats from {profiles_path}")
+    for profile in _profiles.values():
+        if profile.quota_messages or profile.quota_tokens:
+            quotas.set_limits("profile", profile.name, {"messages": profile.quota_messages, "tokens": profile.quota_tokens})
+
+
+def for_chat(chat_id) -> Profile:
+    return _chats.get(chat_id, default)
+
+
+def all_profiles() -> list[Profile]:
+    return list(_profiles.values())
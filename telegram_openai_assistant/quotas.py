@@ -0,0 +1,369 @@
+# quotas.py
+# Usage quotas, so one heavy user (or one busy group) can't use up the bot's capacity for
+# everyone else. Usage is limited over a sliding window (QUOTA_WINDOW_SECONDS, a day by
+# default) at three scopes -- per user, per group chat, and overall -- each both in
+# messages answered and in model tokens spent (from each response's real total_tokens).
+# Assistant profiles (see profiles.py) can add a fourth: a limit on everything one
+# profile answers, set per profile with set_limits().
+#
+# Each window is split into QUOTA_BUCKETS fixed slices with a running total, held in
+# memory, so checking a message against every limit is a few additions no matter how
+# much traffic there has been; sliding forward just zeroes the slices that fell out of
+# the window. Every change is also added to a per-slice counter in shared storage (see
+# storage.incr_counter), which is what a window is loaded from the first time a process
+# sees that user/chat. That keeps quotas across restarts, and lets several bot processes
+# account for each other's usage: each write hands back the slice's shared total, so a
+# process's view catches up with the others' on its own next write.
+#
+# A message is charged when it's admitted, before the model call, so a burst can't all
+# slip past the last free slot together; acquire() and release() bracket that. The
+# message's increment of the current slice is conditional (incr_counter's limit): it
+# only goes through if the slice stays within what the rest of the window leaves of the
+# limit, so processes racing for the last free slot can't all take it. The earlier
+# slices are as this process last saw them, so across processes a message limit can
+# only be overshot by what the others used in those since -- never within one. Tokens
+# are only known afterwards, so the token limit stops the *next* message once the
+# window's spend has reached it.
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict
+
+from .config import (
+    quota_chat_messages,
+    quota_chat_tokens,
+    quota_global_messages,
+    quota_global_tokens,
+    quota_user_messages,
+    quota_user_tokens,
+    quota_window_seconds,
+)
+from .storage import backend as storage
+
+logger = logging.getLogger(__name__)
+
+# Slices per window. More means a smoother slide (usage expires in 1/24th-of-a-window
+# steps here) at the cost of more counters to load for a new user.
+QUOTA_BUCKETS = 24
+# Users/chats whose windows are kept in memory; the least recently active are dropped
+# (and reloaded from storage if they come back).
+MAX_TRACKED_SUBJECTS = 10_000
+METRICS = ("messages", "tokens")
+SCOPES = ("user", "chat", "profile", "global")
+GLOBAL_SUBJECT = "all"
+
+
+class Denial:
+    """Why a message was refused: which scope's limit it hit, on which metric, and
+    roughly how long until enough of the window has slid past for it to be allowed."""
+
+    __slots__ = ("scope", "metric", "limit", "retry_after")
+
+    def __init__(self, scope: str, metric: str, limit: int, retry_after: float):
+        self.scope = scope
+        self.metric = metric
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+class Charge:
+    """An admitted message: which subjects it was charged to, and in which slice, so
+    release() can refund exactly that."""
+
+    __slots__ = ("subjects", "bucket")
+
+    def __init__(self, subjects: list[tuple[str, str]], bucket: int):
+        self.subjects = subjects
+        self.bucket = bucket
+
+
+class _Window:
+    """One subject's usage over the sliding window: per-slice counts for each metric in a
+    ring (slice number b lives at index b % buckets) plus running totals."""
+
+    __slots__ = ("bucket", "counts", "totals")
+
+    def __init__(self, bucket: int, counts: dict[str, list[int]]):
+        self.bucket = bucket
+        self.counts = counts
+        self.totals = {metric: sum(c) for metric, c in counts.items()}
+
+    def advance(self, bucket: int) -> None:
+        """Slides the window forward to end at slice `bucket`."""
+        steps = bucket - self.bucket
+        if steps <= 0:
+            return
+        for metric, counts in self.counts.items():
+            n = len(counts)
+            if steps >= n:
+                counts[:] = [0] * n
+                self.totals[metric] = 0
+                continue
+            for b in range(self.bucket + 1, bucket + 1):
+                self.totals[metric] -= counts[b % n]
+                counts[b % n] = 0
+        self.bucket = bucket
+
+    def add(self, metric: str, amount: int, bucket: int | None = None) -> None:
+        """Adds to slice `bucket` (default: the current one), which must be in the window."""
+        counts = self.counts[metric]
+        counts[(self.bucket if bucket is None else bucket) % len(counts)] += amount
+        self.totals[metric] += amount
+
+    def sync(self, metric: str, bucket: int, shared_value: int) -> None:
+        """Takes in the shared total for slice `bucket` (which includes other processes'
+        usage), unless that's behind what this process has already counted."""
+        if bucket != self.bucket:
+            return
+        counts = self.counts[metric]
+        index = bucket % len(counts)
+        if shared_value > counts[index]:
+            self.totals[metric] += shared_value - counts[index]
+            counts[index] = shared_value
+
+    def oldest_used_bucket(self, metric: str) -> int | None:
+        counts = self.counts[metric]
+        n = len(counts)
+        for b in range(self.bucket - n + 1, self.bucket + 1):
+            if counts[b % n]:
+                return b
+        return None
+
+
+class QuotaEngine:
+    def __init__(self, window_seconds: float, limits: dict[str, dict[str, int]], buckets: int = QUOTA_BUCKETS):
+        """`limits` maps scope -> metric -> limit (0 = unlimited)."""
+        self._buckets = buckets
+        self._bucket_seconds = max(1.0, window_seconds / buckets)
+        self._window_seconds = self._bucket_seconds * buckets
+        self._limits = limits
+        # (scope, subject) -> metric -> limit, for subjects with limits of their own.
+        self._subject_limits: dict[tuple[str, str], dict[str, int]] = {}
+        # (scope, subject) -> _Window, least recently used first.
+        self._windows: OrderedDict[tuple[str, str], _Window] = OrderedDict()
+        self._stats = {"admitted": 0, "denied": 0, "released": 0}
+
+    def _bucket(self, now: float) -> int:
+        return int(now // self._bucket_seconds)
+
+    def set_limits(self, scope: str, subject, limits: dict[str, int]) -> None:
+        """Gives one subject limits of its own (metric -> limit, 0 = unlimited) in place
+        of its scope's."""
+        self._subject_limits[(scope, str(subject))] = limits
+
+    def _limit(self, scope: str, subject: str, metric: str) -> int:
+        limits = self._subject_limits.get((scope, subject)) or self._limits.get(scope, {})
+        return limits.get(metric, 0)
+
+    def _subjects(self, chat_id, user_id, profile: str | None) -> list[tuple[str, str]]:
+        # A private chat is the user; only groups get a chat-level quota of their own.
+        subjects = [("user", str(user_id))]
+        if chat_id != user_id:
+            subjects.append(("chat", str(chat_id)))
+        # Only profiles with a quota are tracked, sparing the others a counter write per
+        # message.
+        if profile is not None and ("profile", profile) in self._subject_limits:
+            subjects.append(("profile", profile))
+        subjects.append(("global", GLOBAL_SUBJECT))
+        return subjects
+
+    def _counter_key(self, scope: str, subject: str, metric: str, bucket: int) -> str:
+        return f"quota:{scope}:{subject}:{metric}:{bucket}"
+
+    def _load(self, scope: str, subject: str, bucket: int) -> _Window:
+        """Reads a window's slices from storage. Blocking; run it in a thread."""
+        first = bucket - self._buckets + 1
+        counts = {}
+        for metric in METRICS:
+            values = storage.get_counters(
+                [self._counter_key(scope, subject, metric, b) for b in range(first, bucket + 1)]
+            )
+            ring = [0] * self._buckets
+            for b, value in zip(range(first, bucket + 1), values):
+                ring[b % self._buckets] = value
+            counts[metric] = ring
+        return _Window(bucket, counts)
+
+    async def _windows_for(self, subjects: list[tuple[str, str]], now: float) -> list[_Window]:
+        bucket = self._bucket(now)
+        # Held here, since other tasks can evict them from the LRU while we load the rest.
+        held = {s: self._windows[s] for s in subjects if s in self._windows}
+        missing = [s for s in subjects if s not in held]
+        if missing:
+            loaded = await asyncio.to_thread(lambda: [self._load(*s, bucket) for s in missing])
+            held.update(zip(missing, loaded))
+        windows = []
+        for subject in subjects:
+            # Another task may have loaded it while we were waiting; keep the first.
+            window = self._windows.setdefault(subject, held[subject])
+            self._windows.move_to_end(subject)
+            window.advance(bucket)
+            windows.append(window)
+        while len(self._windows) > MAX_TRACKED_SUBJECTS:
+            self._windows.popitem(last=False)
+        return windows
+
+    def _persist(
+        self, changes: list[tuple[str, str, str, int, int, int | None]]
+    ) -> tuple[list[int | None], int | None]:
+        """Adds each (scope, subject, metric, bucket, amount, limit) to storage, limit
+        being what the slice may reach (None = no limit). Returns the slices' new shared
+        totals and None, or -- if a slice would go past its limit -- undoes the changes
+        already made and returns the index of the refused one. Blocking; run it in a
+        thread."""
+        ttl = self._window_seconds + self._bucket_seconds
+        shared = []
+        for i, (scope, subject, metric, bucket, amount, limit) in enumerate(changes):
+            value = storage.incr_counter(self._counter_key(scope, subject, metric, bucket), amount, ttl, limit)
+            if value is None and limit is not None:
+                for done in changes[:i]:
+                    storage.incr_counter(self._counter_key(*done[:4]), -done[4], ttl)
+                return shared, i
+            shared.append(value)
+        return shared, None
+
+    async def _charge(
+        self, subjects, windows, metric: str, amount: int, limits=None, bucket: int | None = None
+    ) -> int | None:
+        """Adds amount to every subject's window, here and in storage, in slice `bucket`
+        (default: the current one). `limits` (one per subject, None = no limit) caps each
+        subject's whole window: if any would go past its limit, nothing is charged and
+        that subject's index is returned."""
+        if bucket is None:
+            bucket = windows[0].bucket
+        for window in windows:
+            window.add(metric, amount, bucket)
+        slice_limits = [
+            # What the rest of the window leaves of the limit for the current slice.
+            limit - (window.totals[metric] - window.counts[metric][bucket % self._buckets]) if limit else None
+            for window, limit in zip(windows, limits or [None] * len(windows))
+        ]
+        try:
+            shared, refused = await asyncio.to_thread(
+                self._persist,
+                [
+                    (scope, subject, metric, bucket, amount, slice_limit)
+                    for (scope, subject), slice_limit in zip(subjects, slice_limits)
+                ],
+            )
+        except Exception:
+            # Quotas stay enforced from memory; only persistence/sharing is degraded.
+            logger.exception(f"Failed to persist quota usage ({metric} {amount:+d})")
+            return None
+        if refused is not None:
+            for window in windows:
+                window.add(metric, -amount, bucket)
+            # Other processes have filled the slice; it holds at least this much.
+            windows[refused].sync(metric, bucket, slice_limits[refused] - amount + 1)
+            return refused
+        for window, value in zip(windows, shared):
+            if value is not None:
+                window.sync(metric, bucket, value)
+        return None
+
+    def _retry_after(self, window: _Window, metric: str, limit: int, now: float) -> float:
+        """Seconds until the oldest slices have slid out far enough to bring usage back
+        under the limit."""
+        n = self._buckets
+        total = window.totals[metric]
+        oldest = window.oldest_used_bucket(metric)
+        if oldest is None:
+            return 0.0
+        for b in range(oldest, window.bucket + 1):
+            total -= window.counts[metric][b % n]
+            if total < limit:
+                # Slice b leaves the window once slice b + n begins.
+                return max(0.0, (b + n) * self._bucket_seconds - now)
+        return self._window_seconds
+
+    async def acquire(self, chat_id, user_id, profile: str | None = None) -> Charge | Denial:
+        """Admits one message from user_id in chat_id, answered by the named assistant
+        profile, charging it to every quota it falls under (see release()), or returns
+        why it can't be admitted (charging nothing)."""
+        now = time.time()
+        subjects = self._subjects(chat_id, user_id, profile)
+        windows = await self._windows_for(subjects, now)
+        for (scope, subject), window in zip(subjects, windows):
+            for metric in METRICS:
+                limit = self._limit(scope, subject, metric)
+                if limit and window.totals[metric] >= limit:
+                    return self._deny(chat_id, user_id, scope, metric, limit, window, now)
+        limits = [self._limit(scope, subject, "messages") for scope, subject in subjects]
+        refused = await self._charge(subjects, windows, "messages", 1, limits)
+        if refused is not None:
+            # Other processes took what this one still saw as free.
+            return self._deny(chat_id, user_id, subjects[refused][0], "messages", limits[refused], windows[refused], now)
+        self._stats["admitted"] += 1
+        return Charge(subjects, windows[0].bucket)
+
+    def _deny(self, chat_id, user_id, scope: str, metric: str, limit: int, window: _Window, now: float) -> Denial:
+        self._stats["denied"] += 1
+        logger.info(f"Quota: refused message from user {user_id} in chat {chat_id} ({scope} {metric} limit)")
+        return Denial(scope, metric, limit, self._retry_after(window, metric, limit, now))
+
+    async def release(self, charge: Charge) -> None:
+        """Refunds an acquire() whose message ended up not being answered, from the slice
+        it was charged to -- unless that has slid out of the window meanwhile."""
+        self._stats["released"] += 1
+        windows = await self._windows_for(charge.subjects, time.time())
+        if charge.bucket <= windows[0].bucket - self._buckets:
+            return
+        await self._charge(charge.subjects, windows, "messages", -1, bucket=charge.bucket)
+
+    async def record_tokens(self, chat_id, user_id, tokens: int | None, profile: str | None = None) -> None:
+        """Charges the model tokens an answer cost."""
+        if not tokens:
+            return
+        subjects = self._subjects(chat_id, user_id, profile)
+        await self._charge(subjects, await self._windows_for(subjects, time.time()), "tokens", tokens)
+
+    async def usage(self, scope: str, subject) -> dict:
+        """{"messages", "tokens"} used in the current window, with the limits."""
+        subjects = [(scope, str(subject))]
+        (window,) = await self._windows_for(subjects, time.time())
+        return {
+            metric: {"used": window.totals[metric], "limit": self._limit(scope, str(subject), metric)}
+            for metric in METRICS
+        }
+
+    def top(self, scope: str, count: int = 5) -> list[tuple[str, dict]]:
+        """The heaviest subjects of a scope by messages, among those held in memory
+        (i.e. active since this process started, roughly)."""
+        bucket = self._bucket(time.time())
+        ranked = []
+        for (s, subject), window in self._windows.items():
+            if s != scope:
+                continue
+            window.advance(bucket)
+            if window.totals["messages"] or window.totals["tokens"]:
+                ranked.append((subject, dict(window.totals)))
+        ranked.sort(key=lambda item: (item[1]["messages"], item[1]["tokens"]), reverse=True)
+        return ranked[:count]
+
+    @property
+    def window_seconds(self) -> float:
+        return self._window_seconds
+
+    def stats(self) -> dict:
+        return {"tracked": len(self._windows), **self._stats}
+
+
+quotas = QuotaEngine(
+    quota_window_seconds,
+    {
+        "user": {"messages": quota_user_messages, "tokens": quota_user_tokens},
+        "chat": {"messages": quota_chat_messages, "tokens": quota_chat_tokens},
+        # Set per profile, by profiles.init().
+        "profile": {"messages": 0, "tokens": 0},
+        "global": {"messages": quota_global_messages, "tokens": quota_global_tokens},
+    },
+)
+
+
+def format_duration(seconds: float) -> str:
+    """Rough human-readable duration, e.g. "3 hours" or "12 minutes"."""
+    if seconds >= 2 * 60 * 60:
+        return f"{math.ceil(seconds / 3600)} hours"
+    minutes = max(1, math.ceil(seconds / 60))
+    return f"{minutes} minute{'s' if minutes != 1 else ''}"
@@ -0,0 +1,50 @@
+# ratelimit.py
+import time
+
+
+class TokenBucket:
+    """Classic token bucket: holds up to `capacity` tokens, refilled continuously at
+    `rate_per_minute`. A rate of 0 (or less) means unlimited.
+
+    take() is allowed to overdraw the bucket, leaving it in debt that has to be refilled
+    before anything else gets through. That's what lets callers reserve an estimate up
+    front and settle the real cost afterwards with adjust(), and lets a single request
+    bigger than the whole capacity through once the bucket is full instead of never."""
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None):
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.rate_per_second <= 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_second)
+        self._updated = now
+
+    def wait_time(self, amount: float = 1) -> float:
+        """Seconds until `amount` can be taken (0 if it can be taken now)."""
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        needed = min(amount, self.capacity)
+        if self._tokens >= needed:
+            return 0.0
+        return (needed - self._tokens) / self.rate_per_second
+
+    def take(self, amount: float = 1) -> None:
+        if self.unlimited:
+            return
+        self._refill()
+        self._tokens -= amount
+
+    def adjust(self, delta: float) -> None:
+        """Charges `delta` more (or, if negative, refunds) against an earlier take()."""
+        if self.unlimited:
+            return
+        self._refill()
+        self._tokens = min(self.capacity, self._tokens - delta)
@@ -0,0 +1,161 @@
+# redis_storage.py
+# Conversation-state backend over a Redis-compatible server (Redis, Valkey, KeyDB, ...),
+# selected with STORAGE_BACKEND=redis. It has the same interface as SQLiteStorage, but
+# keeps nothing in process memory, so any number of bot processes on any number of
+# machines can serve the same users: whichever one receives a message reads the
+# conversation as the last one left it, and the shared counters are enforced across all.
+#
+# Each conversation is one JSON value (the same state dict SQLiteStorage returns),
+# rewritten on every save and expiring after CONVERSATION_TIMEOUT_SECONDS of inactivity
+# -- by which point handlers.py would start a fresh thread anyway. Histories are bounded
+# by the context budget, so rewriting one is cheap next to the model call that produced
+# the turn. A save is a compare-and-set (WATCH/MULTI) on the updated_at the caller read,
+# so two processes answering the same conversation can't overwrite each other's turns.
+# Counters are updated by a small Lua script, which Redis runs atomically.
+#
+# Requires the optional redis package (pip install redis). For local development, point
+# REDIS_URL at any local Redis-compatible server, or pass an in-process stand-in such as
+# fakeredis.FakeRedis(decode_responses=True) to RedisStorage directly.
+import json
+import logging
+import math
+
+from .config import conversation_timeout_seconds
+from .storage import _new_state
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1] = counter, ARGV = amount, limit ("" = none), ttl seconds ("" = none).
+# Returns the new value, or nil (-> None) if the limit would be exceeded.
+_INCREMENT_COUNTER_SCRIPT = """
+local amount = tonumber(ARGV[1])
+if ARGV[2] ~= '' then
+    local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+    if current + amount > tonumber(ARGV[2]) then
+        return false
+    end
+end
+local value = redis.call('INCRBY', KEYS[1], amount)
+if ARGV[3] ~= '' and redis.call('TTL', KEYS[1]) == -1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+return value
+"""
+
+
+class RedisStorage:
+    """Shared conversation-state backend. Methods block on the network, so call them via
+    asyncio.to_thread from async code, like SQLiteStorage's."""
+
+    def __init__(self, client, key_prefix: str = ""):
+        """`client` is a redis.Redis (or compatible) client created with
+        decode_responses=True."""
+        self._client = client
+        self._prefix = key_prefix
+        self.writes_behind = False  # save_history waits on the server
+        self._ttl_seconds = max(1, math.ceil(conversation_timeout_seconds))
+        self._increment = None
+        self._stats = {"reads": 0, "read_misses": 0, "writes": 0, "conflicts": 0}
+
+    @classmethod
+    def from_url(cls, url: str, key_prefix: str = "") -> "RedisStorage":
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("STORAGE_BACKEND=redis requires the redis package (pip install redis)") from e
+        return cls(redis.Redis.from_url(url, decode_responses=True), key_prefix)
+
+    def _conversation_key(self, conversation_key: str) -> str:
+        return f"{self._prefix}conversation:{conversation_key}"
+
+    def _counter_key(self, key: str) -> str:
+        return f"{self._prefix}counter:{key}"
+
+    def init_db(self):
+        """Checks the server is reachable and loads the counter script. Call once at
+        startup."""
+        self._client.ping()
+        self._increment = self._client.register_script(_INCREMENT_COUNTER_SCRIPT)
+
+    def close(self):
+        logger.info(f"Redis storage: {self._stats}")
+        self._client.close()
+
+    def write_queue_stats(self) -> dict:
+        """Writes go straight to the server; there's no queue."""
+        return {"queue_depth": 0, "flushed_rows": self._stats["writes"]}
+
+    def cache_stats(self) -> dict:
+        """Reads and reads that found nothing (there's no local cache to hit)."""
+        return {"entries": 0, "hits": 0, "misses": self._stats["read_misses"], "reads": self._stats["reads"]}
+
+    def get_conversation_state(self, conversation_key: str) -> dict | None:
+        """See SQLiteStorage.get_conversation_state."""
+        self._stats["reads"] += 1
+        raw = self._client.get(self._conversation_key(conversation_key))
+        if raw is None:
+            self._stats["read_misses"] += 1
+            return None
+        return json.loads(raw)
+
+    def save_history(
+        self,
+        conversation_key: str,
+        history: list[dict],
+        chain: dict | None = None,
+        summary: dict | None = None,
+        *,
+        expected_updated_at: str | None,
+    ) -> bool:
+        """See SQLiteStorage.save_history. Written before returning; False, writing
+        nothing, if the conversation was saved by someone else since
+        expected_updated_at."""
+        from redis.exceptions import WatchError
+
+        write = _new_state(history, chain, summary)
+        name = self._conversation_key(conversation_key)
+        with self._client.pipeline() as pipe:
+            try:
+                pipe.watch(name)
+                raw = pipe.get(name)
+                if (json.loads(raw)["updated_at"] if raw is not None else None) != expected_updated_at:
+                    pipe.unwatch()
+                    self._stats["conflicts"] += 1
+                    return False
+                pipe.multi()
+                pipe.set(name, json.dumps(write.state, ensure_ascii=False), ex=self._ttl_seconds)
+                pipe.execute()
+            except WatchError:
+                # Written by someone else between the check and the SET.
+                self._stats["conflicts"] += 1
+                return False
+        self._stats["writes"] += 1
+        return True
+
+    def incr_counter(
+        self, key: str, amount: int = 1, ttl_seconds: float | None = None, limit: int | None = None
+    ) -> int | None:
+        """See SQLiteStorage.incr_counter."""
+        if limit is not None and amount > limit:
+            return None
+        value = self._increment(
+            keys=[self._counter_key(key)],
+            args=[
+                amount,
+                "" if limit is None else limit,
+                "" if ttl_seconds is None else max(1, math.ceil(ttl_seconds)),
+            ],
+        )
+        return None if value is None else int(value)
+
+    def get_counter(self, key: str) -> int:
+        """See SQLiteStorage.get_counter."""
+        value = self._client.get(self._counter_key(key))
+        return int(value) if value is not None else 0
+
+    def get_counters(self, keys: list[str]) -> list[int]:
+        """See SQLiteStorage.get_counters."""
+        if not keys:
+            return []
+        values = self._client.mget([self._counter_key(key) for key in keys])
+        return [int(value) if value is not None else 0 for value in values]
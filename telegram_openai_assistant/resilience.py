@@ -0,0 +1,214 @@
+# resilience.py
+# Keeps a slow or failing OpenAI from holding every user hostage. With only the SDK's
+# fixed 60s timeout and two retries, an outage meant each user waited up to three
+# minutes for an apology, while new messages kept piling more requests onto it. Model
+# calls for answers now go through `guard`, which adds:
+#   - adaptive deadlines: a multiple of the recent p99 latency (of the whole answer, or
+#     of the first token when streaming), kept between OPENAI_TIMEOUT_MIN_SECONDS and
+#     OPENAI_TIMEOUT_MAX_SECONDS, so a call that is clearly stuck is given up on in
+#     seconds rather than a minute;
+#   - optional hedging (OPENAI_HEDGE_REQUESTS): a call still running at the recent p95
+#     gets an identical second request, and whichever answers first is used -- trading
+#     a few duplicate calls for a much shorter tail;
+#   - a circuit breaker: once CIRCUIT_BREAKER_ERROR_RATE of the recent calls have failed,
+#     calls stop for CIRCUIT_BREAKER_COOLDOWN_SECONDS and callers answer from the answer
+#     cache or apologize straight away; then one trial call is let through, and its
+#     outcome closes the circuit again or restarts the cooldown.
+import asyncio
+import logging
+import time
+from collections import deque
+
+from .config import (
+    circuit_breaker_cooldown_seconds,
+    circuit_breaker_error_rate,
+    openai_hedge_requests,
+    openai_timeout_max_seconds,
+    openai_timeout_min_seconds,
+)
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Latencies of recent successful calls, per kind, that deadlines are derived from.
+LATENCY_WINDOW = 200
+# Below this many samples the deadline is the maximum, and there's no hedging.
+MIN_LATENCY_SAMPLES = 20
+# Deadline = this many times the recent p99. Generous: it's meant to catch calls that
+# are stuck, not ones on the slow side of normal.
+TIMEOUT_P99_MULTIPLIER = 3.0
+# The breaker judges the error rate over this many recent calls, once it has at least
+# BREAKER_MIN_CALLS of them.
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 10
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+TRANSITIONS = registry.counter(
+    "bot_circuit_transitions_total",
+    "Circuit breaker state changes, by breaker (model, or router for its classifier) and new state",
+    ("breaker", "state"),
+)
+HEDGES = registry.counter(
+    "bot_model_hedges_total", "Hedged model requests: sent, and won (answered before the original)", ("outcome",)
+)
+
+
+class LatencyTracker:
+    def __init__(self, window: int):
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> float | None:
+        """The q-quantile of the recent samples, or None if there are too few yet."""
+        if len(self._samples) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    def __init__(self, error_rate: float, cooldown_seconds: float, window: int, min_calls: int, name: str = "model"):
+        self._name = name
+        self._error_rate = error_rate
+        self._cooldown_seconds = cooldown_seconds
+        self._min_calls = min_calls
+        self._outcomes: deque[bool] = deque(maxlen=window)  # True = failed
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._stats = {"rejected": 0, "opened": 0}
+
+    def _transition(self, state: str) -> None:
+        logger.warning(f"Circuit breaker ({self._name}): {self.state} -> {state}")
+        self.state = state
+        TRANSITIONS.inc(breaker=self._name, state=state)
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+            self._stats["opened"] += 1
+        self._outcomes.clear()
+        self._probing = False
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead now. Every allowed call must be followed by a
+        record()."""
+        if self.state == OPEN and time.monotonic() - self._opened_at >= self._cooldown_seconds:
+            self._transition(HALF_OPEN)
+        if self.state == CLOSED or (self.state == HALF_OPEN and not self._probing):
+            self._probing = self.state == HALF_OPEN
+            return True
+        self._stats["rejected"] += 1
+        return False
+
+    def record(self, failed: bool | None) -> None:
+        """The outcome of an allowed call: failed True/False, or None if it says nothing
+        about the service's health (e.g. a request it rejected as invalid)."""
+        if self.state == HALF_OPEN:
+            if failed is None:
+                self._probing = False  # let another call try
+            else:
+                self._transition(OPEN if failed else CLOSED)
+            return
+        if self.state == OPEN or failed is None or self._error_rate <= 0:
+            return
+        self._outcomes.append(failed)
+        if len(self._outcomes) >= self._min_calls and sum(self._outcomes) >= self._error_rate * len(self._outcomes):
+            self._transition(OPEN)
+
+    def stats(self) -> dict:
+        return {"open": int(self.state != CLOSED), "half_open": int(self.state == HALF_OPEN), **self._stats}
+
+
+def _retrieve_exception(task: asyncio.Task) -> None:
+    if not task.cancelled():
+        task.exception()
+
+
+class ModelGuard:
+    def __init__(self, min_timeout: float, max_timeout: float, hedge: bool, breaker: CircuitBreaker):
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+        self._hedge = hedge
+        self._breaker = breaker
+        # "answer" (whole non-streamed calls), "first_token" (streamed ones) or "route"
+        # (router.py's classifier, a much smaller call).
+        self._latency = {kind: LatencyTracker(LATENCY_WINDOW) for kind in ("answer", "first_token", "route")}
+        self._stats = {"timeouts": 0, "hedged": 0, "hedges_won": 0}
+
+    def allow(self) -> bool:
+        return self._breaker.allow()
+
+    def record(self, failed: bool | None) -> None:
+        self._breaker.record(failed)
+
+    def timeout(self, kind: str) -> float:
+        p99 = self._latency[kind].quantile(0.99)
+        if p99 is None:
+            return self._max_timeout
+        return min(self._max_timeout, max(self._min_timeout, p99 * TIMEOUT_P99_MULTIPLIER))
+
+    def _hedge_after(self, kind: str) -> float | None:
+        return self._latency[kind].quantile(0.95) if self._hedge else None
+
+    async def run(self, kind: str, attempt, discard=None):
+        """Returns `await attempt()`, within the kind's deadline (raising TimeoutError
+        past it) and hedged with a second attempt() if enabled. discard is called with
+        the result of a hedged attempt that finished but wasn't used, e.g. to close it."""
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(self._hedged(attempt, self._hedge_after(kind), discard), self.timeout(kind))
+        except TimeoutError:
+            self._stats["timeouts"] += 1
+            raise
+        self._latency[kind].observe(time.perf_counter() - started)
+        return result
+
+    async def _hedged(self, attempt, hedge_after: float | None, discard):
+        if hedge_after is None:
+            return await attempt()
+        original = asyncio.create_task(attempt())
+        tasks = {original}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                HEDGES.inc(outcome="sent")
+                self._stats["hedged"] += 1
+                tasks.add(asyncio.create_task(attempt()))
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                failed = None
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is None:
+                        if task is not original:
+                            HEDGES.inc(outcome="won")
+                            self._stats["hedges_won"] += 1
+                        for other in done - {task}:
+                            if other.exception() is None and discard is not None:
+                                await discard(other.result())
+                        return task.result()
+                    failed = task
+                if not tasks:
+                    raise failed.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+                task.add_done_callback(_retrieve_exception)
+
+    def stats(self) -> dict:
+        return {
+            "timeout_seconds": self.timeout("answer"),
+            "first_token_timeout_seconds": self.timeout("first_token"),
+            **self._stats,
+            **self._breaker.stats(),
+        }
+
+
+guard = ModelGuard(
+    openai_timeout_min_seconds,
+    openai_timeout_max_seconds,
+    openai_hedge_requests,
+    CircuitBreaker(circuit_breaker_error_rate, circuit_breaker_cooldown_seconds, BREAKER_WINDOW, BREAKER_MIN_CALLS),
+)
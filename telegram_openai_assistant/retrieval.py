@@ -0,0 +1,285 @@
+# retrieval.py
+# Local retrieval over the knowledge files, as an alternative to the hosted file_search
+# tool (RETRIEVAL_MODE). file_search costs a tool round trip on every call, and the
+# documents it retrieves are most of each request's input tokens. With a local index,
+# the best few passages for a question are picked here and inlined into the request
+# instead, within a fixed RETRIEVAL_MAX_CHARS budget:
+#   - "local" always does that and never attaches file_search;
+#   - "hybrid" does it for simple questions -- short ones whose terms the local
+#     passages mostly cover -- and leaves everything else to file_search.
+#
+# The index is a JSON file of passages built from a local copy of the files in the
+# vector store (python -m telegram_openai_assistant.build_index <dir>). Passages are
+# ranked with BM25, then boosted by the file priority order the instructions give the
+# model ("prioritize the files in your knowledge by the following order: ..."), so the
+# passages we pick follow the same preference the model would apply to file_search
+# results. Results are cached per normalized question, since the same questions come up
+# again and again and the index only changes on restart.
+import json
+import logging
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from pathlib import Path
+
+from . import profiles
+from .config import (
+    retrieval_index_path,
+    retrieval_max_chars,
+    retrieval_min_coverage,
+    retrieval_mode,
+    retrieval_simple_max_words,
+    retrieval_top_k,
+)
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+# Target passage size when building the index: big enough to hold a complete answer to
+# a narrow question, small enough that RETRIEVAL_MAX_CHARS fits several.
+PASSAGE_CHARS = 1200
+# BM25 parameters (the usual defaults).
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Score multiplier for the highest-priority file, falling linearly to 1.0 for the
+# lowest-priority one (and for files the instructions don't mention).
+PRIORITY_BOOST = 1.5
+# Questions whose retrieval results are kept in memory.
+RETRIEVAL_CACHE_SIZE = 2048
+PASSAGES_PREFIX = (
+    "Excerpts from your knowledge files that are relevant to the next question, most "
+    "relevant first. Base your answer on them, following the file priority in your "
+    "instructions:\n\n"
+)
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have how i if in is it its me my "
+    "of on or should so than that the their then there these they this to was what when "
+    "where which who why will with would you your".split()
+)
+_PRIORITY_RE = re.compile(r"by the following order[^:]*:(.*?)(?:\.\s|\.$)", re.IGNORECASE | re.DOTALL)
+_QUOTED_RE = re.compile(r'"([^"]+)"')
+
+RETRIEVALS = registry.counter(
+    "bot_retrieval_total", "Model calls in local/hybrid retrieval mode, by where their passages came from", ("source",)
+)
+
+
+def _stem(word: str) -> str:
+    # Just enough to match plurals ("breaks" / "break"); the corpus is small and narrow.
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def terms(text: str) -> list[str]:
+    return [_stem(w) for w in _WORD_RE.findall(text.lower()) if w not in _STOPWORDS]
+
+
+def priority_order(instructions: str) -> list[str]:
+    """The file names listed, most favored first, in the instructions' "prioritize the
+    files ... by the following order: "A", "B", ..." sentence (empty if there's none)."""
+    match = _PRIORITY_RE.search(instructions)
+    return _QUOTED_RE.findall(match.group(1)) if match else []
+
+
+def _priority_boost(file_name: str, order: list[str]) -> float:
+    stem = Path(file_name).stem.lower()
+    for rank, name in enumerate(order):
+        name = name.lower()
+        # "2" matches "2.pdf" and "2 - Lecture notes.pdf", but not "20.pdf".
+        if stem == name or (stem.startswith(name) and not stem[len(name)].isalnum()):
+            return 1 + (PRIORITY_BOOST - 1) * (len(order) - rank) / len(order)
+    return 1.0
+
+
+def split_passages(text: str, size: int = PASSAGE_CHARS) -> list[str]:
+    """Packs a document's paragraphs into passages of about `size` characters; a
+    paragraph longer than that is cut between sentences (or, failing that, words)."""
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = " ".join(paragraph.split())
+        while len(paragraph) > size:
+            cut = max(paragraph.rfind(". ", 0, size), paragraph.rfind(" ", 0, size // 2))
+            cut = cut + 1 if cut > 0 else size
+            pieces.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if paragraph:
+            pieces.append(paragraph)
+
+    passages = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + 2 + len(piece) > size:
+            passages.append(current)
+            current = ""
+        current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        passages.append(current)
+    return passages
+
+
+def _read_document(path: Path) -> str:
+    if path.suffix.lower() == ".pdf":
+        try:
+            from pypdf import PdfReader
+        except ImportError as e:
+            raise RuntimeError("Indexing PDF files requires the pypdf package (pip install pypdf)") from e
+        return "\n\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+    return path.read_text(encoding="utf-8", errors="replace")
+
+
+def build_index(source_dir, output_path, size: int = PASSAGE_CHARS) -> dict:
+    """Indexes every .txt, .md and .pdf file under source_dir into output_path. Returns
+    {file name: passage count}."""
+    source_dir = Path(source_dir)
+    passages = []
+    counts = {}
+    for path in sorted(source_dir.rglob("*")):
+        if not path.is_file() or path.suffix.lower() not in (".txt", ".md", ".pdf"):
+            continue
+        name = str(path.relative_to(source_dir))
+        document_passages = split_passages(_read_document(path), size)
+        passages.extend({"file": name, "text": text} for text in document_passages)
+        counts[name] = len(document_passages)
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump({"version": INDEX_VERSION, "built_at": time.time(), "passages": passages}, file, ensure_ascii=False)
+    tmp_path.replace(output_path)
+    return counts
+
+
+class Retrieved:
+    """The passages picked for a question, and how well they cover its terms (0-1)."""
+
+    __slots__ = ("passages", "coverage")
+
+    def __init__(self, passages: list[dict], coverage: float):
+        self.passages = passages
+        self.coverage = coverage
+
+    def as_message(self) -> dict:
+        """The passages as an input message to place before the question."""
+        blocks = [f"[{p['file']}]\n{p['text']}" for p in self.passages]
+        return {"role": "developer", "content": PASSAGES_PREFIX + "\n\n---\n\n".join(blocks)}
+
+
+class LocalIndex:
+    """BM25 over the passages of an index file built by build_index()."""
+
+    def __init__(self, passages: list[dict], order: list[str], top_k: int, max_chars: int):
+        self._passages = passages
+        self._top_k = top_k
+        self._max_chars = max_chars
+        self._boosts = [_priority_boost(p["file"], order) for p in passages]
+        self._lengths = []
+        # term -> [(passage index, term frequency)]
+        self._postings: dict[str, list[tuple[int, int]]] = {}
+        for i, passage in enumerate(passages):
+            counts = Counter(terms(passage["text"]))
+            self._lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                self._postings.setdefault(term, []).append((i, count))
+        self._average_length = sum(self._lengths) / len(passages) if passages else 0.0
+        # search() runs in asyncio.to_thread workers, so the cache is shared between
+        # threads; the scoring itself only reads the index and needs no lock.
+        self._cache_lock = threading.Lock()
+        self._cache: OrderedDict[str, Retrieved] = OrderedDict()
+        self._stats = {"passages": len(passages), "searches": 0, "cache_hits": 0}
+
+    @classmethod
+    def load(cls, path, order: list[str], top_k: int, max_chars: int) -> "LocalIndex":
+        with open(path, encoding="utf-8") as file:
+            index = json.load(file)
+        if index.get("version") != INDEX_VERSION:
+            raise RuntimeError(f"{path} is an index of version {index.get('version')}; rebuild it")
+        return cls(index["passages"], order, top_k, max_chars)
+
+    def _idf(self, term: str) -> float:
+        n = len(self._passages)
+        df = len(self._postings.get(term, ()))
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def search(self, question: str) -> Retrieved:
+        """The best passages for question, up to top_k and max_chars in total."""
+        query = list(dict.fromkeys(terms(question)))
+        key = " ".join(query)
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self._stats["cache_hits"] += 1
+                return cached
+            self._stats["searches"] += 1
+
+        scores: dict[int, float] = {}
+        for term in query:
+            idf = self._idf(term)
+            for i, tf in self._postings.get(term, ()):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[i] / self._average_length)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = sorted(scores, key=lambda i: scores[i] * self._boosts[i], reverse=True)
+
+        picked = []
+        used = 0
+        for i in ranked[: self._top_k]:
+            passage = self._passages[i]
+            if used + len(passage["text"]) > self._max_chars and picked:
+                break
+            picked.append(passage)
+            used += len(passage["text"])
+        found = {t for p in picked for t in terms(p["text"])}
+        result = Retrieved(picked, sum(t in found for t in query) / len(query) if query else 0.0)
+
+        with self._cache_lock:
+            self._cache[key] = result
+            while len(self._cache) > RETRIEVAL_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
+    def known_fraction(self, question: str) -> float:
+        """The fraction of question's terms that occur anywhere in the index (1.0 if it
+        has none)."""
+        query = set(terms(question))
+        return sum(t in self._postings for t in query) / len(query) if query else 1.0
+
+    def stats(self) -> dict:
+        return {"cached": len(self._cache), **self._stats}
+
+
+index: LocalIndex | None = None
+
+
+def init() -> None:
+    """Loads the local index if RETRIEVAL_MODE uses it. Call once at startup, after
+    profiles.init()."""
+    global index
+    if retrieval_mode == "hosted":
+        return
+    if not Path(retrieval_index_path).exists():
+        raise RuntimeError(
+            f"RETRIEVAL_MODE={retrieval_mode} needs an index at {retrieval_index_path}; build one with "
+            "python -m telegram_openai_assistant.build_index <directory of knowledge files>"
+        )
+    # The index holds the default profile's knowledge files; only it uses the index.
+    order = priority_order(profiles.default.instructions)
+    index = LocalIndex.load(retrieval_index_path, order, retrieval_top_k, retrieval_max_chars)
+    logger.info(f"Loaded {index.stats()['passages']} passages for {retrieval_mode} retrieval (file priority: {order})")
+
+
+def for_question(question: str) -> Retrieved | None:
+    """Passages to inline for question, or None to use file_search instead. Needs the
+    index loaded (init()); runs BM25 on a cache miss, so call it via asyncio.to_thread."""
+    retrieved = index.search(question)
+    if retrieval_mode == "hybrid" and (
+        len(question.split()) > retrieval_simple_max_words or retrieved.coverage < retrieval_min_coverage
+    ):
+        RETRIEVALS.inc(source="file_search")
+        return None
+    RETRIEVALS.inc(source="local")
+    return retrieved
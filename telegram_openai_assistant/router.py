@@ -0,0 +1,207 @@
+# router.py
+# Decides, before the model is called, whether a message needs the model at all. A
+# greeting, a "thanks" or a question that has nothing to do with the assistant's subject
+# used to cost the same full call -- with file_search -- as a real clinical question,
+# only for the model to say hello, you're welcome, or (as its instructions tell it) that
+# it can't answer. Now, in order of cost:
+#   - local rules answer messages made up only of greeting or thanks words with the
+#     profile's canned reply;
+#   - for the first question of a conversation, if the local retrieval index is loaded
+#     and none of the question's terms occur anywhere in the knowledge files, the
+#     profile's canned refusal is sent;
+#   - optionally (ROUTER_MODEL), a small model classifies the first questions the rules
+#     couldn't decide, given the assistant's instructions, and anything it calls small
+#     talk or out of scope gets the canned reply too.
+# Everything else goes down the normal path. Follow-up messages are never refused: out
+# of their conversation, a perfectly good follow-up ("and in phakic eyes?") can look
+# off-topic. Routing fails open -- a classifier error or timeout just means the model
+# answers. The classifier is a model call like any other on the same OpenAI account:
+# it waits for an admission slot in the chat's queue (scheduler.py) and gets deadlines
+# like the answers' (resilience.py). It has a circuit breaker of its own, though, so a
+# slow or broken ROUTER_MODEL only ever turns routing off -- never the answers.
+import asyncio
+import logging
+from collections import OrderedDict
+
+from . import openai_client, retrieval
+from .answer_cache import normalize
+from .config import (
+    circuit_breaker_cooldown_seconds,
+    circuit_breaker_error_rate,
+    router_enabled,
+    router_model,
+    router_timeout_seconds,
+)
+from .metrics import registry, stage_timer
+from .profiles import Profile
+from .resilience import BREAKER_MIN_CALLS, BREAKER_WINDOW, CircuitBreaker, guard
+from .scheduler import admission
+from .tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+GREETING, THANKS, OUT_OF_SCOPE, MODEL = "greeting", "thanks", "out_of_scope", "model"
+# A message routed as small talk has at most this many words, all of them from the
+# word lists below, and at least one greeting or thanks word.
+SMALL_TALK_MAX_WORDS = 8
+GREETING_WORDS = frozenset("hi hello hey hiya howdy greetings morning afternoon evening".split())
+THANKS_WORDS = frozenset("thanks thank thx ty cheers appreciated appreciate".split())
+_FILLER_WORDS = frozenset(
+    "good there all everyone you so very much many a lot again great ok okay cool perfect awesome "
+    "nice got it that helps helped helpful bot doctor dr".split()
+)
+# The index rule only judges questions with at least this many terms; a one-word
+# question that happens to miss the index is more likely a typo than off-topic.
+INDEX_MIN_TERMS = 2
+# Classifier verdicts kept in memory, per profile and normalized question.
+CLASSIFIER_CACHE_SIZE = 2048
+CLASSIFIER_INSTRUCTIONS = """You triage messages sent to an assistant, before the assistant sees them. The assistant's own instructions are given below. Reply with exactly one word:
+- "question" if the message asks for anything the assistant's instructions cover, or might cover;
+- "out_of_scope" if it is clearly about something the assistant's instructions don't cover;
+- "greeting" if it is only a greeting, with nothing to answer;
+- "thanks" if it is only thanks or an acknowledgement, with nothing to answer.
+If in any doubt, reply "question".
+
+The assistant's instructions:
+
+"""
+_CLASSES = (GREETING, THANKS, OUT_OF_SCOPE, "question")
+
+ROUTES = registry.counter(
+    "bot_router_decisions_total",
+    "Messages by assistant profile, route (greeting, thanks, out_of_scope, model) and what decided it",
+    ("profile", "route", "source"),
+)
+SAVED_TOKENS = registry.counter(
+    "bot_router_saved_tokens_total",
+    "Model tokens saved by routed messages, estimated at the average model answer's",
+    ("profile",),
+)
+CLASSIFIER_TOKENS = registry.counter(
+    "bot_router_classifier_tokens_total", "Tokens spent by the ROUTER_MODEL classifier", ("profile",)
+)
+
+
+def small_talk(text: str) -> str | None:
+    """GREETING or THANKS if text is nothing but a greeting or thanks, else None."""
+    words = normalize(text).split()
+    if not words or len(words) > SMALL_TALK_MAX_WORDS:
+        return None
+    if not all(w in GREETING_WORDS or w in THANKS_WORDS or w in _FILLER_WORDS for w in words):
+        return None
+    if any(w in THANKS_WORDS for w in words):
+        return THANKS
+    if any(w in GREETING_WORDS for w in words):
+        return GREETING
+    return None
+
+
+class Router:
+    def __init__(self, enabled: bool, classifier_model: str, classifier_timeout: float):
+        self._enabled = enabled
+        self._classifier_model = classifier_model
+        self._classifier_timeout = classifier_timeout
+        self._breaker = CircuitBreaker(
+            circuit_breaker_error_rate, circuit_breaker_cooldown_seconds, BREAKER_WINDOW, BREAKER_MIN_CALLS, "router"
+        )
+        # (profile name, normalized question) -> class, least recently used first.
+        self._verdicts: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self._stats = {
+            "routed": 0,
+            "classifier_calls": 0,
+            "classifier_cache_hits": 0,
+            "classifier_errors": 0,
+            "classifier_tokens": 0,
+            "saved_tokens": 0,
+        }
+
+    def _out_of_index(self, text: str, profile: Profile) -> bool:
+        if retrieval.index is None or not profile.local_retrieval:
+            return False
+        if len(set(retrieval.terms(text))) < INDEX_MIN_TERMS:
+            return False
+        return retrieval.index.known_fraction(text) == 0
+
+    async def _classify(self, text: str, profile: Profile, chat_id) -> str | None:
+        """The classifier's verdict on text (one of _CLASSES), or None if it couldn't
+        give one."""
+        key = (profile.name, normalize(text))
+        verdict = self._verdicts.get(key)
+        if verdict is not None:
+            self._verdicts.move_to_end(key)
+            self._stats["classifier_cache_hits"] += 1
+            return verdict
+        if not self._breaker.allow():
+            return None
+        self._stats["classifier_calls"] += 1
+        instructions = CLASSIFIER_INSTRUCTIONS + profile.instructions
+        failed = None
+        try:
+            async with admission.slot(chat_id, estimate_tokens(instructions) + estimate_tokens(text)) as slot:
+                with stage_timer("route"):
+                    response = await asyncio.wait_for(
+                        guard.run(
+                            "route",
+                            lambda: openai_client.client.responses.create(
+                                model=self._classifier_model, instructions=instructions, input=text
+                            ),
+                        ),
+                        self._classifier_timeout,
+                    )
+                tokens = response.usage.total_tokens if response.usage is not None else 0
+                slot.record_tokens(tokens)
+            failed = False
+        except openai_client.MODEL_ERRORS as e:
+            failed = openai_client.is_service_failure(e)
+            self._stats["classifier_errors"] += 1
+            logger.warning(f"Routing classifier failed, leaving the message to the model: {e!r}")
+            return None
+        finally:
+            self._breaker.record(failed)
+        self._stats["classifier_tokens"] += tokens
+        CLASSIFIER_TOKENS.inc(tokens, profile=profile.name)
+        answer = response.output_text.strip().strip('".').lower()
+        verdict = answer if answer in _CLASSES else "question"
+        self._verdicts[key] = verdict
+        while len(self._verdicts) > CLASSIFIER_CACHE_SIZE:
+            self._verdicts.popitem(last=False)
+        return verdict
+
+    async def route(
+        self, text: str, profile: Profile, first_turn: bool, chat_id
+    ) -> openai_client.ResponseResult | None:
+        """The canned reply to text, sent in chat_id, if it doesn't need the model, else
+        None. first_turn says whether text starts a conversation; only then can it be
+        refused as out of scope."""
+        if not self._enabled:
+            return None
+        source = "rule"
+        route = small_talk(text)
+        if route is None and first_turn:
+            if self._out_of_index(text, profile):
+                route, source = OUT_OF_SCOPE, "index"
+            elif self._classifier_model:
+                verdict = await self._classify(text, profile, chat_id)
+                if verdict in (GREETING, THANKS, OUT_OF_SCOPE):
+                    route, source = verdict, "classifier"
+        if route is None:
+            ROUTES.inc(profile=profile.name, route=MODEL, source="none")
+            return None
+
+        ROUTES.inc(profile=profile.name, route=route, source=source)
+        self._stats["routed"] += 1
+        answers = openai_client.MODEL_REQUESTS.value(profile=profile.name, outcome="model")
+        if answers:
+            saved = openai_client.MODEL_TOKENS.value(profile=profile.name, kind="total") / answers
+            SAVED_TOKENS.inc(saved, profile=profile.name)
+            self._stats["saved_tokens"] += saved
+        logger.info(f"Routed {text!r} as {route} ({source}), no model call")
+        reply = {GREETING: profile.greeting_reply, THANKS: profile.thanks_reply}.get(route, profile.out_of_scope_reply)
+        return openai_client.ResponseResult(reply, None, route=route)
+
+    def stats(self) -> dict:
+        breaker = {f"breaker_{name}": value for name, value in self._breaker.stats().items()}
+        return {"classifier_cached": len(self._verdicts), **self._stats, **breaker}
+
+
+router = Router(router_enabled, router_model, router_timeout_seconds)
@@ -0,0 +1,168 @@
+# scheduler.py
+# Admission control for model calls. Without it, a busy group can launch dozens of
+# requests at once, trip the API's rate limit, and leave every user -- not just that
+# group -- with an error. Instead, requests wait here for:
+#   - a free slot (at most OPENAI_MAX_CONCURRENCY in flight),
+#   - the requests-per-minute and tokens-per-minute budgets (token buckets, with the
+#     tokens budget charged by each response's real total_tokens once it's known),
+# and are admitted round-robin across chats rather than first-come-first-served, so a
+# chat with a long backlog gets one turn per round like everyone else instead of
+# starving private users queued behind it.
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from .config import (
+    openai_max_concurrency,
+    openai_requests_per_minute,
+    openai_tokens_per_minute,
+    queue_notice_after_seconds,
+)
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class _Waiter:
+    __slots__ = ("chat_id", "tokens", "future", "enqueued_at")
+
+    def __init__(self, chat_id, tokens: int, future: asyncio.Future):
+        self.chat_id = chat_id
+        self.tokens = tokens
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class Slot:
+    """Handed out by AdmissionController.slot(); report the call's real token usage on it
+    so the tokens-per-minute budget reflects what was actually spent."""
+
+    def __init__(self, controller: "AdmissionController", reserved_tokens: int):
+        self._controller = controller
+        self._reserved_tokens = reserved_tokens
+        self.waited_seconds = 0.0
+
+    def record_tokens(self, total_tokens: int | None) -> None:
+        """Settles the reservation against the actual usage (None/0 for calls that didn't
+        reach the model, e.g. cache hits or errors, which refunds it)."""
+        self._controller._token_bucket.adjust((total_tokens or 0) - self._reserved_tokens)
+        self._reserved_tokens = total_tokens or 0
+
+
+class AdmissionController:
+    def __init__(self, max_concurrency: int, requests_per_minute: float, tokens_per_minute: float,
+                 notice_after_seconds: float):
+        self._max_concurrency = max(1, max_concurrency)
+        self._request_bucket = TokenBucket(requests_per_minute)
+        self._token_bucket = TokenBucket(tokens_per_minute)
+        self._notice_after_seconds = notice_after_seconds
+        self._active = 0
+        # chat_id -> its waiters in arrival order. Dict order is the round-robin order:
+        # the chat at the front is admitted next, then moves to the back.
+        self._queues: OrderedDict = OrderedDict()
+        self._wakeup: asyncio.TimerHandle | None = None
+        self._stats = {"admitted": 0, "queued": 0, "notices": 0, "max_wait_seconds": 0.0}
+
+    def _queued_count(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def position(self, waiter: _Waiter) -> int:
+        """1-based position the waiter will (roughly) be admitted at, given round-robin
+        order: every chat ahead of it in the rotation gets one more turn than it does."""
+        queue = self._queues.get(waiter.chat_id)
+        if queue is None or waiter not in queue:
+            return 0
+        index = queue.index(waiter)
+        ahead = 0
+        before_own_chat = True
+        for chat_id, other in self._queues.items():
+            if chat_id == waiter.chat_id:
+                before_own_chat = False
+                continue
+            ahead += min(len(other), index + (1 if before_own_chat else 0))
+        return ahead + index + 1
+
+    def _dispatch(self) -> None:
+        self._wakeup = None
+        while self._active < self._max_concurrency and self._queues:
+            chat_id, queue = next(iter(self._queues.items()))
+            waiter = queue[0]
+            wait = max(self._request_bucket.wait_time(1), self._token_bucket.wait_time(waiter.tokens))
+            if wait > 0:
+                self._wakeup = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            queue.popleft()
+            if queue:
+                self._queues.move_to_end(chat_id)
+            else:
+                del self._queues[chat_id]
+            self._request_bucket.take(1)
+            self._token_bucket.take(waiter.tokens)
+            self._active += 1
+            self._stats["admitted"] += 1
+            waited = time.monotonic() - waiter.enqueued_at
+            self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], waited)
+            waiter.future.set_result(waited)
+
+    def _remove(self, waiter: _Waiter) -> None:
+        queue = self._queues.get(waiter.chat_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[waiter.chat_id]
+
+    def _release(self) -> None:
+        self._active -= 1
+        if self._wakeup is None:
+            self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, chat_id, estimated_tokens: int, on_queued=None):
+        """Waits for admission, then holds a concurrency slot for the duration of the
+        block. estimated_tokens is reserved from the tokens-per-minute budget up front;
+        call record_tokens() on the yielded Slot to settle it. If the wait passes
+        QUEUE_NOTICE_AFTER_SECONDS, `await on_queued(position)` is called once so the
+        user can be told they're waiting."""
+        waiter = _Waiter(chat_id, estimated_tokens, asyncio.get_running_loop().create_future())
+        self._queues.setdefault(chat_id, deque()).append(waiter)
+        if self._wakeup is None:
+            self._dispatch()
+        try:
+            if not waiter.future.done():
+                self._stats["queued"] += 1
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self._notice_after_seconds)
+                except asyncio.TimeoutError:
+                    if on_queued is not None:
+                        self._stats["notices"] += 1
+                        await on_queued(self.position(waiter))
+                    await waiter.future
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release()  # admitted just as we were cancelled
+            else:
+                waiter.future.cancel()
+                self._remove(waiter)
+            raise
+
+        slot = Slot(self, estimated_tokens)
+        slot.waited_seconds = waiter.future.result()
+        if slot.waited_seconds >= 1:
+            logger.info(f"Chat {chat_id} waited {slot.waited_seconds:.1f}s for a model slot")
+        try:
+            yield slot
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        return {"active": self._active, "queue_depth": self._queued_count(), **self._stats}
+
+
+admission = AdmissionController(
+    openai_max_concurrency,
+    openai_requests_per_minute,
+    openai_tokens_per_minute,
+    queue_notice_after_seconds,
+)
@@ -0,0 +1,206 @@
+# sender.py
+# Outbound Bot API calls that post to a chat (sending, editing and deleting messages).
+# Telegram throttles bots that post too fast -- about 30 messages a second overall, one
+# a second per chat, 20 a minute per group -- by refusing requests with a RetryAfter
+# ("flood control") error. A long reply in a busy group used to run straight into that
+# and fail half-sent. Every call here instead:
+#   - waits for the global and the chat's token bucket (TELEGRAM_MESSAGES_PER_SECOND,
+#     TELEGRAM_CHAT_MESSAGES_PER_MINUTE / TELEGRAM_GROUP_MESSAGES_PER_MINUTE), so we
+#     stay under the limits rather than finding them,
+#   - goes through the chat's FIFO lock, so calls to one chat happen in the order they
+#     were made while different chats proceed in parallel, and the chunks of one reply
+#     (send_chunks) arrive back to back instead of interleaved with another reply,
+#   - retries a RetryAfter after the time Telegram asks for, and a dropped connection
+#     with exponential backoff (not a timeout: the message may well have been sent),
+#   - records its latency, rate-limit wait included, under bot_stage_seconds.
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+from .config import (
+    telegram_chat_messages_per_minute,
+    telegram_group_messages_per_minute,
+    telegram_messages_per_second,
+)
+from .metrics import STAGE_SECONDS, registry
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Messages a chat can send back to back before its rate applies, e.g. the first few
+# chunks of a long reply. Small, since Telegram's per-chat flood control is strict.
+CHAT_BURST = 3
+# Attempts per call, including the first.
+MAX_ATTEMPTS = 4
+# A RetryAfter longer than this isn't waited out -- the chat is better off with an error
+# than with a reply that arrives minutes later.
+MAX_RETRY_AFTER_SECONDS = 60
+# First backoff after a connection error; doubles per attempt, with jitter.
+NETWORK_BACKOFF_SECONDS = 0.5
+# Chats whose rate state is kept; the least recently used idle ones are dropped.
+MAX_TRACKED_CHATS = 10_000
+
+SENDS = registry.counter(
+    "bot_telegram_calls_total", "Bot API calls posting to a chat, by method and outcome", ("method", "outcome")
+)
+
+
+def _seconds(retry_after) -> float:
+    # An int in python-telegram-bot 21, a timedelta in later versions.
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+class _ChatState:
+    __slots__ = ("bucket", "lock", "users")
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.lock = asyncio.Lock()
+        self.users = 0  # calls currently holding or waiting on the lock
+
+
+class TelegramSender:
+    def __init__(self, messages_per_second: float, chat_messages_per_minute: float,
+                 group_messages_per_minute: float):
+        self._global = TokenBucket(messages_per_second * 60, capacity=max(1.0, messages_per_second))
+        self._chat_rate = chat_messages_per_minute
+        self._group_rate = group_messages_per_minute
+        # chat_id -> _ChatState, least recently used first.
+        self._chats: OrderedDict = OrderedDict()
+        self._stats = {"calls": 0, "rate_limited": 0, "flood_waits": 0, "retries": 0, "failures": 0}
+
+    def _chat_state(self, chat_id) -> _ChatState:
+        state = self._chats.get(chat_id)
+        if state is None:
+            # Group and channel ids are negative.
+            rate = self._group_rate if chat_id < 0 else self._chat_rate
+            state = self._chats[chat_id] = _ChatState(TokenBucket(rate, capacity=min(CHAT_BURST, rate) or None))
+            while len(self._chats) > MAX_TRACKED_CHATS:
+                oldest_id, oldest = next(iter(self._chats.items()))
+                if oldest.users:
+                    break
+                del self._chats[oldest_id]
+        self._chats.move_to_end(chat_id)
+        return state
+
+    @asynccontextmanager
+    async def _chat(self, chat_id):
+        """Holds the chat's lock; calls to the chat made meanwhile wait their turn."""
+        state = self._chat_state(chat_id)
+        state.users += 1
+        try:
+            async with state.lock:
+                yield state
+        finally:
+            state.users -= 1
+
+    async def _wait_for_rate(self, state: _ChatState) -> None:
+        waited = False
+        while True:
+            wait = max(self._global.wait_time(1), state.bucket.wait_time(1))
+            if wait <= 0:
+                break
+            waited = True
+            await asyncio.sleep(wait)
+        if waited:
+            self._stats["rate_limited"] += 1
+        self._global.take(1)
+        state.bucket.take(1)
+
+    async def _call(self, state: _ChatState, chat_id, method, **kwargs):
+        """One Bot API call, with the chat's lock already held."""
+        name = method.__name__
+        started = time.perf_counter()
+        self._stats["calls"] += 1
+        try:
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                await self._wait_for_rate(state)
+                try:
+                    result = await method(chat_id=chat_id, **kwargs)
+                except RetryAfter as e:
+                    retry_after = _seconds(e.retry_after)
+                    if attempt == MAX_ATTEMPTS or retry_after > MAX_RETRY_AFTER_SECONDS:
+                        raise
+                    self._stats["flood_waits"] += 1
+                    logger.warning(f"Telegram flood control on chat {chat_id}: retrying {name} in {retry_after:.0f}s")
+                    await asyncio.sleep(retry_after)
+                except (BadRequest, TimedOut):
+                    # Both are NetworkErrors too, but retrying won't help a rejected
+                    # request and might duplicate one that timed out after arriving.
+                    raise
+                except NetworkError as e:
+                    if attempt == MAX_ATTEMPTS:
+                        raise
+                    backoff = NETWORK_BACKOFF_SECONDS * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                    logger.warning(f"Telegram {name} to chat {chat_id} failed ({e}); retrying in {backoff:.1f}s")
+                    await asyncio.sleep(backoff)
+                else:
+                    SENDS.inc(method=name, outcome="ok" if attempt == 1 else "retried")
+                    return result
+                self._stats["retries"] += 1
+        except BadRequest:
+            # Usually handled by the caller (HTML rejected, message not modified).
+            SENDS.inc(method=name, outcome="rejected")
+            raise
+        except Exception:
+            self._stats["failures"] += 1
+            SENDS.inc(method=name, outcome="error")
+            raise
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="telegram_send")
+
+    async def call(self, chat_id, method, **kwargs):
+        """`await method(chat_id=chat_id, **kwargs)` (a Bot method like bot.send_message),
+        rate limited, in order and retried as described above."""
+        async with self._chat(chat_id) as state:
+            return await self._call(state, chat_id, method, **kwargs)
+
+    async def _send_html(self, state: _ChatState, bot, chat_id, chunk: str, html_chunk: str):
+        try:
+            return await self._call(state, chat_id, bot.send_message, text=html_chunk, parse_mode=ParseMode.HTML)
+        except BadRequest as e:
+            logger.error(f"Telegram rejected HTML message, falling back to plain text: {e}")
+            return await self._call(state, chat_id, bot.send_message, text=chunk)
+
+    async def send_html(self, bot, chat_id, chunk: str, html_chunk: str):
+        """Sends one rendered chunk (see telegram_markdown.render_chunks), falling back to
+        its plain Markdown if Telegram rejects the HTML. Returns the sent Message."""
+        async with self._chat(chat_id) as state:
+            return await self._send_html(state, bot, chat_id, chunk, html_chunk)
+
+    async def send_chunks(self, bot, chat_id, chunks: list[tuple[str, str]]) -> list:
+        """Sends a reply's rendered chunks in order, with nothing else posted to the chat
+        in between. Returns the sent Messages."""
+        async with self._chat(chat_id) as state:
+            return [await self._send_html(state, bot, chat_id, chunk, html_chunk) for chunk, html_chunk in chunks]
+
+    async def edit_html(self, bot, chat_id, message_id, chunk: str, html_chunk: str) -> None:
+        """Edits a message to show a rendered chunk, falling back to plain Markdown if
+        Telegram rejects the HTML. Editing to the same content is not an error."""
+        async with self._chat(chat_id) as state:
+            try:
+                await self._call(
+                    state, chat_id, bot.edit_message_text, message_id=message_id, text=html_chunk,
+                    parse_mode=ParseMode.HTML,
+                )
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return
+                logger.error(f"Telegram rejected HTML edit, falling back to plain text: {e}")
+                await self._call(state, chat_id, bot.edit_message_text, message_id=message_id, text=chunk)
+
+    def stats(self) -> dict:
+        return {"tracked_chats": len(self._chats), **self._stats}
+
+
+sender = TelegramSender(
+    telegram_messages_per_second,
+    telegram_chat_messages_per_minute,
+    telegram_group_messages_per_minute,
+)
@@ -1,63 +1,713 @@
 # storage.py
-# Persists per-conversation message history (as a JSON list of {"role", "content"} turns)
-# so continuity survives process restarts/redeploys. We manage history ourselves rather
+# Persists per-conversation message history (a list of {"role", "content"} turns) so
+# continuity survives process restarts/redeploys. We manage history ourselves rather
 # than using the Responses API's previous_response_id chaining, because that's an opaque
 # server-side thread we can't selectively trim from -- owning the list lets handlers.py
 # evict the oldest turns (FIFO) once a conversation gets too large, instead of having to
-# wipe it entirely.
+# wipe it entirely. (handlers.py can optionally *also* chain turns server-side via
+# previous_response_id to send less per request -- see RESPONSE_CHAINING -- but this
+# local history stays the source of truth it falls back to.)
+#
+# Each turn is its own row in the turns table, numbered by a per-conversation seq that
+# storage assigns (and hands back as a "seq" key on each history entry). That makes
+# saving a turn a single row insert and FIFO trimming a single range delete, instead of
+# re-serializing and rewriting the whole conversation every time.
+#
+# Writes are write-behind: save_history only records the latest history for a
+# conversation in memory, and a background thread commits everything pending in a single
+# transaction every FLUSH_INTERVAL_SECONDS (or sooner, once FLUSH_MAX_PENDING
+# conversations are waiting). Several saves for the same conversation within one interval
+# collapse into one write. Reads check the pending writes first, so a conversation
+# always sees its own latest turn. The trade-off is that a hard crash can lose up to one
+# interval of turns; a normal shutdown flushes everything via SQLiteStorage.close().
+#
+# In front of all that sits a bounded in-memory LRU of recently active conversations,
+# filled on every save and on every disk read, so the common case -- the same person
+# sending their next message a minute after the last reply -- never touches SQLite or
+# re-reads its turns at all.
+#
+# Alongside conversations, storage keeps shared counters (incr_counter) -- e.g. the bot's
+# daily message count -- which are incremented atomically in the database itself, so
+# they stay correct however many processes are updating them.
+#
+# All of the above is the single-machine SQLite backend. With SQLITE_MULTI_PROCESS, the
+# write-behind queue is bypassed and cached conversations are re-validated on every read,
+# so several processes can share the file. Each save then names the version
+# (updated_at) of the conversation it builds on, and is refused if another process has
+# saved the conversation since -- the caller reloads and tries again, rather than the
+# two silently overwriting each other's turns. For several machines, STORAGE_BACKEND=redis
+# swaps in RedisStorage (redis_storage.py), which offers the same interface.
 import json
+import logging
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timezone
 
-from .config import sqlite_db_path
+from .config import (
+    conversation_timeout_seconds,
+    redis_key_prefix,
+    redis_url,
+    sqlite_db_path,
+    sqlite_multi_process,
+    storage_backend,
+)
 
+logger = logging.getLogger(__name__)
 
-def _needs_migration(conn: sqlite3.Connection) -> bool:
-    cols = {row[1] for row in conn.execute("PRAGMA table_info(conversations)")}
-    return bool(cols) and "history_json" not in cols
+# Bumped (with a matching step in SQLiteStorage._migrate) whenever the schema changes.
+SCHEMA_VERSION = 4
 
+FLUSH_INTERVAL_SECONDS = 0.5
+FLUSH_MAX_PENDING = 64
+# The cache is bounded both ways: by entry count, and by a rough estimate of the memory
+# the cached histories hold, since one long case discussion can outweigh hundreds of
+# short threads.
+CACHE_MAX_ENTRIES = 2000
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Per-turn overhead on top of the content itself (dict, keys, small strings) -- only needs
+# to be in the right ballpark for the byte budget to be meaningful.
+CACHE_TURN_OVERHEAD_BYTES = 200
+# Counters are mostly written once and left to expire (quotas.py keys one per time
+# slice), so expired rows are swept out of the whole table this often.
+COUNTER_PRUNE_INTERVAL_SECONDS = 60
 
-def init_db():
-    """Create the conversations table if it doesn't already exist. Call once at startup.
-    If an older schema (response_id-chained, from before self-managed FIFO history) is
-    found, it's dropped and recreated -- this table only holds resumable session state,
-    not data worth preserving across a schema change."""
-    with sqlite3.connect(sqlite_db_path) as conn:
-        if _needs_migration(conn):
-            conn.execute("DROP TABLE conversations")
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS conversations (
-                conversation_key TEXT PRIMARY KEY,
-                history_json TEXT NOT NULL,
-                updated_at TEXT NOT NULL
-            )
-            """
+
+class _ConversationCache:
+    """LRU of conversation state keyed on conversation_key. Entries whose updated_at is
+    older than ttl_seconds are dropped rather than served: handlers.py would reset such a
+    thread anyway, so there's no point keeping it pinned in memory."""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # key -> (state dict, updated_at epoch seconds, estimated bytes)
+        self._entries: OrderedDict[str, tuple[dict, float, int]] = OrderedDict()
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    @staticmethod
+    def _estimate_bytes(state: dict) -> int:
+        summary = state.get("summary") or {}
+        return len(summary.get("content") or "") + sum(
+            len(m.get("content") or "") + CACHE_TURN_OVERHEAD_BYTES for m in state["history"]
+        )
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry[2]
+
+    def _is_expired(self, updated_ts: float, now: float) -> bool:
+        return now - updated_ts >= self._ttl_seconds
+
+    def get(self, conversation_key: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(conversation_key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            if self._is_expired(entry[1], time.time()):
+                self._drop(conversation_key)
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(conversation_key)
+            self._stats["hits"] += 1
+        return _copy_state(entry[0])
+
+    def put(self, conversation_key: str, state: dict, *, if_newer: bool = False) -> None:
+        """Caches state, replacing any entry for the key. With if_newer (for state read
+        back from disk), an entry saved since the read began is kept instead."""
+        size = self._estimate_bytes(state)
+        updated_ts = datetime.fromisoformat(state["updated_at"]).timestamp()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(conversation_key)
+            if if_newer and entry is not None and entry[1] > updated_ts:
+                return
+            if entry is not None:
+                self._drop(conversation_key)
+            if size > self._max_bytes or self._is_expired(updated_ts, now):
+                return
+            self._entries[conversation_key] = (_copy_state(state), updated_ts, size)
+            self._bytes += size
+            # Least recently used entries sit at the front, and since every save refreshes
+            # an entry, that's also (roughly) where the stalest ones are.
+            while self._entries:
+                oldest_key, oldest = next(iter(self._entries.items()))
+                if self._is_expired(oldest[1], now):
+                    self._stats["expirations"] += 1
+                elif len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                    self._stats["evictions"] += 1
+                else:
+                    break
+                self._drop(oldest_key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, **self._stats}
+
+
+class _PendingWrite:
+    """What a flush needs to bring one conversation's rows up to date: its latest state,
+    which turns in its history haven't been written yet (seq >= first_new_seq), and
+    whether the stored turns must be discarded first because the thread was reset."""
+
+    __slots__ = ("state", "first_new_seq", "replace")
+
+    def __init__(self, state: dict, first_new_seq: int, replace: bool):
+        self.state = state
+        self.first_new_seq = first_new_seq
+        self.replace = replace
+
+    def merged_after(self, older: "_PendingWrite") -> "_PendingWrite":
+        """Folds an older, still-unwritten save for the same conversation into this one."""
+        return _PendingWrite(
+            self.state,
+            min(self.first_new_seq, older.first_new_seq),
+            self.replace or older.replace,
         )
 
 
-def get_conversation_state(conversation_key: str) -> dict | None:
-    """Returns the stored state for a conversation, or None if it has no history yet."""
-    with sqlite3.connect(sqlite_db_path) as conn:
-        row = conn.execute(
-            "SELECT history_json, updated_at FROM conversations WHERE conversation_key = ?",
-            (conversation_key,),
-        ).fetchone()
+class _WriteBehindQueue:
+    """Coalesces history saves per conversation_key and commits them in batches from a
+    single background thread."""
+
+    def __init__(self, write_batch, flush_interval: float, max_pending: int):
+        self._write_batch = write_batch
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # only one batch is ever being written
+        self._pending: dict[str, _PendingWrite] = {}
+        # The batch currently being committed; still visible to readers until it lands.
+        self._in_flight: dict[str, _PendingWrite] = {}
+        self._thread: threading.Thread | None = None
+        self._closed = False
+        self._stats = {
+            "enqueued": 0,
+            "coalesced": 0,
+            "flushes": 0,
+            "flushed_rows": 0,
+            "flush_errors": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    def start(self) -> None:
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, name="storage-writer", daemon=True)
+            self._thread.start()
+
+    def put(self, conversation_key: str, write: _PendingWrite) -> None:
+        with self._cond:
+            older = self._pending.get(conversation_key)
+            if older is not None:
+                write = write.merged_after(older)
+                self._stats["coalesced"] += 1
+            self._pending[conversation_key] = write
+            self._stats["enqueued"] += 1
+            if len(self._pending) >= self._max_pending:
+                self._cond.notify()
+
+    def get(self, conversation_key: str) -> dict | None:
+        with self._cond:
+            entry = self._pending.get(conversation_key) or self._in_flight.get(conversation_key)
+        if entry is None:
+            return None
+        return _copy_state(entry.state)
+
+    def flush(self) -> None:
+        """Commits everything pending right now, on the calling thread."""
+        with self._flush_lock:
+            with self._cond:
+                if not self._pending:
+                    return
+                self._in_flight, self._pending = self._pending, {}
+                batch = self._in_flight
+            started = time.perf_counter()
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                # Anything but a database error is a bug; log where it came from.
+                logger.error(
+                    f"Failed to flush {len(batch)} conversation(s), will retry: {e!r}",
+                    exc_info=not isinstance(e, sqlite3.Error),
+                )
+                with self._cond:
+                    self._stats["flush_errors"] += 1
+                    # Newer saves that arrived meanwhile win over the failed batch.
+                    for key, write in batch.items():
+                        newer = self._pending.get(key)
+                        self._pending[key] = write if newer is None else newer.merged_after(write)
+                    self._in_flight = {}
+                return
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._cond:
+                self._in_flight = {}
+                self._stats["flushes"] += 1
+                self._stats["flushed_rows"] += len(batch)
+                self._stats["last_flush_ms"] = elapsed_ms
+                self._stats["max_flush_ms"] = max(self._stats["max_flush_ms"], elapsed_ms)
+                self._stats["total_flush_ms"] += elapsed_ms
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._closed and len(self._pending) < self._max_pending:
+                    self._cond.wait(timeout=self._flush_interval)
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception:
+                # flush() requeues failed batches itself; this only keeps the writer
+                # alive through anything unexpected outside the write.
+                logger.exception("Conversation writer error")
+            if closed:
+                return
+
+    def close(self) -> None:
+        """Stops the writer thread after a final flush."""
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._closed = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"queue_depth": len(self._pending), **self._stats}
+
+
+class SQLiteStorage:
+    """Conversation-state backend over a single SQLite file.
+
+    Connections are pooled per thread (sqlite3 connections can't be shared across
+    threads, and asyncio.to_thread hands work to a small fixed set of executor threads,
+    so this stays bounded) and kept open for the life of the process, which also lets
+    sqlite3's per-connection statement cache reuse the prepared statements below instead
+    of re-parsing them on every call. The database runs in WAL mode so readers never
+    block on the background writer's transactions, or vice versa."""
+
+    # synchronous=NORMAL is the recommended pairing with WAL: commits no longer fsync,
+    # only checkpoints do, and the database can't be corrupted by a crash -- at worst the
+    # last few commits roll back, which is already the contract of the write-behind queue.
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA cache_size=-16000",  # negative = KiB, so ~16 MB of page cache per connection
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA busy_timeout=5000",
+    )
+    STATEMENT_CACHE_SIZE = 64
+
+    _SELECT_CONVERSATION = """
+        SELECT updated_at, response_id, chain_start_seq, chain_tokens, summary, summary_tokens
+        FROM conversations WHERE conversation_key = ?
+    """
+    _SELECT_TURNS = """
+        SELECT seq, role, content, est_tokens FROM turns
+        WHERE conversation_key = ? ORDER BY seq
+    """
+    _UPSERT_CONVERSATION = """
+        INSERT INTO conversations
+            (conversation_key, updated_at, response_id, chain_start_seq, chain_tokens, summary, summary_tokens)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(conversation_key) DO UPDATE SET
+            updated_at = excluded.updated_at,
+            response_id = excluded.response_id,
+            chain_start_seq = excluded.chain_start_seq,
+            chain_tokens = excluded.chain_tokens,
+            summary = excluded.summary,
+            summary_tokens = excluded.summary_tokens
+    """
+    _SELECT_UPDATED_AT = "SELECT updated_at FROM conversations WHERE conversation_key = ?"
+    _DELETE_ALL_TURNS = "DELETE FROM turns WHERE conversation_key = ?"
+    _DELETE_TURNS_BEFORE = "DELETE FROM turns WHERE conversation_key = ? AND seq < ?"
+    # A failed batch is rolled back before it's retried, so a turn is only ever inserted
+    # once; a clash on the primary key would mean two writers numbered the same turn.
+    _INSERT_TURN = """
+        INSERT INTO turns (conversation_key, seq, role, content, est_tokens)
+        VALUES (?, ?, ?, ?, ?)
+    """
+    _DELETE_EXPIRED_COUNTER = "DELETE FROM counters WHERE key = ? AND expires_at <= ?"
+    _DELETE_EXPIRED_COUNTERS = "DELETE FROM counters WHERE expires_at <= ?"
+    # A single statement, so the check against the limit and the increment can't be
+    # interleaved with another process's. When the limit would be exceeded the WHERE
+    # makes the upsert a no-op and RETURNING yields no row.
+    _INCREMENT_COUNTER = """
+        INSERT INTO counters (key, value, expires_at) VALUES (:key, :amount, :expires_at)
+        ON CONFLICT(key) DO UPDATE SET value = value + excluded.value
+        WHERE :limit IS NULL OR value + excluded.value <= :limit
+        RETURNING value
+    """
+    _SELECT_COUNTER = "SELECT value FROM counters WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)"
+
+    def __init__(self, db_path: str, multi_process: bool = False):
+        self.db_path = db_path
+        self._multi_process = multi_process
+        # save_history only queues the write (no I/O), so async callers needn't hop threads.
+        self.writes_behind = not multi_process
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._write_queue = _WriteBehindQueue(self._write_batch, FLUSH_INTERVAL_SECONDS, FLUSH_MAX_PENDING)
+        self._cache = _ConversationCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, conversation_timeout_seconds)
+        self._next_counter_prune = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                check_same_thread=False,  # only ever used by its own thread, but closed from close()
+                cached_statements=self.STATEMENT_CACHE_SIZE,
+            )
+            for pragma in self.PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def init_db(self):
+        """Create the tables if they don't already exist (migrating an older schema in
+        place) and start the background writer. Call once at startup."""
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < SCHEMA_VERSION:
+                self._migrate(conn, version)
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.execute(self._DELETE_EXPIRED_COUNTERS, (time.time(),))
+        if not self._multi_process:
+            self._write_queue.start()
+
+    @staticmethod
+    def _migrate(conn: sqlite3.Connection, version: int) -> None:
+        """Brings a database at schema `version` up to SCHEMA_VERSION. Runs inside
+        init_db's transaction, so a failed migration leaves the old schema untouched."""
+        if version < 1:
+            cols = {row[1] for row in conn.execute("PRAGMA table_info(conversations)")}
+            legacy = "history_json" in cols
+            if legacy:
+                # Whole-history-as-one-JSON-blob schema: split each blob into turn rows.
+                conn.execute("ALTER TABLE conversations RENAME TO conversations_legacy")
+            elif cols:
+                # Even older response_id-chained schema, from before self-managed FIFO
+                # history. There's nothing in it we can turn back into turns, and it only
+                # ever held resumable session state, so it's simply dropped.
+                conn.execute("DROP TABLE conversations")
+            conn.execute(
+                """
+                CREATE TABLE conversations (
+                    conversation_key TEXT PRIMARY KEY,
+                    updated_at TEXT NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS turns (
+                    conversation_key TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    est_tokens INTEGER,
+                    PRIMARY KEY (conversation_key, seq)
+                ) WITHOUT ROWID
+                """
+            )
+            if legacy:
+                for key, history_json, updated_at in conn.execute(
+                    "SELECT conversation_key, history_json, updated_at FROM conversations_legacy"
+                ).fetchall():
+                    conn.execute(
+                        "INSERT INTO conversations (conversation_key, updated_at) VALUES (?, ?)", (key, updated_at)
+                    )
+                    conn.executemany(
+                        SQLiteStorage._INSERT_TURN,
+                        [(key, seq, m["role"], m["content"], None) for seq, m in enumerate(json.loads(history_json))],
+                    )
+                conn.execute("DROP TABLE conversations_legacy")
+        if version < 2:
+            # Optional previous_response_id chaining (see handlers.get_reply).
+            conn.execute("ALTER TABLE conversations ADD COLUMN response_id TEXT")
+            conn.execute("ALTER TABLE conversations ADD COLUMN chain_start_seq INTEGER")
+            conn.execute("ALTER TABLE conversations ADD COLUMN chain_tokens INTEGER")
+        if version < 3:
+            # Rolling summary of turns compacted out of the history (see handlers._compact).
+            conn.execute("ALTER TABLE conversations ADD COLUMN summary TEXT")
+            conn.execute("ALTER TABLE conversations ADD COLUMN summary_tokens INTEGER")
+        if version < 4:
+            # Shared counters (see incr_counter). expires_at is epoch seconds, NULL = never.
+            conn.execute(
+                """
+                CREATE TABLE counters (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL,
+                    expires_at REAL
+                ) WITHOUT ROWID
+                """
+            )
+
+    def close(self):
+        """Flushes any pending writes, stops the background writer and closes every pooled
+        connection. Call once on exit."""
+        self._write_queue.close()
+        logger.info(f"Storage writer stopped: {self.write_queue_stats()}")
+        logger.info(f"Conversation cache: {self.cache_stats()}")
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    def write_queue_stats(self) -> dict:
+        """Queue depth plus cumulative counters (saves enqueued/coalesced, flushes, rows
+        written, and flush latency in ms) for the write-behind queue."""
+        return self._write_queue.stats()
+
+    def cache_stats(self) -> dict:
+        """Entry count, estimated bytes held, and hit/miss/eviction/expiration counters for
+        the in-memory conversation cache."""
+        return self._cache.stats()
+
+    def get_conversation_state(self, conversation_key: str) -> dict | None:
+        """Returns the stored state for a conversation -- {"history", "updated_at",
+        "chain", "summary"} -- or None if it has no history yet. chain is the server-side
+        response chain the history can be continued from ({"response_id", "start_seq",
+        "tokens"}), or None. summary condenses turns that were compacted out of the
+        history ({"content", "est_tokens"}), or None."""
+        cached = self._cache.get(conversation_key)
+        if self._multi_process:
+            # Another process may have moved the conversation on since we cached it.
+            conn = self._connection()
+            row = conn.execute(self._SELECT_UPDATED_AT, (conversation_key,)).fetchone()
+            if row is None:
+                return None
+            if cached is not None and cached["updated_at"] == row[0]:
+                return cached
+        elif cached is not None:
+            return cached
+        else:
+            # A pending write may have been evicted from the cache before it was flushed.
+            pending = self._write_queue.get(conversation_key)
+            if pending is not None:
+                return pending
+            conn = self._connection()
+
+        row = conn.execute(self._SELECT_CONVERSATION, (conversation_key,)).fetchone()
+        if row is None:
+            return None
+        updated_at, response_id, chain_start_seq, chain_tokens, summary, summary_tokens = row
+        state = {
+            "history": [_turn_from_row(r) for r in conn.execute(self._SELECT_TURNS, (conversation_key,))],
+            "updated_at": updated_at,
+            "chain": (
+                {"response_id": response_id, "start_seq": chain_start_seq, "tokens": chain_tokens}
+                if response_id is not None
+                else None
+            ),
+            "summary": {"content": summary, "est_tokens": summary_tokens} if summary is not None else None,
+        }
+        self._cache.put(conversation_key, state, if_newer=True)
+        return state
+
+    def save_history(
+        self,
+        conversation_key: str,
+        history: list[dict],
+        chain: dict | None = None,
+        summary: dict | None = None,
+        *,
+        expected_updated_at: str | None,
+    ) -> bool:
+        """Queues the conversation's latest history to be written and refreshes the cache;
+        returns immediately (with SQLITE_MULTI_PROCESS, writes it before returning).
+
+        `expected_updated_at` is the updated_at of the state the history was built from
+        (None if the conversation had none). With SQLITE_MULTI_PROCESS, if another
+        process has saved the conversation since, nothing is written and False is
+        returned: reload it and re-apply the new turns. Otherwise this process is the
+        only writer, handlers.py saves each conversation one turn at a time, and the
+        save always goes through.
+
+        `history` is the conversation as it should now stand: turns previously returned by
+        get_conversation_state (which carry a "seq") that are still wanted, followed by any
+        new turns (which don't yet). Stored turns older than the first one kept are
+        deleted; if none of the stored turns were kept -- a reset -- they're all replaced.
+
+        `chain` records the server-side response the history can be continued from:
+        {"response_id", "tokens", "start_seq"}, where start_seq is the seq of the first turn
+        that response's thread contains -- omit it (or pass None) when the thread starts
+        at the first turn of `history`.
+
+        `summary` is the conversation's rolling summary ({"content", "est_tokens"}) to
+        store alongside it; pass the current one through unchanged to keep it."""
+        write = _new_state(history, chain, summary)
+        if self._multi_process:
+            if not self._write_if_unchanged(conversation_key, write, expected_updated_at):
+                return False
+            self._cache.put(conversation_key, write.state)
+        else:
+            self._cache.put(conversation_key, write.state)
+            self._write_queue.put(conversation_key, write)
+        return True
+
+    def incr_counter(
+        self, key: str, amount: int = 1, ttl_seconds: float | None = None, limit: int | None = None
+    ) -> int | None:
+        """Atomically adds `amount` to the named counter (created at 0, and expiring
+        ttl_seconds after creation if given) and returns its new value. With `limit`, the
+        counter is left unchanged and None returned if the addition would take it past
+        the limit -- so "take one if there's room" is a single call, safe across
+        processes."""
+        if limit is not None and amount > limit:
+            return None
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if now >= self._next_counter_prune:
+                self._next_counter_prune = now + COUNTER_PRUNE_INTERVAL_SECONDS
+                conn.execute(self._DELETE_EXPIRED_COUNTERS, (now,))
+            else:
+                conn.execute(self._DELETE_EXPIRED_COUNTER, (key, now))
+            row = conn.execute(
+                self._INCREMENT_COUNTER,
+                {
+                    "key": key,
+                    "amount": amount,
+                    "expires_at": now + ttl_seconds if ttl_seconds is not None else None,
+                    "limit": limit,
+                },
+            ).fetchone()
+        return row[0] if row is not None else None
 
-    if row is None:
-        return None
-    return {"history": json.loads(row[0]), "updated_at": row[1]}
+    def get_counter(self, key: str) -> int:
+        """The counter's current value (0 if it doesn't exist or has expired)."""
+        row = self._connection().execute(self._SELECT_COUNTER, (key, time.time())).fetchone()
+        return row[0] if row is not None else 0
 
+    def get_counters(self, keys: list[str]) -> list[int]:
+        """get_counter for several counters at once, in the same order."""
+        if not keys:
+            return []
+        rows = self._connection().execute(
+            f"SELECT key, value FROM counters WHERE key IN ({', '.join('?' * len(keys))})"
+            " AND (expires_at IS NULL OR expires_at > ?)",
+            (*keys, time.time()),
+        ).fetchall()
+        values = dict(rows)
+        return [values.get(key, 0) for key in keys]
 
-def save_history(conversation_key: str, history: list[dict]) -> None:
-    with sqlite3.connect(sqlite_db_path) as conn:
+    def _write_batch(self, batch: dict[str, _PendingWrite]) -> None:
+        conn = self._connection()
+        with conn:
+            for key, write in batch.items():
+                self._write_conversation(conn, key, write)
+
+    def _write_if_unchanged(self, key: str, write: _PendingWrite, expected_updated_at: str | None) -> bool:
+        """Writes one conversation now, unless its stored updated_at is no longer
+        expected_updated_at. The write lock is taken before the check, so no other
+        process can save the conversation in between."""
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(self._SELECT_UPDATED_AT, (key,)).fetchone()
+            if (row[0] if row is not None else None) != expected_updated_at:
+                return False
+            self._write_conversation(conn, key, write)
+        return True
+
+    def _write_conversation(self, conn: sqlite3.Connection, key: str, write: _PendingWrite) -> None:
+        history, chain, summary = write.state["history"], write.state["chain"] or {}, write.state["summary"] or {}
         conn.execute(
-            """
-            INSERT INTO conversations (conversation_key, history_json, updated_at)
-            VALUES (?, ?, ?)
-            ON CONFLICT(conversation_key) DO UPDATE SET
-                history_json = excluded.history_json,
-                updated_at = excluded.updated_at
-            """,
-            (conversation_key, json.dumps(history), datetime.now(timezone.utc).isoformat()),
+            self._UPSERT_CONVERSATION,
+            (
+                key,
+                write.state["updated_at"],
+                chain.get("response_id"),
+                chain.get("start_seq"),
+                chain.get("tokens"),
+                summary.get("content"),
+                summary.get("est_tokens"),
+            ),
         )
+        if write.replace or not history:
+            conn.execute(self._DELETE_ALL_TURNS, (key,))
+        else:
+            conn.execute(self._DELETE_TURNS_BEFORE, (key, history[0]["seq"]))
+        conn.executemany(
+            self._INSERT_TURN,
+            [
+                (key, m["seq"], m["role"], m["content"], m.get("est_tokens"))
+                for m in history
+                if write.replace or m["seq"] >= write.first_new_seq
+            ],
+        )
+
+
+def _new_state(history: list[dict], chain: dict | None, summary: dict | None) -> _PendingWrite:
+    """Numbers the new turns of a history being saved (see save_history) and builds the
+    state to store for it, wrapped with what changed relative to the stored version."""
+    seqs = [m["seq"] for m in history if "seq" in m]
+    replace = not seqs
+    next_seq = 0 if replace else max(seqs) + 1
+    first_new_seq = next_seq
+    numbered = []
+    for m in history:
+        if "seq" not in m:
+            m = {**m, "seq": next_seq}
+            next_seq += 1
+        numbered.append(m)
+
+    if chain is not None:
+        start_seq = chain.get("start_seq")
+        if start_seq is None:
+            start_seq = numbered[0]["seq"] if numbered else 0
+        chain = {"response_id": chain["response_id"], "start_seq": start_seq, "tokens": chain.get("tokens")}
+
+    state = {
+        "history": numbered,
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+        "chain": chain,
+        "summary": summary,
+    }
+    return _PendingWrite(state, first_new_seq, replace)
+
+
+def _copy_state(state: dict) -> dict:
+    """Copy of a state dict whose history list the caller is free to modify (turns
+    themselves are shared; a stored turn's role and content never change)."""
+    return {**state, "history": list(state["history"])}
+
+
+def _turn_from_row(row: tuple) -> dict:
+    seq, role, content, est_tokens = row
+    turn = {"role": role, "content": content, "seq": seq}
+    if est_tokens is not None:
+        turn["est_tokens"] = est_tokens
+    return turn
+
+
+def _load_backend():
+    if storage_backend == "redis":
+        from .redis_storage import RedisStorage
+
+        return RedisStorage.from_url(redis_url, redis_key_prefix)
+    return SQLiteStorage(sqlite_db_path, multi_process=sqlite_multi_process)
+
+
+backend = _load_backend()
@@ -1,78 +1,104 @@
 """Converts the model's CommonMark-style Markdown output into Telegram's HTML
 parse-mode format, so **bold**, _italic_, `code`, links, lists, and blockquotes
-actually render instead of showing up as raw markdown syntax in the chat."""
+actually render instead of showing up as raw markdown syntax in the chat.
+
+Replies are rendered with render_chunks(), which also splits them into messages: the
+answer is parsed once and split between top-level blocks of the token stream, so no
+message ever starts or ends inside a tag (or a list, quote or code block) and nothing
+is parsed twice. Messages are sized by their rendered HTML as well as their Markdown,
+since escaping can make the HTML several times longer ("<" -> "&lt;"). Text with no
+Markdown syntax at all -- most short answers -- skips the parser entirely."""
 
 import html as _html
+import re
 
 from markdown_it import MarkdownIt
 
+from .metrics import timed
+
 _md = MarkdownIt("commonmark").enable("strikethrough")
 
+# Plain-text fast path: text matching neither of these renders to just its escaped
+# paragraphs, so it doesn't need the parser. The first catches every inline construct
+# (emphasis, code, links, autolinks/HTML, entities, escapes, strikethrough); the second
+# any line that could open a block (indented code, lists, headings, quotes, setext and
+# thematic breaks) -- including some that wouldn't, which just take the slow path.
+_INLINE_SYNTAX_RE = re.compile(r"[\\`*_~\[\]<>&\r\x00]")
+_BLOCK_SYNTAX_RE = re.compile(r"^(?:[ \t]+[^ \t\n]|[-+=#]|\d{1,9}[.)])", re.MULTILINE)
+_BLANK_LINES_RE = re.compile(r"\n(?:[ \t]*\n)+")
+_EXTRA_NEWLINES_RE = re.compile(r"\n{3,}")
+
+_INLINE_TAGS = {
+    "strong_open": "<b>",
+    "strong_close": "</b>",
+    "em_open": "<i>",
+    "em_close": "</i>",
+    "s_open": "<s>",
+    "s_close": "</s>",
+    "link_close": "</a>",
+    "softbreak": "\n",
+    "hardbreak": "\n",
+}
+
 
 def _escape(text: str) -> str:
     return _html.escape(text, quote=False)
 
 
-def _render_inline(children) -> str:
-    out = []
+def _is_plain(text: str) -> bool:
+    return _INLINE_SYNTAX_RE.search(text) is None and _BLOCK_SYNTAX_RE.search(text) is None
+
+
+def _render_plain(text: str) -> str:
+    """What the full renderer produces for text that passes _is_plain(): each paragraph's
+    lines stripped of trailing spaces, paragraphs separated by one blank line."""
+    paragraphs = (p.strip() for p in _BLANK_LINES_RE.split(text.strip()))
+    return "\n\n".join(
+        _escape("\n".join(line.rstrip(" ") for line in p.split("\n"))) for p in paragraphs if p
+    )
+
+
+def _render_inline(children, out: list) -> None:
     for tok in children:
         t = tok.type
         if t == "text":
             out.append(_escape(tok.content))
+        elif t in _INLINE_TAGS:
+            out.append(_INLINE_TAGS[t])
         elif t == "code_inline":
             out.append(f"<code>{_escape(tok.content)}</code>")
-        elif t == "strong_open":
-            out.append("<b>")
-        elif t == "strong_close":
-            out.append("</b>")
-        elif t == "em_open":
-            out.append("<i>")
-        elif t == "em_close":
-            out.append("</i>")
-        elif t == "s_open":
-            out.append("<s>")
-        elif t == "s_close":
-            out.append("</s>")
         elif t == "link_open":
             href = _html.escape(tok.attrGet("href") or "", quote=True)
             out.append(f'<a href="{href}">')
-        elif t == "link_close":
-            out.append("</a>")
-        elif t in ("softbreak", "hardbreak"):
-            out.append("\n")
         elif t == "image":
             out.append(_escape(tok.content or tok.attrGet("alt") or ""))
         elif tok.children:
-            out.append(_render_inline(tok.children))
+            _render_inline(tok.children, out)
         elif tok.content:
             out.append(_escape(tok.content))
-    return "".join(out)
 
 
-def to_telegram_html(text: str) -> str:
-    """Renders Markdown to the subset of HTML Telegram's parse_mode="HTML" accepts
-    (b/i/s/code/pre/a/blockquote). Anything not explicitly handled (raw HTML blocks,
-    tables, etc.) is dropped rather than passed through, so we never emit an entity
-    Telegram doesn't recognize."""
-    tokens = _md.parse(text)
-    out = []
+def _render_tokens(tokens, out: list) -> None:
+    """Appends the Telegram HTML for a run of block tokens to `out`. Anything not
+    explicitly handled (raw HTML blocks, tables, etc.) is dropped rather than passed
+    through, so we never emit an entity Telegram doesn't recognize."""
     list_stack = []  # each entry: ["bullet"|"ordered", count]
 
     for tok in tokens:
         t = tok.type
 
-        if t == "heading_open":
-            out.append("<b>")
-        elif t == "heading_close":
-            out.append("</b>\n\n")
-        elif t == "inline":
-            out.append(_render_inline(tok.children))
+        if t == "inline":
+            _render_inline(tok.children, out)
         elif t == "paragraph_close":
             # Inside a list item, markdown-it wraps content in a paragraph even for
             # "tight" lists in some cases; list_item_close already adds the newline,
             # so skip the extra blank line here to avoid a gap between every bullet.
             if not list_stack:
                 out.append("\n\n")
+        elif t == "heading_open":
+            out.append("<b>")
+        elif t == "heading_close":
+            out.append("</b>\n\n")
         elif t == "bullet_list_open":
             list_stack.append(["bullet", 0])
         elif t == "ordered_list_open":
@@ -100,10 +126,137 @@ def to_telegram_html(text: str) -> str:
             out.append(f"<pre>{_escape(tok.content)}</pre>\n\n")
         elif t == "hr":
             out.append("─" * 10 + "\n\n")
-        # Anything else (html_block, tables, etc.) is intentionally skipped.
 
+
+def _finish(out: list) -> str:
     result = "".join(out).strip()
     result = result.replace("\n\n</blockquote>", "</blockquote>")
-    while "\n\n\n" in result:
-        result = result.replace("\n\n\n", "\n\n")
-    return result
+    return _EXTRA_NEWLINES_RE.sub("\n\n", result)
+
+
+def _render(text: str) -> str:
+    if _is_plain(text):
+        return _render_plain(text)
+    out = []
+    _render_tokens(_md.parse(text), out)
+    return _finish(out)
+
+
+@timed("render_markdown")
+def to_telegram_html(text: str) -> str:
+    """Renders Markdown to the subset of HTML Telegram's parse_mode="HTML" accepts
+    (b/i/s/code/pre/a/blockquote)."""
+    return _render(text)
+
+
+def _split_text(text: str, limit: int) -> list[str]:
+    """Splits text into chunks of at most `limit` characters, preferring to break on a
+    paragraph/line/word boundary over mid-word. Knows nothing about Markdown."""
+    if len(text) <= limit:
+        return [text]
+
+    chunks = []
+    remaining = text
+    while len(remaining) > limit:
+        split_at = remaining.rfind("\n\n", 0, limit)
+        if split_at == -1:
+            split_at = remaining.rfind("\n", 0, limit)
+        if split_at == -1:
+            split_at = remaining.rfind(" ", 0, limit)
+        if split_at <= 0:
+            split_at = limit
+        chunks.append(remaining[:split_at].rstrip())
+        remaining = remaining[split_at:].lstrip()
+    if remaining:
+        chunks.append(remaining)
+    return chunks
+
+
+def _top_level_blocks(tokens) -> list[tuple[int, int, int, int]]:
+    """(first token, end token, first source line, end source line) of each top-level
+    block -- a paragraph, a whole list, a whole quote, a code block, ..."""
+    blocks = []
+    depth = 0
+    start = 0
+    for i, tok in enumerate(tokens):
+        if depth == 0:
+            start = i
+        depth += tok.nesting
+        if depth == 0:
+            line_start, line_end = tokens[start].map
+            blocks.append((start, i + 1, line_start, line_end))
+    return blocks
+
+
+def _render_split(text: str, limit: int, text_limit: int | None = None) -> list[tuple[str, str]]:
+    """render_chunks for a single block too long for one message: split as text into
+    pieces of at most text_limit (default: limit) characters, each rendered on its own,
+    and split further -- in proportion to how much escaping grew it -- while a piece's
+    HTML is still over limit."""
+    chunks = []
+    for chunk in _split_text(text, text_limit or limit):
+        html = _render(chunk)
+        if len(html) > limit and len(chunk) > 1:
+            chunks.extend(_render_split(chunk, limit, max(1, len(chunk) * limit // len(html))))
+        else:
+            chunks.append((chunk, html))
+    return chunks
+
+
+@timed("render_markdown")
+def render_chunks(text: str, limit: int) -> list[tuple[str, str]]:
+    """Splits a reply into messages of at most `limit` characters, both of Markdown and
+    of rendered HTML, and renders each: a list of (markdown, html) pairs, the Markdown
+    being what to send as plain text if Telegram rejects the HTML. Messages break
+    between top-level blocks; a single block too long for one message is split as text
+    and its pieces rendered separately."""
+    # markdown-it also breaks lines on a lone "\r"; the block map below counts "\n" only.
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    if len(text) <= limit:
+        html = _render(text)
+        if len(html) <= limit:
+            return [(text, html)]
+    # Plain text has nothing to escape, so its HTML is never longer than the text.
+    if _is_plain(text):
+        return [(chunk, _render_plain(chunk)) for chunk in _split_text(text, limit)]
+
+    tokens = _md.parse(text)
+    lines = text.split("\n")
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line) + 1)
+
+    chunks = []
+    # Top-level blocks render independently, so a message's HTML is its blocks' HTML
+    # joined (and _finish only ever shortens it).
+    group: list[tuple[int, int, int, int]] = []
+    out: list[str] = []
+    html_length = 0
+
+    def flush():
+        nonlocal html_length
+        if not group:
+            return
+        markdown = "\n".join(lines[group[0][2]:group[-1][3]]).strip()
+        chunks.append((markdown, _finish(out)))
+        group.clear()
+        out.clear()
+        html_length = 0
+
+    for block in _top_level_blocks(tokens):
+        start, end, line_start, line_end = block
+        block_out = []
+        _render_tokens(tokens[start:end], block_out)
+        block_html = "".join(block_out)
+        if offsets[line_end] - offsets[line_start] > limit or len(block_html) > limit:
+            flush()
+            chunks.extend(_render_split("\n".join(lines[line_start:line_end]).strip(), limit))
+            continue
+        if group and (offsets[line_end] - offsets[group[0][2]] > limit or html_length + len(block_html) > limit):
+            flush()
+        group.append(block)
+        out.append(block_html)
+        html_length += len(block_html)
+    flush()
+    return chunks
@@ -0,0 +1,87 @@
+# tokens.py
+# Token estimators used to keep conversations under handlers.MAX_CONTEXT_TOKENS. Each
+# turn's estimate is computed once, stored on the history entry as "est_tokens" and
+# persisted with it (see storage.py), so trimming never has to re-measure old turns.
+import logging
+from typing import Protocol
+
+from .config import token_estimator
+
+logger = logging.getLogger(__name__)
+
+# No tokenizer dependency by default: file_search's retrieved-document tokens are
+# invisible to us until after the call anyway and dominate the real total, so a precise
+# local count of just the conversational text wouldn't meaningfully improve this estimate.
+CHARS_PER_TOKEN_ESTIMATE = 4
+# Encoding used by TiktokenEstimator; close enough for current OpenAI models' budgeting.
+TIKTOKEN_ENCODING = "o200k_base"
+
+
+class TokenEstimator(Protocol):
+    name: str
+
+    def estimate(self, text: str) -> int:
+        ...
+
+
+class CharRatioEstimator:
+    name = "chars"
+
+    def __init__(self, chars_per_token: int = CHARS_PER_TOKEN_ESTIMATE):
+        self._chars_per_token = chars_per_token
+
+    def estimate(self, text: str) -> int:
+        return max(1, len(text) // self._chars_per_token)
+
+
+class TiktokenEstimator:
+    name = "tiktoken"
+
+    def __init__(self, encoding: str = TIKTOKEN_ENCODING):
+        try:
+            import tiktoken
+        except ImportError as e:
+            raise RuntimeError("TOKEN_ESTIMATOR=tiktoken requires the tiktoken package (pip install tiktoken)") from e
+        self._encoding = tiktoken.get_encoding(encoding)
+
+    def estimate(self, text: str) -> int:
+        return max(1, len(self._encoding.encode(text, disallowed_special=())))
+
+
+_ESTIMATORS = {
+    CharRatioEstimator.name: CharRatioEstimator,
+    TiktokenEstimator.name: TiktokenEstimator,
+}
+
+
+def _load_estimator(name: str) -> TokenEstimator:
+    factory = _ESTIMATORS.get(name)
+    if factory is None:
+        logger.error(f"Unknown TOKEN_ESTIMATOR {name!r}, falling back to {CharRatioEstimator.name!r}")
+        return CharRatioEstimator()
+    try:
+        return factory()
+    except RuntimeError as e:
+        logger.error(f"{e}; falling back to {CharRatioEstimator.name!r}")
+        return CharRatioEstimator()
+    except Exception:
+        # e.g. tiktoken failing to download its encoding: estimate roughly rather than
+        # refuse to start.
+        logger.exception(f"Failed to load TOKEN_ESTIMATOR {name!r}; falling back to {CharRatioEstimator.name!r}")
+        return CharRatioEstimator()
+
+
+estimator: TokenEstimator = _load_estimator(token_estimator)
+
+
+def estimate_tokens(text: str) -> int:
+    return estimator.estimate(text)
+
+
+def turn_tokens(turn: dict) -> int:
+    """The turn's cached estimate, computing and caching it first if it doesn't have one
+    yet (e.g. turns stored before estimates were persisted)."""
+    est = turn.get("est_tokens")
+    if est is None:
+        est = turn["est_tokens"] = estimate_tokens(turn["content"])
+    return est
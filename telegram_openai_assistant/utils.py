@@ -1,59 +1,109 @@
 import json
+import os
 from pathlib import Path
 import datetime
 from filelock import FileLock
 
-from .config import data_dir
+from .config import data_dir, qa_log_max_bytes
+from .metrics import timed
 
 # Paths to the files, anchored under DATA_DIR so root-vs-package CWD drift can't happen
 # and, on Railway, this can point into the mounted volume to survive redeploys.
 _data_dir = Path(data_dir)
 _data_dir.mkdir(parents=True, exist_ok=True)
-message_count_file = _data_dir / "message_count.json"
+# Legacy Q&A log: a single JSON array that had to be fully re-read and re-written on
+# every message. Only kept around so migrate_legacy_qa() can find and convert it.
 qa_file = _data_dir / "questions_answers.json"
+# Current Q&A log: one JSON object per line, so saving a turn is a single append no
+# matter how large the history has grown. Rotated into QA_ARCHIVE_GLOB-named archives.
+qa_log_file = _data_dir / "questions_answers.jsonl"
+QA_ARCHIVE_PREFIX = "questions_answers-"
+QA_ARCHIVE_GLOB = f"{QA_ARCHIVE_PREFIX}*.jsonl"
+# Sorts ahead of every timestamped archive, so exports stay in chronological order.
+_LEGACY_ARCHIVE_NAME = f"{QA_ARCHIVE_PREFIX}00000000-000000-legacy.jsonl"
 lock_file = _data_dir / "file.lock"  # Lock file for safe file operations
 
-def get_message_count():
-    """Retrieve the current message count."""
-    try:
-        if not message_count_file.exists():
-            return {"date": str(datetime.date.today()), "count": 0}
-        
-        with open(message_count_file, 'r') as file:
-            return json.load(file)
-    except (IOError, json.JSONDecodeError) as e:
-        print(f"Error reading message count: {e}")
-        return {"date": str(datetime.date.today()), "count": 0}
+def _archive_path(now: datetime.datetime) -> Path:
+    path = _data_dir / f"{QA_ARCHIVE_PREFIX}{now:%Y%m%d-%H%M%S-%f}.jsonl"
+    suffix = 1
+    while path.exists():  # two rotations within the same microsecond
+        path = _data_dir / f"{QA_ARCHIVE_PREFIX}{now:%Y%m%d-%H%M%S-%f}-{suffix}.jsonl"
+        suffix += 1
+    return path
 
-def update_message_count(new_count):
-    """Update the message count in the file."""
+def _rotate_qa_log_if_needed(now: datetime.datetime) -> None:
+    """Moves the live log aside once it's too big or was last written on an earlier day.
+    Must be called with the file lock held."""
     try:
-        with FileLock(str(lock_file)):
-            with open(message_count_file, 'w') as file:
-                json.dump({"date": str(datetime.date.today()), "count": new_count}, file)
-    except IOError as e:
-        print(f"Error updating message count: {e}")
+        stat = qa_log_file.stat()
+    except FileNotFoundError:
+        return
+    if stat.st_size == 0:
+        return
+    last_written = datetime.datetime.fromtimestamp(stat.st_mtime).date()
+    if stat.st_size >= qa_log_max_bytes or last_written != now.date():
+        os.replace(qa_log_file, _archive_path(now))
 
-def save_qa(telegram_id, username, question, answer):
-    """Save question and answer pairs to a file with user information."""
+@timed("save_qa")
+def save_qa_batch(entries: list[dict]) -> None:
+    """Appends Q&A entries (see analytics.qa_event) to the Q&A log, one compact JSON
+    object per line, in a single write. Raises OSError if the log can't be written."""
+    data = "".join(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n" for entry in entries)
+    # The lock only covers a stat() and a single append, not a full rewrite.
+    with FileLock(str(lock_file)):
+        _rotate_qa_log_if_needed(datetime.datetime.now())
+        with open(qa_log_file, 'a', encoding="utf-8") as file:
+            file.write(data)
+
+def migrate_legacy_qa():
+    """One-shot conversion of the legacy questions_answers.json array into the JSON Lines
+    log. The converted entries become the oldest archive, and the legacy file is renamed
+    (not deleted) to questions_answers.json.migrated so it's only ever picked up once.
+    Safe to call on every startup."""
     try:
         with FileLock(str(lock_file)):
-            # Ensure the QA file exists
             if not qa_file.exists():
-                with open(qa_file, 'w') as file:
-                    json.dump([], file)
-
-            # Read, append, and save the new Q&A entry
-            with open(qa_file, 'r+') as file:
-                data = json.load(file)
-                data.append({
-                    "telegram_id": telegram_id,
-                    "username": username,
-                    "question": question,
-                    "answer": answer,
-                    "timestamp": str(datetime.datetime.now())  # Add timestamp
-                })
-                file.seek(0)
-                json.dump(data, file, indent=4)
+                return
+            with open(qa_file, 'r', encoding="utf-8") as file:
+                entries = json.load(file)
+            tmp_path = _data_dir / (_LEGACY_ARCHIVE_NAME + ".tmp")
+            with open(tmp_path, 'w', encoding="utf-8") as file:
+                for entry in entries:
+                    file.write(json.dumps(entry) + "\n")
+            os.replace(tmp_path, _data_dir / _LEGACY_ARCHIVE_NAME)
+            os.replace(qa_file, qa_file.with_name(qa_file.name + ".migrated"))
+            print(f"Migrated {len(entries)} Q&A entries from {qa_file.name}")
     except (IOError, json.JSONDecodeError) as e:
-        print(f"Error saving Q&A: {e}")
+        print(f"Error migrating legacy Q&A file: {e}")
+
+def iter_qa_entries():
+    """Yields every logged Q&A entry, oldest first, across all archives and the live log."""
+    paths = sorted(_data_dir.glob(QA_ARCHIVE_GLOB))
+    if qa_log_file.exists():
+        paths.append(qa_log_file)
+    for path in paths:
+        with open(path, 'r', encoding="utf-8") as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line (e.g. the process was killed mid-write) shouldn't
+                    # make the rest of the history unexportable.
+                    print(f"Skipping malformed Q&A line in {path.name}")
+
+def export_qa_json(output_path) -> int:
+    """Writes the whole Q&A history as a single JSON array in the legacy
+    questions_answers.json format, for analysts' existing tooling. Streams entries
+    rather than building the full list in memory. Returns the number of entries written."""
+    count = 0
+    with open(output_path, 'w', encoding="utf-8") as file:
+        file.write("[")
+        for entry in iter_qa_entries():
+            file.write(",\n    " if count else "\n    ")
+            file.write(json.dumps(entry, indent=4).replace("\n", "\n    "))
+            count += 1
+        file.write("\n]" if count else "]")
+    return count
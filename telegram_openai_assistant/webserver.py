@@ -0,0 +1,221 @@
+# webserver.py
+# The HTTP side of webhook mode (BOT_MODE=webhook): Telegram POSTs each update to
+# WEBHOOK_PATH and we hand it to the same python-telegram-bot Application that polling
+# mode uses, so handlers don't know the difference. Also serves the probes a process
+# manager / load balancer needs:
+#   GET /healthz  -- 200 while the process is up (liveness)
+#   GET /readyz   -- 200 once the bot is started, 503 before that and while draining
+#                    for shutdown (readiness), so traffic is routed elsewhere
+#
+# Metrics (GET /metrics, see metrics.py) are only served by the separate HttpServer on
+# METRICS_PORT, never on the public webhook listener.
+#
+# Deliberately tiny and dependency-free (asyncio streams, HTTP/1.1 with keep-alive,
+# Content-Length bodies only): that's all Telegram, health checkers and scrapers speak,
+# and it avoids pulling in tornado just for python-telegram-bot's built-in webhook
+# server. HttpServer on its own (just /healthz and /metrics) is what exposes metrics on
+# METRICS_PORT, in either mode.
+import asyncio
+import hmac
+import json
+import logging
+from http import HTTPStatus
+
+from telegram import Update
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram updates are a few KB; anything far bigger isn't one.
+MAX_BODY_BYTES = 1024 * 1024
+# Idle keep-alive connections are closed after this long.
+KEEPALIVE_TIMEOUT_SECONDS = 75
+SECRET_TOKEN_HEADER = "x-telegram-bot-api-secret-token"
+
+
+class Request:
+    __slots__ = ("method", "path", "query", "headers", "body")
+
+    def __init__(self, method: str, path: str, query: str, headers: dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+
+class Response:
+    __slots__ = ("status", "body", "content_type")
+
+    def __init__(self, status: int = 200, body: bytes | str = b"", content_type: str = "text/plain; charset=utf-8"):
+        self.status = status
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.content_type = content_type
+
+
+class HttpServer:
+    """Serves /healthz and (unless serve_metrics is off) /metrics, plus any routes added
+    with add_route()."""
+
+    def __init__(self, host: str, port: int, serve_metrics: bool = True):
+        self._host = host
+        self._port = port
+        self._server: asyncio.base_events.Server | None = None
+        self._connections: set[asyncio.Task] = set()
+        self._routes: dict[tuple[str, str], object] = {}
+        self.add_route("GET", "/healthz", self._healthz)
+        if serve_metrics:
+            self.add_route("GET", "/metrics", self._metrics)
+
+    def add_route(self, method: str, path: str, handler) -> None:
+        """Registers `async handler(request) -> Response` for method + exact path."""
+        self._routes[(method, path)] = handler
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve_connection, self._host, self._port)
+        logger.info(f"HTTP server listening on {self._host}:{self._port}")
+
+    async def stop(self) -> None:
+        """Stops accepting connections and closes the open ones."""
+        if self._server is None:
+            return
+        self._server.close()
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _healthz(self, request: Request) -> Response:
+        return Response(200, "ok\n")
+
+    async def _metrics(self, request: Request) -> Response:
+        return Response(200, metrics.registry.render(), metrics.CONTENT_TYPE)
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(_read_request(reader), KEEPALIVE_TIMEOUT_SECONDS)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    return
+                except _BadRequest as e:
+                    await _write_response(writer, Response(e.status), keep_alive=False)
+                    return
+                if request is None:
+                    return
+                handler = self._routes.get((request.method, request.path))
+                if handler is None:
+                    allowed = any(path == request.path for _, path in self._routes)
+                    response = Response(405 if allowed else 404)
+                else:
+                    try:
+                        response = await handler(request)
+                    except Exception:
+                        logger.exception(f"HTTP server: error handling {request.method} {request.path}")
+                        response = Response(500)
+                keep_alive = request.headers.get("connection", "").lower() != "close"
+                await _write_response(writer, response, keep_alive)
+                if not keep_alive:
+                    return
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+
+
+class WebhookServer(HttpServer):
+    """HttpServer plus the Telegram webhook and readiness probe for `application`, which
+    must already be initialized and started (its update_queue is what we feed)."""
+
+    def __init__(self, application, host: str, port: int, webhook_path: str, secret_token: str):
+        super().__init__(host, port, serve_metrics=False)
+        self._application = application
+        self._secret_token = secret_token
+        # Ready: accepting updates. Cleared on shutdown before draining so Telegram's
+        # retries (and the load balancer) go to another instance instead.
+        self.ready = False
+        self.add_route("GET", "/readyz", self._readyz)
+        self.add_route("POST", webhook_path, self._webhook)
+
+    async def stop(self) -> None:
+        """Stops accepting connections and closes the open ones. Requests already handed
+        to the application keep being processed by it."""
+        self.ready = False
+        await super().stop()
+
+    async def _readyz(self, request: Request) -> Response:
+        if self.ready:
+            return Response(200, "ready\n")
+        return Response(503, "not ready\n")
+
+    async def _webhook(self, request: Request) -> Response:
+        supplied = request.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(supplied.encode("utf-8"), self._secret_token.encode("utf-8")):
+            logger.warning("Webhook: rejected request with a missing or wrong secret token")
+            return Response(403)
+        if not self.ready:
+            # Telegram retries non-2xx deliveries, so the update isn't lost.
+            return Response(503)
+        try:
+            update = Update.de_json(json.loads(request.body), self._application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Webhook: malformed update: {e}")
+            return Response(400)
+        await self._application.update_queue.put(update)
+        return Response(200)
+
+
+class _BadRequest(Exception):
+    def __init__(self, status: int):
+        self.status = status
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Request | None:
+    """Reads one request off the connection, or returns None if the client closed it."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _version = request_line.decode("latin-1").split()
+    except ValueError:
+        raise _BadRequest(400)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise _BadRequest(411)
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise _BadRequest(400)
+    if length > MAX_BODY_BYTES:
+        raise _BadRequest(413)
+    body = await reader.readexactly(length) if length else b""
+    path, _, query = target.partition("?")
+    return Request(method.upper(), path, query, headers, body)
+
+
+async def _write_response(writer: asyncio.StreamWriter, response: Response, keep_alive: bool) -> None:
+    reason = HTTPStatus(response.status).phrase
+    head = (
+        f"HTTP/1.1 {response.status} {reason}\r\n"
+        f"Content-Type: {response.content_type}\r\n"
+        f"Content-Length: {len(response.body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        "\r\n"
+    )
+    writer.write(head.encode("latin-1") + response.body)
+    await writer.drain()